@@ -0,0 +1,397 @@
+"""Benchmark bmmgr storages and render on synthetic bookmarks.
+
+Every measurement runs in its own process, so its peak RSS is its own, and the results are printed as json
+to compare storage changes across commits, e.g.
+
+    python bench_bmmgr.py --sizes 1000,10000 -o before.json
+"""
+from __future__ import annotations
+
+import argparse
+import base64
+import dataclasses
+import datetime
+import io
+import json
+import logging
+import os.path
+import platform
+import random
+import resource
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bmmgr
+
+
+logging.basicConfig()
+logger = logging.getLogger('bench')
+
+BACKENDS = {
+    'db': 'bookmarks.db',
+    'jsonl': 'bookmarks.jsonl',
+    'njsonl': 'bookmarks.njsonl',
+    'split': 'bookmarks',
+}
+# ops changing the storage run on a copy of it
+MUTATING_OPS = ('save', 'add', 'remove', 'update')
+STORAGE_OPS = ('save', 'load', 'query', 'add', 'remove', 'update', 'render')
+WORDS = ('python', 'linux', 'rust', 'news', 'blog', 'docs', 'video', 'music', 'paper', 'tool', 'game', 'recipe',
+         'travel', 'finance', 'design', 'api', 'guide', 'home', 'forum', 'wiki')
+
+
+@dataclasses.dataclass
+class Workload:
+    size: int = 10000
+    tags: int = 200
+    tags_per_bookmark: int = 3
+    # tag k is picked with weight 1 / (k + 1) ** tag_skew, 0 for uniform
+    tag_skew: float = 1.0
+    icon_size: int = 2048
+    icon_ratio: float = 0.8
+    distinct_icons: int = 500
+    # bookmarks touched by query, add, remove, update and fetch
+    ops_count: int = 200
+    seed: int = 0
+
+    def uri(self, idx: int) -> str:
+        return f'https://host{idx % max(1, self.size // 20)}.example/{idx}'
+
+    def sample(self, count: int) -> list[int]:
+        return random.Random(f'{self.seed}:sample').sample(range(self.size), min(count, self.size))
+
+
+def generate(w: Workload, start: int, stop: int) -> typing.Iterator[bmmgr.Bookmark]:
+    """bookmarks `start` to `stop` of the workload, the same for the same workload"""
+    icon_rng = random.Random(f'{w.seed}:icons')
+    icons = [f'data:image/png;base64,{base64.b64encode(icon_rng.randbytes(w.icon_size)).decode()}'
+             for _ in range(w.distinct_icons)]
+    tag_names = [f'tag{k}' for k in range(w.tags)]
+    cum_weights = []
+    total = 0.0
+    for k in range(w.tags):
+        total += 1 / (k + 1) ** w.tag_skew
+        cum_weights.append(total)
+    rng = random.Random(f'{w.seed}:{start}')
+    for idx in range(start, stop):
+        yield bmmgr.Bookmark(
+            title=f'{idx} {" ".join(rng.choices(WORDS, k=4))}',
+            uri=w.uri(idx),
+            tags=set(rng.choices(tag_names, cum_weights=cum_weights, k=w.tags_per_bookmark)) if tag_names else set(),
+            icon_data_uri=rng.choice(icons) if icons and rng.random() < w.icon_ratio else ''
+        )
+
+
+def peak_rss_kb() -> int:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB elsewhere
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def prepare_op(op: str, path: str, w: Workload, base_url: str) -> typing.Callable[[], int]:
+    """do the setup of `op` and return the part to measure, which returns how many items it handled"""
+    if op == 'fetch':
+        bookmarks = [bmmgr.Bookmark(f'page {idx}', f'{base_url}/p/{idx}', icon_uri=f'/icons/{idx % w.distinct_icons}.png')
+                     for idx in range(w.ops_count)]
+        # one local host stands for all the sites, so it is not limited like one
+        options = bmmgr.FetchOptions(concurrency=32, per_host=32, rate=0, retries=1)
+
+        def _fetch():
+            bmmgr.get_all_info(bookmarks, fetch_options=options)
+            return len(bookmarks)
+        return _fetch
+
+    storage = bmmgr.get_storage(path)
+    if op == 'save':
+        bookmarks = list(generate(w, 0, w.size))
+
+        def _save():
+            storage.save(bookmarks)
+            return len(bookmarks)
+        return _save
+    if op == 'load':
+        return lambda: len(storage.load())
+    if op == 'render':
+        def _render():
+            bookmarks = storage.load()
+            bmmgr.render(bookmarks)
+            return len(bookmarks)
+        return _render
+    uris = [w.uri(idx) for idx in w.sample(w.ops_count)]
+    if op == 'query':
+        def _query():
+            for uri in uris:
+                storage.query([[('uri', '=', uri)]])
+            # scans, a few of them weigh as much as the point queries
+            for k in range(10):
+                storage.query([[('title', 'like', f'%{WORDS[k]}%')]])
+            return len(uris) + 10
+        return _query
+    if op == 'add':
+        bookmarks = list(generate(w, w.size, w.size + w.ops_count))
+
+        def _add():
+            for b in bookmarks:
+                storage.add(b)
+            return len(bookmarks)
+        return _add
+    if op == 'remove':
+        def _remove():
+            for uri in uris:
+                storage.remove(uri=uri)
+            return len(uris)
+        return _remove
+    if op == 'update':
+        bookmarks = [b for uri in uris for b in storage.query([[('uri', '=', uri)]])]
+        for b in bookmarks:
+            b.title = f'{b.title} updated'
+
+        def _update():
+            storage.update(bookmarks, ['title'])
+            return len(bookmarks)
+        return _update
+    raise ValueError(f'unknown op: {op}')
+
+
+def run_worker(args):
+    w = Workload(**json.loads(args.workload))
+    measure = prepare_op(args.op, args.path, w, args.base_url)
+    setup_rss_kb = peak_rss_kb()
+    start = time.perf_counter()
+    items = measure()
+    seconds = time.perf_counter() - start
+    json.dump({'seconds': seconds, 'items': items, 'peak_rss_kb': peak_rss_kb(), 'setup_rss_kb': setup_rss_kb},
+              sys.stdout)
+
+
+def run_micro_render(args) -> list[dict]:
+    """time `render` alone on bookmarks in memory, without any storage"""
+    results = []
+    for size in args.sizes:
+        w = Workload(**{field.name: getattr(args, field.name) for field in dataclasses.fields(Workload)
+                        if field.name != 'size'}, size=size)
+        bookmarks = list(generate(w, 0, size))
+        runs = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            bmmgr.render(bookmarks)
+            runs.append(time.perf_counter() - start)
+        seconds = min(runs)
+        results.append({
+            'size': size,
+            'op': 'micro-render',
+            'items': size,
+            'seconds': seconds,
+            'median_seconds': statistics.median(runs),
+            'seconds_per_10k': seconds * 10000 / size if size else None,
+            'peak_rss_kb': peak_rss_kb(),
+        })
+        logger.info('render %d: %.3fs, %.3fs per 10k', size, seconds, results[-1]['seconds_per_10k'] or 0)
+    return results
+
+
+def run_server(args):
+    """stand-in of the sites bookmarks point to: pages linking icons, and icons of `icon_px`"""
+    import aiohttp.web
+    import PIL.Image
+
+    rng = random.Random(args.seed)
+    icons = []
+    for _ in range(args.distinct_icons):
+        with io.BytesIO() as f:
+            PIL.Image.frombytes('RGB', (args.icon_px, args.icon_px), rng.randbytes(args.icon_px ** 2 * 3)).save(f, 'PNG')
+            icons.append(f.getvalue())
+
+    async def page(request):
+        idx = int(request.match_info['idx'])
+        return aiohttp.web.Response(
+            text=f'<html><head><title>page {idx}</title><link rel="icon" href="/icons/{idx % len(icons)}.png"></head></html>',
+            content_type='text/html')
+
+    async def icon(request):
+        return aiohttp.web.Response(body=icons[int(request.match_info['idx']) % len(icons)], content_type='image/png')
+
+    async def favicon(request):
+        return aiohttp.web.Response(body=icons[0], content_type='image/png')
+
+    app = aiohttp.web.Application()
+    app.router.add_get('/p/{idx}', page)
+    app.router.add_get('/favicon.ico', favicon)
+    app.router.add_get('/icons/{idx}.png', icon)
+    sock = socket.create_server(('127.0.0.1', 0))
+    print(sock.getsockname()[1], flush=True)
+    aiohttp.web.run_app(app, sock=sock, print=None)
+
+
+class Bench:
+    def __init__(self, args, workdir: str):
+        self._args = args
+        self._workdir = workdir
+        self._base_url = ''
+
+    def _run(self, op: str, path: str, w: Workload) -> dict:
+        cmd = [sys.executable, os.path.abspath(__file__), 'worker', '--op', op, '--path', path,
+               '--workload', json.dumps(dataclasses.asdict(w)), '--base-url', self._base_url]
+        return json.loads(subprocess.run(cmd, check=True, stdout=subprocess.PIPE, text=True).stdout)
+
+    def _measure(self, op: str, backend: str, w: Workload, source: str) -> dict:
+        runs = []
+        for _ in range(self._args.repeat):
+            path = source
+            if op in MUTATING_OPS:
+                copy_dir = os.path.join(self._workdir, f'{backend}-{op}')
+                shutil.rmtree(copy_dir, ignore_errors=True)
+                if op == 'save':
+                    os.makedirs(copy_dir)
+                else:
+                    shutil.copytree(os.path.dirname(source), copy_dir)
+                path = os.path.join(copy_dir, BACKENDS[backend])
+                if backend == 'split':
+                    os.makedirs(path, exist_ok=True)
+            runs.append(self._run(op, path, w))
+        seconds = min(run['seconds'] for run in runs)
+        result = {
+            'backend': backend,
+            'size': w.size,
+            'op': op,
+            'items': runs[0]['items'],
+            'seconds': seconds,
+            'median_seconds': statistics.median(run['seconds'] for run in runs),
+            'per_second': runs[0]['items'] / seconds if seconds else None,
+            'peak_rss_kb': max(run['peak_rss_kb'] for run in runs),
+            'setup_rss_kb': max(run['setup_rss_kb'] for run in runs),
+        }
+        logger.info('%s %d %s: %.3fs, %.0f/s, %d KB', backend, w.size, op, seconds, result['per_second'] or 0,
+                    result['peak_rss_kb'])
+        return result
+
+    def _backend(self, backend: str, w: Workload) -> list[dict]:
+        # every size and backend starts from its own saved storage
+        source_dir = os.path.join(self._workdir, f'{backend}-source')
+        shutil.rmtree(source_dir, ignore_errors=True)
+        os.makedirs(source_dir)
+        source = os.path.join(source_dir, BACKENDS[backend])
+        if backend == 'split':
+            os.makedirs(source)
+        self._run('save', source, w)
+        return [self._measure(op, backend, w, source) for op in self._args.ops if op in STORAGE_OPS]
+
+    def run(self) -> list[dict]:
+        results = []
+        base = Workload(**{field.name: getattr(self._args, field.name) for field in dataclasses.fields(Workload)
+                           if field.name != 'size'})
+        for size in self._args.sizes:
+            w = dataclasses.replace(base, size=size)
+            for backend in self._args.backends:
+                results.extend(self._backend(backend, w))
+        if 'fetch' in self._args.ops:
+            server = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'serve', '--icon-px',
+                                       str(self._args.icon_px), '--distinct-icons', str(base.distinct_icons)],
+                                      stdout=subprocess.PIPE, text=True)
+            try:
+                self._base_url = f'http://127.0.0.1:{server.stdout.readline().strip()}'
+                results.append(self._measure('fetch', '', dataclasses.replace(base, size=0), ''))
+            finally:
+                server.terminate()
+                server.wait()
+        return results
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def main():
+    def _list(choices=None, type_=str):
+        def _(value: str):
+            items = [type_(item) for item in value.split(',') if item]
+            if choices and (unknown := set(items) - set(choices)):
+                raise argparse.ArgumentTypeError(f'unknown: {", ".join(sorted(unknown))}')
+            return items
+        return _
+
+    defaults = Workload()
+    parser = argparse.ArgumentParser(add_help=True, allow_abbrev=False)
+    sub_parsers = parser.add_subparsers(dest='action')
+
+    worker_parser = sub_parsers.add_parser('worker', help='run one measurement, used by the benchmark itself')
+    worker_parser.add_argument('--op', required=True)
+    worker_parser.add_argument('--path', default='')
+    worker_parser.add_argument('--workload', required=True)
+    worker_parser.add_argument('--base-url', dest='base_url', default='')
+
+    serve_parser = sub_parsers.add_parser('serve', help='run the stand-in site of fetch, its port is printed first')
+    serve_parser.add_argument('--icon-px', dest='icon_px', type=int, default=64)
+    serve_parser.add_argument('--distinct-icons', dest='distinct_icons', type=int, default=defaults.distinct_icons)
+    serve_parser.add_argument('--seed', type=int, default=defaults.seed)
+
+    sub_parsers.add_parser('micro-render', help='time render alone on bookmarks in memory, '
+                                                'with the options given before it, e.g. --sizes 10000 micro-render')
+
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('-o', '--output', dest='output', default='-', help='json results, - for stdout')
+    parser.add_argument('--workdir', dest='workdir', default=None, help='where storages are written, a temp dir by default')
+    parser.add_argument('--sizes', type=_list(type_=int), default=[1000, 10000], help='bookmark counts, comma separated')
+    parser.add_argument('--backends', type=_list(BACKENDS), default=list(BACKENDS), help='comma separated')
+    parser.add_argument('--ops', type=_list(STORAGE_OPS + ('fetch', )), default=list(STORAGE_OPS + ('fetch', )),
+                        help='comma separated')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every measurement, the fastest is reported')
+    parser.add_argument('--tags', type=int, default=defaults.tags, help='distinct tags')
+    parser.add_argument('--tags-per-bookmark', dest='tags_per_bookmark', type=int, default=defaults.tags_per_bookmark)
+    parser.add_argument('--tag-skew', dest='tag_skew', type=float, default=defaults.tag_skew,
+                        help='tag k is picked with weight 1/(k+1)^skew, 0 for uniform')
+    parser.add_argument('--icon-size', dest='icon_size', type=int, default=defaults.icon_size,
+                        help='bytes of every stored icon before base64')
+    parser.add_argument('--icon-ratio', dest='icon_ratio', type=float, default=defaults.icon_ratio,
+                        help='share of bookmarks with an icon')
+    parser.add_argument('--distinct-icons', dest='distinct_icons', type=int, default=defaults.distinct_icons)
+    parser.add_argument('--icon-px', dest='icon_px', type=int, default=64, help='width and height of fetched icons')
+    parser.add_argument('--ops-count', dest='ops_count', type=int, default=defaults.ops_count,
+                        help='bookmarks touched by query, add, remove, update and fetch')
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    args = parser.parse_args()
+
+    if args.action == 'worker':
+        run_worker(args)
+        return
+    if args.action == 'serve':
+        run_server(args)
+        return
+
+    logger.setLevel(max(logging.WARNING - 10 * args.verbose, logging.DEBUG))
+    if args.action == 'micro-render':
+        results = run_micro_render(args)
+    else:
+        with tempfile.TemporaryDirectory(prefix='bench_bmmgr.') as tmp_dir:
+            workdir = args.workdir or tmp_dir
+            os.makedirs(workdir, exist_ok=True)
+            results = Bench(args, workdir).run()
+    report = {
+        'commit': get_commit(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'args': {key: value for key, value in vars(args).items() if key not in ('output', 'workdir', 'verbose', 'action')},
+        'results': results,
+    }
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,46 @@
 from __future__ import annotations
 
 import abc
+import contextlib
 import functools
+import itertools
+import operator
+import shutil
 import sqlite3
 import sys
+import tempfile
 import os.path
 import io
+import codecs
 import fcntl
 import argparse
 import typing
 import zipfile
+import zlib
+import gzip
 import urllib.parse
 import json
 import dataclasses
 import datetime
+import email.utils
 import base64
 import hashlib
 import logging
 import collections
+import concurrent.futures
+import multiprocessing
+import queue
 import re
+import random
+import time
 import lz4.block
 import aiohttp
 import asyncio
 import PIL.Image
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 logging.basicConfig()
@@ -31,19 +49,40 @@ logger = logging.getLogger('bookmarks')
 ICON_SIZE = 64, 64
 
 
-@dataclasses.dataclass
+def get_icon_hash(icon_data_uri: str) -> str:
+    """content address of an icon, the data uri carries both the mime type and the image bytes"""
+    return hashlib.sha1(icon_data_uri.encode()).hexdigest()
+
+
+def is_icon_ref(icon_data_uri: str) -> bool:
+    """storages keep a key of their icon store in place of the data uri"""
+    return bool(icon_data_uri) and not icon_data_uri.startswith('data:')
+
+
+def is_icon_hash(key: str) -> bool:
+    """whether a key of an icon store is a content hash, older stores keyed icons otherwise"""
+    return re.fullmatch(r'[0-9a-f]{40}', key) is not None
+
+
+@dataclasses.dataclass(slots=True)
 class Bookmark:
     title: str
     uri: str
     parent: str = ''
-    modified: datetime.datetime = dataclasses.field(default_factory=datetime.datetime.now)
+    # when the browser last modified it, None if the browser does not tell
+    modified: typing.Optional[datetime.datetime] = None
     created: datetime.datetime = dataclasses.field(default_factory=datetime.datetime.now)
     icon_uri: str = '/favicon.ico'
     tags: typing.Set[str] = dataclasses.field(default_factory=set)
-    icon_data_uri: str = ''
+    icon_data_uri: dataclasses.InitVar[str] = ''
     icon_updated: bool = dataclasses.field(init=False, default=False)
+    # icon_data_uri is a property (see below), storages may defer reading it to `_icon_loader`
+    _icon_data_uri: str = dataclasses.field(init=False, repr=False, default='')
+    _icon_loader: typing.Optional[typing.Callable[[], str]] = dataclasses.field(init=False, repr=False, compare=False, default=None)
+    _icon_hash: str = dataclasses.field(init=False, repr=False, compare=False, default='')
 
-    def __post_init__(self):
+    def __post_init__(self, icon_data_uri: str):
+        self._icon_data_uri = icon_data_uri
         self.validate()
         if not self.icon_uri:
             self.icon_uri = '/favicon.ico'
@@ -53,6 +92,58 @@ class Bookmark:
     def path(self):
         return f'{self.parent}.{self.title}'
 
+    @classmethod
+    def trusted(cls, title: str, uri: str, icon_uri: str, icon_data_uri: str, tags: typing.Iterable[str],
+                modified: typing.Optional[datetime.datetime] = None,
+                created: typing.Optional[datetime.datetime] = None) -> Bookmark:
+        """build a bookmark read back from a storage, it was validated and got an absolute icon_uri when it was
+        saved, so skip `__post_init__` and its urlparse. Tags are interned, they repeat a lot over bookmarks.
+        """
+        if not icon_uri.startswith(('http://', 'https://')):
+            return cls(title=title, uri=uri, icon_uri=icon_uri, icon_data_uri=icon_data_uri,
+                       tags={sys.intern(tag) for tag in tags}, modified=modified,
+                       created=created or datetime.datetime.now())
+        bookmark = cls.__new__(cls)
+        bookmark.title = title
+        bookmark.uri = uri
+        bookmark.parent = ''
+        bookmark.modified = modified
+        bookmark.created = created or datetime.datetime.now()
+        bookmark.icon_uri = icon_uri
+        bookmark.tags = {sys.intern(tag) for tag in tags}
+        bookmark.icon_updated = False
+        bookmark._icon_data_uri = icon_data_uri
+        bookmark._icon_loader = None
+        bookmark._icon_hash = ''
+        return bookmark
+
+    def _get_icon_data_uri(self) -> str:
+        if self._icon_loader is not None:
+            self._icon_data_uri = self._icon_loader()
+            self._icon_loader = None
+        return self._icon_data_uri
+
+    def _set_icon_data_uri(self, icon_data_uri: str):
+        self._icon_data_uri = icon_data_uri
+        self._icon_loader = None
+        self._icon_hash = ''
+
+    def set_lazy_icon(self, loader: typing.Callable[[], str], icon_hash: str = ''):
+        """read the icon by `loader` on the first access, `icon_hash` is its content hash if already known"""
+        self._icon_data_uri = ''
+        self._icon_loader = loader
+        self._icon_hash = icon_hash
+
+    @property
+    def has_icon_data(self) -> bool:
+        return self._icon_loader is not None or bool(self._icon_data_uri)
+
+    @property
+    def icon_hash(self) -> str:
+        if not self._icon_hash and self.icon_data_uri:
+            self._icon_hash = get_icon_hash(self.icon_data_uri)
+        return self._icon_hash
+
     def validate(self):
         uri_obj = urllib.parse.urlparse(self.uri)
         if not uri_obj.netloc:
@@ -75,21 +166,83 @@ class Bookmark:
     def to_sqlite_tuple(self):
         return self.title, self.uri, self.icon_uri, self.icon_data_uri, ";".join(self.tags)
 
-    def data_dict(self) -> typing.Dict:
+    def data_dict(self, with_icon=True) -> typing.Dict:
         return {
             "title": self.title,
             "uri": self.uri,
             "icon_uri": self.icon_uri,
-            "icon_data_uri": self.icon_data_uri,
-            "tags": list(sorted(self.tags))
+            "icon_data_uri": self.icon_data_uri if with_icon else '',
+            "tags": list(sorted(self.tags)),
+            "modified": self.modified.isoformat() if self.modified else None
         }
 
     @classmethod
-    def from_data_dict(cls, data_dict: typing.Dict) -> Bookmark:
+    def from_data_dict(cls, data_dict: typing.Dict, trusted=False) -> Bookmark:
+        """`trusted` is for dicts read back from a storage, see `trusted`"""
+        modified = data_dict.get("modified")
+        modified = datetime.datetime.fromisoformat(modified) if modified else None
+        if trusted:
+            return cls.trusted(data_dict["title"], data_dict["uri"], data_dict.get("icon_uri", ""),
+                               data_dict.get("icon_data_uri", ""), data_dict["tags"], modified)
         data_dict["tags"] = set(data_dict["tags"])
+        data_dict["modified"] = modified
         return Bookmark(**data_dict)
 
 
+Bookmark.icon_data_uri = property(Bookmark._get_icon_data_uri, Bookmark._set_icon_data_uri)
+
+
+class BookmarkTable:
+    """Bookmarks kept column by column for bulk work over a whole storage, like render and resave.
+
+    It holds no Bookmark objects, equal tag sets are shared, and lazy icons stay lazy. Bookmarks are built
+    by `Bookmark.trusted` on access, so changing them does not change the table.
+    """
+
+    def __init__(self, bookmarks: typing.Iterable[Bookmark] = ()):
+        self.titles: list[str] = []
+        self.uris: list[str] = []
+        self.icon_uris: list[str] = []
+        self.tags: list[frozenset[str]] = []
+        self.modified: list[typing.Optional[datetime.datetime]] = []
+        # the data uri, or (loader, hash) of a lazy icon
+        self.icons: list[typing.Union[str, tuple[typing.Callable[[], str], str]]] = []
+        self._tag_sets: dict[frozenset[str], frozenset[str]] = {}
+        self._created = datetime.datetime.now()
+        self.extend(bookmarks)
+
+    def append(self, bookmark: Bookmark):
+        self.titles.append(bookmark.title)
+        self.uris.append(bookmark.uri)
+        self.icon_uris.append(bookmark.icon_uri)
+        tags = frozenset(map(sys.intern, bookmark.tags))
+        self.tags.append(self._tag_sets.setdefault(tags, tags))
+        self.modified.append(bookmark.modified)
+        if bookmark._icon_loader is not None:
+            self.icons.append((bookmark._icon_loader, bookmark._icon_hash))
+        else:
+            self.icons.append(bookmark._icon_data_uri)
+
+    def extend(self, bookmarks: typing.Iterable[Bookmark]):
+        for bookmark in bookmarks:
+            self.append(bookmark)
+
+    def __len__(self) -> int:
+        return len(self.uris)
+
+    def __getitem__(self, idx: int) -> Bookmark:
+        icon = self.icons[idx]
+        bookmark = Bookmark.trusted(self.titles[idx], self.uris[idx], self.icon_uris[idx],
+                                    icon if isinstance(icon, str) else '', self.tags[idx], self.modified[idx],
+                                    self._created)
+        if not isinstance(icon, str):
+            bookmark.set_lazy_icon(*icon)
+        return bookmark
+
+    def __iter__(self) -> typing.Iterator[Bookmark]:
+        return map(self.__getitem__, range(len(self)))
+
+
 @dataclasses.dataclass
 class Folder:
     title: str
@@ -187,25 +340,916 @@ def load_chrome(filepath, skip_empty=False):
     )
 
 
-async def bookmark_icon_uri2data(session: aiohttp.ClientSession, b: Bookmark, icon_cache_dir: typing.Optional[str], force=False):
+class JsonTreeScanner:
+    """Incremental scanner of a bookmark tree in json, nodes are objects holding their children in `children_key`.
+
+    `events` yields ("enter", None) when the children of a node begin, ("leave", attrs) when that node ends,
+    and ("node", attrs) for a node without children. attrs are the other members of the node, which
+    may come after the children (chrome sorts keys). A node ending within the buffer is decoded at
+    once, bigger ones are scanned member by member. So the memory is proportional to the depth of
+    the tree and the size of a chunk, not to the size of the file.
+    """
+    CHUNK = 1 << 20
+
+    def __init__(self, fp: typing.TextIO, children_key='children'):
+        self._fp = fp
+        self._children_key = children_key
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        chunk = self._fp.read(self.CHUNK)
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        if not chunk:
+            self._eof = True
+
+    def _peek(self) -> str:
+        self._pos = json.decoder.WHITESPACE.match(self._buf, self._pos).end()
+        while self._pos >= len(self._buf):
+            if self._eof:
+                raise ValueError(f'unexpected end of {self._fp.name}')
+            self._fill()
+            self._pos = json.decoder.WHITESPACE.match(self._buf, self._pos).end()
+        return self._buf[self._pos]
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError(f'expect {char!r} but got {self._buf[self._pos:self._pos + 32]!r}')
+        self._pos += 1
+
+    def _key(self) -> str:
+        if self._peek() != '"':
+            raise ValueError(f'expect a key but got {self._buf[self._pos:self._pos + 32]!r}')
+        key = self._value()
+        self._expect(':')
+        return key
+
+    def _value(self) -> typing.Any:
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+                self._fill()
+                continue
+            # a number or a literal may continue in the next chunk
+            if end >= len(self._buf) and not self._eof:
+                self._fill()
+                continue
+            self._pos = end
+            return value
+
+    def _next_member(self, close: str) -> bool:
+        """skip the separator, return False once `close` ends the container"""
+        if self._peek() == ',':
+            self._pos += 1
+        elif self._buf[self._pos] == close:
+            self._pos += 1
+            return False
+        return True
+
+    def _object(self) -> typing.Optional[dict]:
+        """decode the object at the current position at once if it ends within the buffer"""
+        if self._peek() != '{':
+            raise ValueError(f'expect a node but got {self._buf[self._pos:self._pos + 32]!r}')
+        try:
+            value, self._pos = self._decoder.raw_decode(self._buf, self._pos)
+        except (json.JSONDecodeError, RecursionError):
+            # too deep to decode at once is scanned as well
+            return None
+        return value
+
+    def _walk(self, node: dict) -> typing.Iterator[tuple[str, typing.Optional[dict]]]:
+        """events of a decoded node"""
+        children = node.pop(self._children_key, None)
+        if children is None:
+            yield 'node', node
+            return
+        yield 'enter', None
+        nodes = [(node, iter(children))]
+        while nodes:
+            attrs, it = nodes[-1]
+            child = next(it, None)
+            if child is None:
+                nodes.pop()
+                yield 'leave', attrs
+                continue
+            children = child.pop(self._children_key, None)
+            if children is None:
+                yield 'node', child
+            else:
+                yield 'enter', None
+                nodes.append((child, iter(children)))
+
+    def _node(self) -> typing.Iterator[tuple[str, typing.Optional[dict]]]:
+        """events of the node at the current position, the nodes not fitting in the buffer are scanned key by key"""
+        nodes: list[list] = []  # [attrs, has children] of the open nodes
+        state = 'node'
+        while True:
+            if state == 'node':
+                value = self._object()
+                if value is None:
+                    self._expect('{')
+                    nodes.append([{}, False])
+                    state = 'object'
+                    continue
+                yield from self._walk(value)
+                if not nodes:
+                    return
+                state = 'children'
+            elif state == 'object':
+                node = nodes[-1]
+                if not self._next_member('}'):
+                    nodes.pop()
+                    yield ('leave' if node[1] else 'node'), node[0]
+                    if not nodes:
+                        return
+                    state = 'children'
+                    continue
+                key = self._key()
+                if key != self._children_key:
+                    node[0][key] = self._value()
+                    continue
+                self._expect('[')
+                node[1] = True
+                yield 'enter', None
+                state = 'children'
+            else:
+                # inside the children of the innermost open node
+                state = 'node' if self._next_member(']') else 'object'
+
+    def events(self, roots_key='', roots_attrs: typing.Optional[dict] = None) -> typing.Iterator[tuple[str, typing.Optional[dict]]]:
+        """with `roots_key`, the nodes are the values of that member of the top object, as children of `roots_attrs`"""
+        if not roots_key:
+            yield from self._node()
+            return
+        self._expect('{')
+        while self._next_member('}'):
+            if self._key() != roots_key:
+                self._value()
+                continue
+            self._expect('{')
+            yield 'enter', None
+            while self._next_member('}'):
+                self._key()
+                yield from self._node()
+            yield 'leave', roots_attrs or {}
+
+
+def iter_tree_bookmarks(open_events: typing.Callable[[], typing.Iterator[tuple[str, typing.Optional[dict]]]],
+                        folder_type, bookmark_type, name_key: str, uri_key: str,
+                        created_key='', modified_key='', icon_key='', type_key='type',
+                        skip_func: typing.Callable[[dict], bool] = lambda _: True,
+                        paths: list[str] = None) -> typing.Iterator[Bookmark]:
+    """streaming counterpart of `general_builder` followed by `convert2list_with_tags`.
+
+    `open_events` is called once per pass over the tree: the first collects the folders (attributes
+    may follow the children), the second counts tags to drop those every bookmark has, it is
+    skipped without `paths` since the counts of the first pass are enough. The last one yields.
+    """
+    titles: list[str] = []
+    parents: list[int] = []
+    skipped: list[bool] = []
+    counts: list[int] = []
+    stack: list[int] = []
+    for event, attrs in open_events():
+        if event == 'enter':
+            parents.append(stack[-1] if stack else -1)
+            stack.append(len(titles))
+            titles.append('')
+            skipped.append(False)
+            counts.append(0)
+        elif event == 'leave':
+            i = stack.pop()
+            assert attrs[type_key] == folder_type, f"Unsupported node with children: {attrs}"
+            titles[i] = attrs[name_key]
+            skipped[i] = skip_func(attrs)
+            if stack and not skipped[i]:
+                counts[stack[-1]] += counts[i]
+        elif skip_func(attrs):
+            continue
+        elif attrs[type_key] == bookmark_type:
+            if stack:
+                counts[stack[-1]] += 1
+        elif attrs[type_key] != folder_type:
+            assert False, f"Unknown bookmark type: {attrs[type_key]}"
+
+    folder_paths: list[str] = []
+    live: list[bool] = []
+    for i, (title, parent) in enumerate(zip(titles, parents)):
+        live.append(not skipped[i] and (parent < 0 or live[parent]))
+        folder_paths.append(f'{folder_paths[parent]}.{title}' if parent >= 0 and folder_paths[parent] else title)
+
+    tags: dict[str, int] = collections.defaultdict(lambda: 0)
+    total = 0
+
+    def _walk() -> typing.Iterator[tuple[list[int], dict]]:
+        """live bookmarks passing `paths` with the indices of their folders"""
+        index = 0
+        folders: list[int] = []
+        for event, attrs in open_events():
+            if event == 'enter':
+                folders.append(index)
+                index += 1
+            elif event == 'leave':
+                folders.pop()
+            elif attrs[type_key] != bookmark_type or not folders or not live[folders[-1]]:
+                continue
+            elif skip_func(attrs):
+                logger.warning('skip %s', attrs)
+            elif not paths or any(f'{folder_paths[folders[-1]]}.{attrs[name_key]}'.startswith(path) for path in paths):
+                yield folders, attrs
+
+    if paths:
+        for folders, _ in _walk():
+            total += 1
+            for i in folders:
+                if titles[i]:
+                    tags[titles[i]] += 1
+    else:
+        for i, title in enumerate(titles):
+            if live[i] and title:
+                tags[title] += counts[i]
+        total = sum(counts[i] for i, parent in enumerate(parents) if parent < 0 and live[i])
+    to_removes = {tag for tag, count in tags.items() if count == total}
+
+    for folders, attrs in _walk():
+        optional_fields = {}
+        if modified_key:
+            optional_fields['modified'] = t(attrs[modified_key])
+        if created_key:
+            optional_fields['created'] = t(attrs[created_key])
+        if icon_key:
+            optional_fields['icon_uri'] = attrs.get(icon_key)
+        bookmark = Bookmark(attrs[name_key], attrs[uri_key], folder_paths[folders[-1]], **optional_fields)
+        bookmark.tags = {titles[i] for i in folders if titles[i]} - to_removes
+        yield bookmark
+
+
+def stream_firefox(filepath, paths: list[str] = None) -> typing.Iterator[Bookmark]:
+    with open(filepath, 'rb') as f:
+        assert f.read(8) == b'mozLz40\x00'
+        # lz4 blocks can not be decompressed incrementally, the json text is scanned in place
+        data = lz4.block.decompress(f.read())
+
+    def _events():
+        return JsonTreeScanner(io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')).events()
+
+    return iter_tree_bookmarks(
+        _events,
+        folder_type='text/x-moz-place-container',
+        bookmark_type='text/x-moz-place',
+        name_key='title',
+        uri_key='uri',
+        created_key='dateAdded',
+        modified_key='lastModified',
+        icon_key='iconuri',
+        skip_func=lambda x: x.get('iconuri', '').startswith('fake-favicon-uri:'),
+        paths=paths
+    )
+
+
+def stream_chrome(filepath, paths: list[str] = None) -> typing.Iterator[Bookmark]:
+    def _events():
+        with open(filepath, 'r', encoding='utf-8') as f:
+            yield from JsonTreeScanner(f).events('roots', {'name': 'root', 'type': 'folder'})
+
+    return iter_tree_bookmarks(
+        _events,
+        folder_type='folder',
+        bookmark_type='url',
+        name_key='name',
+        uri_key='url',
+        skip_func=lambda x: x.get('url', '').startswith('chrome://'),
+        paths=paths
+    )
+
+
+@contextlib.contextmanager
+def open_snapshot(path: str) -> typing.Iterator[sqlite3.Connection]:
+    """read only connection to a database of a browser, a copy of it is read while the running browser locks it"""
+    conn = sqlite3.connect(f'file:{urllib.parse.quote(os.path.abspath(path))}?mode=ro', uri=True)
+    try:
+        conn.execute("SELECT count(*) FROM sqlite_master").fetchone()
+    except sqlite3.OperationalError as e:
+        conn.close()
+        logger.info('cannot read %s (%s), read a copy of it', path, e)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            copy_path = os.path.join(tmp_dir, os.path.basename(path))
+            for suffix in ('', '-wal'):
+                if os.path.exists(path + suffix):
+                    shutil.copyfile(path + suffix, copy_path + suffix)
+            conn = sqlite3.connect(copy_path)
+            try:
+                yield conn
+            finally:
+                conn.close()
+        return
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def load_firefox_places(filepath, skip_empty=False):
+    """read places.sqlite of a profile directly, instead of the last backup"""
+    with open_snapshot(filepath) as conn:
+        rows = conn.execute(
+            "SELECT b.id, b.parent, b.type, b.title, b.dateAdded, b.lastModified, p.url"
+            " FROM moz_bookmarks b LEFT JOIN moz_places p ON p.id = b.fk"
+            " WHERE b.type != 3 ORDER BY b.parent, b.position").fetchall()
+    # the same shape as the json backup
+    nodes = {}
+    root = None
+    for row_id, parent, row_type, title, date_added, last_modified, url in rows:
+        node = {'title': title or '', 'dateAdded': date_added, 'lastModified': last_modified}
+        if row_type == 2:
+            node.update(type='text/x-moz-place-container', children=[])
+        else:
+            node.update(type='text/x-moz-place', uri=url)
+        nodes[row_id] = node, parent
+        if parent == 0:
+            root = node
+    assert root is not None, f"no root in {filepath}"
+    for node, parent in nodes.values():
+        if parent in nodes:
+            nodes[parent][0]['children'].append(node)
+    return general_builder(
+        root,
+        folder_type='text/x-moz-place-container',
+        bookmark_type='text/x-moz-place',
+        name_key='title',
+        uri_key='uri',
+        created_key='dateAdded',
+        modified_key='lastModified',
+        skip_empty=skip_empty,
+        # the url of a bookmark is NULL if its place is missing
+        skip_func=lambda x: 'uri' in x and not (x['uri'] or '').startswith(('http://', 'https://'))
+    )
+
+
+def sniff_image_type(data: bytes) -> str:
+    """browsers keep icons without their types"""
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data.startswith(b'\x00\x00\x01\x00'):
+        return 'image/x-icon'
+    if data.startswith((b'GIF87a', b'GIF89a')):
+        return 'image/gif'
+    if data.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if b'<svg' in data[:1024]:
+        return 'image/svg+xml'
+    return ''
+
+
+def find_profile_file(input_path: str, name: str) -> str:
+    """`name` beside the input, or in its parent for a backup in bookmarkbackups"""
+    dir_path = os.path.dirname(os.path.abspath(input_path))
+    for path in (os.path.join(dir_path, name), os.path.join(os.path.dirname(dir_path), name)):
+        if os.path.exists(path):
+            return path
+    return ''
+
+
+def fill_browser_icons(favicons_path: str, icons_sql: str, bookmarks: list[Bookmark], with_roots=False) -> int:
+    """fill icon data of bookmarks from a favicon database of the browser, return how many are filled.
+
+    `icons_sql` selects (page url, icon url, width, data) of the pages in `temp.pages`,
+    with `with_roots` icons of pages without one fall back to the root /favicon.ico of their origin.
+    """
+    pages = {b.uri for b in bookmarks if not b.has_icon_data}
+    if not favicons_path or not pages:
+        return 0
+    candidates = collections.defaultdict(list)
+    with open_snapshot(favicons_path) as conn:
+        conn.execute("CREATE TEMP TABLE pages(url TEXT PRIMARY KEY)")
+        conn.executemany("INSERT OR IGNORE INTO temp.pages VALUES (?)", ((url,) for url in pages))
+        for page_url, icon_url, width, data in conn.execute(icons_sql):
+            candidates[page_url].append((width, icon_url, data))
+        if with_roots:
+            origins = collections.defaultdict(list)
+            for url in pages - candidates.keys():
+                res = urllib.parse.urlparse(url)
+                origins[f'{res.scheme}://{res.netloc}/favicon.ico'].append(url)
+            conn.execute("CREATE TEMP TABLE origins(url TEXT PRIMARY KEY)")
+            conn.executemany("INSERT INTO temp.origins VALUES (?)", ((url,) for url in origins))
+            for icon_url, width, data in conn.execute(
+                    "SELECT icon_url, width, data FROM moz_icons WHERE root = 1 AND icon_url IN temp.origins"):
+                for page_url in origins[icon_url]:
+                    candidates[page_url].append((width, icon_url, data))
+
+    data_uris = {}
+    filled = 0
+    for b in bookmarks:
+        if b.has_icon_data or b.uri not in candidates:
+            continue
+        # the smallest not smaller than ICON_SIZE, otherwise the biggest
+        width, icon_url, data = min(candidates[b.uri], key=lambda c: (c[0] < ICON_SIZE[0], abs(c[0] - ICON_SIZE[0])))
+        img_type = sniff_image_type(data)
+        if not img_type:
+            logger.warning('unknown icon type of %s in %s', icon_url, favicons_path)
+            continue
+        if data not in data_uris:
+            try:
+                data_uris[data] = icon2data_uri(img_type, data)
+            except Exception as e:
+                logger.warning('cannot convert icon %s of %s: %s', icon_url, b.uri, e)
+                data_uris[data] = ''
+        if data_uris[data]:
+            b.icon_uri = icon_url
+            b.icon_data_uri = data_uris[data]
+            filled += 1
+    logger.info('%d of %d bookmarks got icons from %s', filled, len(bookmarks), favicons_path)
+    return filled
+
+
+def fill_firefox_icons(input_path: str, bookmarks: list[Bookmark]) -> int:
+    return fill_browser_icons(
+        find_profile_file(input_path, 'favicons.sqlite'),
+        "SELECT p.url, i.icon_url, i.width, i.data FROM temp.pages p"
+        " JOIN moz_pages_w_icons pw ON pw.page_url = p.url"
+        " JOIN moz_icons_to_pages ip ON ip.page_id = pw.id"
+        " JOIN moz_icons i ON i.id = ip.icon_id",
+        bookmarks, with_roots=True)
+
+
+def fill_chrome_icons(input_path: str, bookmarks: list[Bookmark]) -> int:
+    return fill_browser_icons(
+        find_profile_file(input_path, 'Favicons'),
+        "SELECT p.url, f.url, b.width, b.image_data FROM temp.pages p"
+        " JOIN icon_mapping m ON m.page_url = p.url"
+        " JOIN favicons f ON f.id = m.icon_id"
+        " JOIN favicon_bitmaps b ON b.icon_id = f.id",
+        bookmarks)
+
+
+@dataclasses.dataclass
+class FetchOptions:
+    concurrency: int = 32
+    per_host: int = 4
+    rate: float = 5.0
+    burst: int = 10
+    retries: int = 3
+    backoff: float = 0.5
+    max_backoff: float = 30.0
+    http_cache: typing.Optional[str] = None
+    # responses written to the http cache in one transaction
+    http_cache_commit_every: int = 100
+    negative_cache: typing.Optional[str] = None
+    ignore_negative_cache: bool = False
+    image_executor: str = 'process'
+    image_workers: typing.Optional[int] = None
+
+
+class RetryLater(Exception):
+    def __init__(self, url: str, status: int, delay: float = 0):
+        super().__init__(f'{url} responds {status}, retry after {delay}s')
+        self.delay = delay
+
+
+class NegativelyCached(Exception):
+    def __init__(self, key: str, failure: str, next_attempt: float):
+        super().__init__(f'{key} failed with {failure}, skipped until {datetime.datetime.fromtimestamp(next_attempt)}')
+
+
+class NegativeCache:
+    """Failures persisted in sqlite, a failed host or uri is not tried again before its backoff passed.
+
+    Connection level failures are keyed by host, http errors by uri.
+    """
+
+    BACKOFF = 6 * 3600
+    MAX_BACKOFF = 30 * 24 * 3600
+
+    def __init__(self, conn: sqlite3.Connection):
+        self._conn = conn
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS failures("
+            "key TEXT PRIMARY KEY, failure TEXT, attempts INTEGER, last_failed REAL, next_attempt REAL)")
+
+    @staticmethod
+    def host_key(url: str) -> str:
+        return f'host:{urllib.parse.urlparse(url).netloc}'
+
+    @staticmethod
+    def uri_key(url: str) -> str:
+        return f'uri:{url}'
+
+    def check(self, url: str):
+        now = time.time()
+        for key in (self.host_key(url), self.uri_key(url)):
+            row = self._conn.execute("SELECT failure, next_attempt FROM failures WHERE key=?", (key,)).fetchone()
+            if row is not None and row[1] > now:
+                raise NegativelyCached(key, row[0], row[1])
+
+    def record(self, key: str, failure: str):
+        now = time.time()
+        row = self._conn.execute("SELECT attempts, next_attempt FROM failures WHERE key=?", (key,)).fetchone()
+        if row and row[1] > now:
+            # already recorded by a concurrent request of this run
+            return
+        attempts = row[0] + 1 if row else 1
+        next_attempt = now + min(self.MAX_BACKOFF, self.BACKOFF * 2 ** (attempts - 1))
+        self._conn.execute("INSERT OR REPLACE INTO failures VALUES (?,?,?,?,?)",
+                           (key, failure, attempts, now, next_attempt))
+        self._conn.commit()
+        logger.info('%s failed %d times with %s, next attempt after %s',
+                    key, attempts, failure, datetime.datetime.fromtimestamp(next_attempt))
+
+    def clear(self, url: str):
+        cur = self._conn.execute("DELETE FROM failures WHERE key IN (?,?)", (self.host_key(url), self.uri_key(url)))
+        if cur.rowcount:
+            self._conn.commit()
+
+
+@dataclasses.dataclass
+class FetchResult:
+    url: str
+    real_url: str
+    status: int
+    content_type: str
+    charset: typing.Optional[str]
+    body: bytes
+    from_cache: bool = False
+    # the body stops at the end of the html head, see Fetcher.fetch
+    truncated: bool = False
+
+
+@dataclasses.dataclass
+class PageProbe:
+    """what get_bookmark_title and bookmark_icon_uri2data want from a page, parsed from its head"""
+    url: str
+    real_url: str
+    status: int
+    title: typing.Optional[str] = None
+    icon_href: typing.Optional[str] = None
+
+    _HEAD_END = re.compile(rb'</head|<body', re.IGNORECASE)
+    _META_CHARSET = re.compile(rb'<meta\s[^>]*charset=[\'"]?([\w.:-]+)', re.IGNORECASE)
+    _TITLE = re.compile(r'<title[^>]*>([^<]*)</title>', re.IGNORECASE)
+    _ICON_LINK = re.compile(r'<link\s+[^>]*rel=(?P<quote>[\'"]?)[^\'">]*icon[^\'"]*(?P=quote)[^>]*>', re.IGNORECASE)
+    _HREF = re.compile(r'href=(?P<quote>[\'"]?)(?P<url>[^\'"]*?)(?P=quote)(\s|/?>)')
+
+    @classmethod
+    def parse(cls, result: FetchResult) -> PageProbe:
+        probe = cls(result.url, result.real_url, result.status)
+        if result.status != 200:
+            return probe
+        data = result.body
+        if m := cls._HEAD_END.search(data):
+            data = data[:m.start()]
+        charset = result.charset
+        if not charset and (m := cls._META_CHARSET.search(data)):
+            charset = m.group(1).decode('ascii')
+        try:
+            codecs.lookup(charset or 'utf-8')
+        except LookupError:
+            logger.warning('unknown charset %s of %s', charset, result.url)
+            charset = None
+        try:
+            html = data.decode(charset or 'utf-8')
+        except UnicodeDecodeError as e:
+            logger.warning('catch decode error, try use errors="replace"', exc_info=e)
+            html = data.decode(charset or 'utf-8', errors='replace')
+        if m := cls._TITLE.search(html):
+            logger.debug('%s title matched: %s', result.url, m.group(0))
+            probe.title = m.group(1)
+        if ml := cls._ICON_LINK.search(html):
+            logger.debug('link matched: %s', ml.group(0))
+            if m := cls._HREF.search(ml.group(0)):
+                logger.debug('href matched: %s', m.group(0))
+                probe.icon_href = m.group('url')
+            else:
+                logger.warning('cannot get icon url from icon link tag from %s', result.url)
+        return probe
+
+
+@dataclasses.dataclass
+class CacheEntry:
+    result: FetchResult
+    etag: str
+    last_modified: str
+    expires: float
+
+    def validators(self) -> dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class HttpCache:
+    """Responses persisted in sqlite with their validators and freshness, stale ones are revalidated.
+
+    A partial response, read up to the end of the html head by a page probe, is only used for probes.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, commit_every=100):
+        self._conn = conn
+        self._commit_every = commit_every
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses("
+            "url TEXT PRIMARY KEY, real_url TEXT, status INTEGER, content_type TEXT, charset TEXT,"
+            " etag TEXT, last_modified TEXT, expires REAL, body BLOB, partial INTEGER DEFAULT 0)")
+        if 'partial' not in {row[1] for row in self._conn.execute("PRAGMA table_info(responses)")}:
+            self._conn.execute("ALTER TABLE responses ADD COLUMN partial INTEGER DEFAULT 0")
+        self._pending = 0
+
+    @staticmethod
+    def expires(headers: typing.Mapping[str, str]) -> typing.Optional[float]:
+        """until when a response is fresh, None if it must not be stored"""
+        cache_control = headers.get('Cache-Control', '').lower()
+        if 'no-store' in cache_control:
+            return None
+        now = time.time()
+        if 'no-cache' in cache_control:
+            return now
+        if m := re.search(r'max-age=(\d+)', cache_control):
+            return now + int(m.group(1))
+        if expires := headers.get('Expires'):
+            try:
+                return email.utils.parsedate_to_datetime(expires).timestamp()
+            except (TypeError, ValueError):
+                return now
+        return now
+
+    def get(self, url: str, partial=False) -> typing.Optional[CacheEntry]:
+        """with `partial`, a partial response is returned too"""
+        row = self._conn.execute(
+            "SELECT real_url, status, content_type, charset, etag, last_modified, expires, body, partial"
+            " FROM responses WHERE url=?", (url,)).fetchone()
+        if row is None or (row[8] and not partial):
+            return None
+        real_url, status, content_type, charset, etag, last_modified, expires, body, truncated = row
+        return CacheEntry(
+            FetchResult(url, real_url, status, content_type, charset, body, from_cache=True, truncated=bool(truncated)),
+            etag, last_modified, expires)
+
+    def put(self, result: FetchResult, etag: str, last_modified: str, expires: float):
+        self._conn.execute("INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?,?,?,?,?,?)", (
+            result.url, result.real_url, result.status, result.content_type, result.charset,
+            etag, last_modified, expires, result.body, result.truncated))
+        self._written()
+
+    def refresh(self, url: str, expires: float):
+        self._conn.execute("UPDATE responses SET expires=? WHERE url=?", (expires, url))
+        self._written()
+
+    def _written(self):
+        self._pending += 1
+        if self._pending >= self._commit_every:
+            self._conn.commit()
+            self._pending = 0
+
+    def close(self):
+        self._conn.commit()
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self._rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+class Fetcher:
+    """Schedule requests of a session: bounded globally and per host, rate limited per host, retried with backoff"""
+
+    # a page probe gives up on a head that is not closed within this many bytes
+    HEAD_MAX_BYTES = 256 * 1024
+    # the first image jobs are run in process, the pool starts only for more of them
+    INLINE_IMAGE_JOBS = 4
+
+    def __init__(self, session: aiohttp.ClientSession, options: FetchOptions):
+        self.session = session
+        self.options = options
+        # caches sharing a file share the connection, or they would lock each other out
+        self._conns: dict[str, sqlite3.Connection] = {}
+        self._cache = (HttpCache(self._connect(options.http_cache), options.http_cache_commit_every)
+                       if options.http_cache else None)
+        negative_cache = options.negative_cache or options.http_cache
+        self._negative = NegativeCache(self._connect(negative_cache)) if negative_cache else None
+        self._slots = asyncio.Semaphore(options.concurrency)
+        self._hosts: dict[str, tuple[asyncio.Semaphore, TokenBucket]] = {}
+        self._executor: typing.Optional[concurrent.futures.Executor] = None
+        # one request per page for both its title and its icon link
+        self._probes: dict[str, asyncio.Future] = {}
+        # cumulative seconds awaited by the fetch coroutines
+        self.stats = collections.Counter()
+
+    def _host(self, url: str) -> tuple[asyncio.Semaphore, TokenBucket]:
+        host = urllib.parse.urlparse(url).netloc
+        if host not in self._hosts:
+            self._hosts[host] = asyncio.Semaphore(self.options.per_host), TokenBucket(self.options.rate, self.options.burst)
+        return self._hosts[host]
+
+    def _connect(self, path: str) -> sqlite3.Connection:
+        if path not in self._conns:
+            self._conns[path] = sqlite3.connect(path, timeout=30)
+        return self._conns[path]
+
+    def close(self):
+        if self._cache:
+            self._cache.close()
+        for conn in self._conns.values():
+            conn.close()
+        if self._executor is not None:
+            self._executor.shutdown()
+        logger.info('network: %.3fs for %d requests of %d bytes, image pool: %.3fs for %d icons',
+                    self.stats['network_time'], self.stats['network'], self.stats['network_bytes'],
+                    self.stats['pool_time'], self.stats['pool'])
+
+    async def run_in_pool(self, func, *args):
+        """run a CPU bound job in the image pool, started on demand: a few icons, as of `add`,
+        are cheaper to decode here than to pay the start of worker processes and the pickling
+        """
+        start = time.perf_counter()
+        try:
+            if self._executor is None:
+                if self.stats['pool'] < self.INLINE_IMAGE_JOBS:
+                    return func(*args)
+                executor_class = {
+                    'process': concurrent.futures.ProcessPoolExecutor,
+                    'thread': concurrent.futures.ThreadPoolExecutor,
+                }[self.options.image_executor]
+                self._executor = executor_class(max_workers=self.options.image_workers)
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.stats['pool'] += 1
+            self.stats['pool_time'] += time.perf_counter() - start
+
+    @contextlib.asynccontextmanager
+    async def get(self, url: str, headers: typing.Optional[dict[str, str]] = None) -> typing.AsyncIterator[aiohttp.ClientResponse]:
+        host_slots, bucket = self._host(url)
+        # wait for the host first, a global slot is only taken to send, or a busy host would hold them all
+        async with host_slots:
+            await bucket.acquire()
+            async with self._slots:
+                # network time is of the request and what the caller reads of the body, not of waiting for the limits
+                start = time.perf_counter()
+                try:
+                    async with self.session.get(url, headers=headers) as resp:
+                        if resp.status in (429, 503):
+                            retry_after = resp.headers.get('Retry-After', '')
+                            raise RetryLater(url, resp.status, float(retry_after) if retry_after.isdigit() else 0)
+                        yield resp
+                finally:
+                    self.stats['network'] += 1
+                    self.stats['network_time'] += time.perf_counter() - start
+
+    async def fetch(self, url: str, head_only=False) -> FetchResult:
+        """GET the whole body, answered from the http cache while fresh and revalidated with its validators after
+
+        with head_only, reading stops once the html head is closed or after HEAD_MAX_BYTES.
+        Such a truncated body is cached as a partial response, which only answers and is revalidated for head_only.
+        """
+        entry = self._cache.get(url, partial=head_only) if self._cache else None
+        if entry and entry.expires > time.time():
+            logger.debug('http cache fresh: %s', url)
+            return entry.result
+        if self._negative and not self.options.ignore_negative_cache:
+            self._negative.check(url)
+        return await self._fetch(url, entry, head_only)
+
+    async def _fetch(self, url: str, entry: typing.Optional[CacheEntry], head_only: bool) -> FetchResult:
+        # only the body is read within `get`, the caches are written after it
+        async with self.get(url, entry.validators() if entry else None) as resp:
+            headers = resp.headers
+            revalidated = resp.status == 304 and entry is not None
+            if not revalidated:
+                body, truncated = await self._read_head(resp) if head_only else (await resp.read(), False)
+                self.stats['network_bytes'] += len(body)
+                result = FetchResult(
+                    url=str(resp.real_url.__class__(url)),
+                    real_url=str(resp.real_url),
+                    status=resp.status,
+                    content_type=headers.get('Content-Type', ''),
+                    charset=resp.charset,
+                    body=body,
+                    truncated=truncated
+                )
+        if revalidated:
+            logger.debug('http cache revalidated: %s', url)
+            self._cache.refresh(url, self._cache.expires(headers) or time.time())
+            return entry.result
+        if self._cache and result.status == 200 and (expires := self._cache.expires(headers)) is not None:
+            self._cache.put(result, headers.get('ETag', ''), headers.get('Last-Modified', ''), expires)
+        if self._negative:
+            if result.status < 400:
+                self._negative.clear(url)
+            else:
+                self._negative.record(self._negative.uri_key(url), f'http {result.status}')
+        return result
+
+    async def _read_head(self, resp: aiohttp.ClientResponse) -> tuple[bytes, bool]:
+        """read until the html head is closed, the rest of the page is left on the wire"""
+        buf = bytearray()
+        async for chunk in resp.content.iter_chunked(16384):
+            # the end tag may straddle two chunks
+            start = max(0, len(buf) - 6)
+            buf += chunk
+            if PageProbe._HEAD_END.search(buf, start) or len(buf) >= self.HEAD_MAX_BYTES:
+                return bytes(buf[:self.HEAD_MAX_BYTES]), True
+        return bytes(buf), False
+
+    async def probe(self, url: str) -> PageProbe:
+        """title and icon link of a page, concurrent and later probes of the same url share one request"""
+        future = self._probes.get(url)
+        if future is None:
+            future = self._probes[url] = asyncio.ensure_future(self._probe(url))
+        try:
+            # a cancelled waiter must not cancel the request the others wait for
+            return await asyncio.shield(future)
+        except Exception:
+            # failures are not memoized, so retry gets a new request
+            if self._probes.get(url) is future:
+                del self._probes[url]
+            raise
+
+    async def _probe(self, url: str) -> PageProbe:
+        return PageProbe.parse(await self.fetch(url, head_only=True))
+
+    async def retry(self, func, url, retry_count=None):
+        retry_count = self.options.retries if retry_count is None else retry_count
+        attempt = 0
+        while retry_count > 0:
+            try:
+                return True, await func()
+            except NegativelyCached as e:
+                logger.info('skip %s: %s', url, e)
+                break
+            except (aiohttp.ClientOSError, aiohttp.ServerTimeoutError, asyncio.exceptions.TimeoutError, RetryLater) as e:
+                retry_count -= 1
+                logger.warning('while %s catch exception: %s, remain retry: %d', url, e, retry_count)
+                if retry_count <= 0:
+                    if self._negative:
+                        self._negative.record(self._negative.host_key(url), e.__class__.__name__)
+                    break
+                # exponential backoff with full jitter
+                delay = random.uniform(0, min(self.options.max_backoff, self.options.backoff * 2 ** attempt))
+                if isinstance(e, RetryLater):
+                    delay = max(delay, min(e.delay, self.options.max_backoff))
+                attempt += 1
+                await asyncio.sleep(delay)
+        return False, None
+
+
+def resize_img(img_type: str, data: bytes) -> tuple[str, bytes]:
+    if img_type == 'image/svg+xml':
+        return img_type, data
+    ff = io.BytesIO(data)
+    img = PIL.Image.open(ff)
+    if img.width <= ICON_SIZE[0] and img.height <= ICON_SIZE[1]:
+        logger.debug("no need to resize")
+        return img_type, data
+    logger.debug("need to resize")
+    new_img = img.resize(ICON_SIZE)
+    ffo = io.BytesIO()
+    new_img.save(ffo, "PNG")
+    ffo.seek(0)
+    new_data = ffo.read()
+    logger.debug(f"compress: {len(data)} -> {len(new_data)}, {(len(data) - len(new_data)) / len(data) :.3f}")
+    return "image/png", new_data
+
+
+def icon2data_uri(img_type: str, data: bytes) -> str:
+    """decode, resize and encode an icon, CPU bound so it runs in the image pool of the fetcher"""
+    img_type, data = resize_img(img_type, data)
+    return f'data:{img_type};base64,{base64.b64encode(data).decode()}'
+
+
+async def bookmark_icon_uri2data(fetcher: Fetcher, b: Bookmark, icon_cache_dir: typing.Optional[str], force=False,
+                                 missing_only=False):
     b.icon_updated = False
     if b.icon_uri.startswith('data:image/'):
         return
-
-    def resize_img(img_type: str, data: bytes) -> tuple[str, bytes]:
-        ff = io.BytesIO(data)
-        img = PIL.Image.open(ff)
-        if img.width <= ICON_SIZE[0] and img.height <= ICON_SIZE[1]:
-            logger.debug("no need to resize")
-            return img_type, data
-        logger.debug("need to resize")
-        new_img = img.resize(ICON_SIZE)
-        ffo = io.BytesIO()
-        new_img.save(ffo, "PNG")
-        ffo.seek(0)
-        new_data = ffo.read()
-        logger.debug(f"compress: {len(data)} -> {len(new_data)}, {(len(data) - len(new_data)) / len(data) :.3f}")
-        return "image/png", new_data
+    if missing_only and b.has_icon_data:
+        return
 
     async def _get():
         cache_path = ''
@@ -217,106 +1261,84 @@ async def bookmark_icon_uri2data(session: aiohttp.ClientSession, b: Bookmark, ic
                     b.icon_data_uri = f.read()
                 return
         logger.debug('aio get: %s', b.icon_uri)
-        async with session.get(b.icon_uri) as resp:
-            data = await resp.read()
-            if resp.status != 200:
-                logger.warning('aio get status: %d, %s', resp.status, b.icon_uri)
-                return
-            img_type = resp.headers.get('Content-Type')
-            if not img_type.startswith("image"):
-                logger.warning('aio get unknown type: %s, %s', img_type, b.icon_uri)
-                return
-            if not data:
-                logger.warning('aio get finished: %s, but there is no data', b.icon_uri)
-                return
-            img_type, data = resize_img(img_type, data)
-            data = base64.b64encode(data).decode()
-            logger.debug('aio get done: %s', b.icon_uri)
-            new_icon_data_uri = f'data:{img_type};base64,{data}'
-            b.icon_updated = b.icon_data_uri != new_icon_data_uri
-            b.icon_data_uri = new_icon_data_uri
-            if cache_path:
-                with open(cache_path, 'w+') as f:
-                    f.write(b.icon_data_uri)
+        resp = await fetcher.fetch(b.icon_uri)
+        data = resp.body
+        if resp.status != 200:
+            logger.warning('aio get status: %d, %s', resp.status, b.icon_uri)
+            return
+        img_type = resp.content_type
+        if not img_type.startswith("image"):
+            logger.warning('aio get unknown type: %s, %s', img_type, b.icon_uri)
+            return
+        if not data:
+            logger.warning('aio get finished: %s, but there is no data', b.icon_uri)
+            return
+        new_icon_data_uri = await fetcher.run_in_pool(icon2data_uri, img_type, data)
+        logger.debug('aio get done: %s', b.icon_uri)
+        b.icon_updated = b.icon_data_uri != new_icon_data_uri
+        b.icon_data_uri = new_icon_data_uri
+        if cache_path:
+            with open(cache_path, 'w+') as f:
+                f.write(b.icon_data_uri)
         return True
 
     async def _get_icon_url():
         logger.warning('try get icons from page for %s', b.title)
-        async with session.get(b.uri) as resp:
-            data = await resp.read()
-            if resp.status != 200:
-                logger.warning('cannot fetch data from %s, got http code: %d', b.uri, resp.status)
-                return
-            html = data.decode(resp.charset if resp.charset else "utf-8")
-            if ml := re.search(r'<link\s+[^>]*rel=(?P<quote>[\'"]?)[^\'">]*icon[^\'"]*(?P=quote)[^>]*>', html):
-                logger.debug('link matched: %s', ml.group(0))
-                if m := re.search(r'href=(?P<quote>[\'"]?)(?P<url>[^\'"]*?)(?P=quote)(\s|>)', ml.group(0)):
-                    logger.debug('href matched: %s', m.group(0))
-                    old_uri = b.icon_uri
-                    b.icon_uri = m.group('url')
-                    b.update_icon_uri()
-                    return b.icon_uri != old_uri
-                else:
-                    logger.warning('cannot get icon url from icon link tag from %s', b.uri)
-            else:
-                logger.warning('cannot get icon link tag from %s', b.uri)
-
-    async def _retry(func, err_msg, retry_count):
-        while retry_count > 0:
-            try:
-                return True, await func()
-            except (aiohttp.ClientOSError, aiohttp.ServerTimeoutError, asyncio.exceptions.TimeoutError) as e:
-                retry_count -= 1
-                logger.warning('while %s catch exception: %s, remain retry: %d', err_msg, e, retry_count)
-        return False, None
+        probe = await fetcher.probe(b.uri)
+        if probe.status != 200:
+            logger.warning('cannot fetch data from %s, got http code: %d', b.uri, probe.status)
+            return
+        if probe.icon_href is None:
+            logger.warning('cannot get icon link tag from %s', b.uri)
+            return
+        old_uri = b.icon_uri
+        b.icon_uri = probe.icon_href
+        b.update_icon_uri()
+        return b.icon_uri != old_uri
 
     try:
-        if all(await _retry(_get, b.icon_uri, 3)):
+        if all(await fetcher.retry(_get, b.icon_uri)):
             return
-        if not all(await _retry(_get_icon_url, b.uri, 3)):
+        if not all(await fetcher.retry(_get_icon_url, b.uri)):
             logger.warning('failed to retrieve icon from page for %s(%s)', b.title, b.uri)
             return
-        await _retry(_get, b.icon_uri, 3)
+        await fetcher.retry(_get, b.icon_uri)
     except Exception as e:
         logger.error('while fetch %s catch exception: %s', b.icon_uri, e)
         return
 
 
-async def get_bookmark_title(session: aiohttp.ClientSession, bookmark: Bookmark):
+async def get_bookmark_title(fetcher: Fetcher, bookmark: Bookmark):
     if bookmark.title:
         return
     logger.warning('try get title from page for %s', bookmark.uri)
 
     async def _get():
-        async with session.get(bookmark.uri) as resp:
-            data = await resp.read()
-            if resp.real_url != resp.real_url.__class__(bookmark.uri):
-                logger.error('redirection found %s -> %s', bookmark.uri, resp.real_url)
-            if resp.status != 200:
-                logger.warning('cannot fetch data from %s, got http code: %d', bookmark.uri, resp.status)
-                return
-            try:
-                html = data.decode(resp.charset if resp.charset else "utf-8")
-            except UnicodeDecodeError as e:
-                logger.warning('catch decode error, try use errors="replace"', exc_info=e)
-                html = data.decode(resp.charset if resp.charset else "utf-8", errors="replace")
-            if ml := re.search(r'<title>([^<]*)</title>', html, re.IGNORECASE|re.MULTILINE):
-                logger.debug('%s title matched: %s', bookmark.uri, ml.group(0))
-                bookmark.title = ml.group(1)
-            else:
-                logger.warning('cannot get title from %s', bookmark.uri)
-    try:
-        await _get()
-    except (aiohttp.ClientOSError, aiohttp.ServerTimeoutError, asyncio.exceptions.TimeoutError) as e:
-        logger.warning('while fetch %s catch exception: %s', bookmark.uri, e)
+        probe = await fetcher.probe(bookmark.uri)
+        if probe.real_url != probe.url:
+            logger.error('redirection found %s -> %s', bookmark.uri, probe.real_url)
+        if probe.status != 200:
+            logger.warning('cannot fetch data from %s, got http code: %d', bookmark.uri, probe.status)
+            return
+        if probe.title is not None:
+            bookmark.title = probe.title
+        else:
+            logger.warning('cannot get title from %s', bookmark.uri)
+    await fetcher.retry(_get, bookmark.uri)
 
 
 def get_svg_uri(b: Bookmark):
+    return _get_svg_uri(b.icon_uri)
+
+
+@functools.lru_cache(maxsize=4096)
+def _get_svg_uri(icon_uri: str) -> str:
+    # icon_uri is /favicon.ico of the host for most bookmarks, so few placeholders are built for many bookmarks
     xml_lines = [
         ('<?xml version="1.0" standalone="no"?>'
          '<svg width="32" height="32" xmlns="http://www.w3.org/2000/svg" version="1.1">')
     ]
-    values = hashlib.md5(b.icon_uri.encode()).digest() * 2
+    values = hashlib.md5(icon_uri.encode()).digest() * 2
     for x in range(4):
         for y in range(4):
             color = values[x*4+y:][:3].hex()
@@ -326,43 +1348,170 @@ def get_svg_uri(b: Bookmark):
     return f'data:image/svg+xml;base64,{data}'
 
 
-def get_all_info(folder, paths: list[str] = None, icon_cache_dir=None, get_title=False, force=False):
+def get_all_info(folder, paths: list[str] = None, icon_cache_dir=None, get_title=False, force=False,
+                 fetch_options: typing.Optional[FetchOptions] = None, missing_only=False,
+                 on_done: typing.Optional[typing.Callable[[Bookmark], None]] = None):
+    """`on_done` is called with every bookmark as soon as all its info is got"""
+    fetch_options = fetch_options or FetchOptions()
 
     _funcs = [
-        functools.partial(bookmark_icon_uri2data, icon_cache_dir=icon_cache_dir, force=force)
+        functools.partial(bookmark_icon_uri2data, icon_cache_dir=icon_cache_dir, force=force, missing_only=missing_only)
     ]
     if get_title:
         _funcs.append(get_bookmark_title)
 
-    def _rec(s: aiohttp.ClientSession, t: list, x: Folder | Bookmark | list[Bookmark], funcs: list[typing.Callable[[aiohttp.ClientSession, Bookmark], typing.Coroutine]]):
+    def _rec(x: Folder | Bookmark | list[Bookmark]) -> typing.Iterator[Bookmark]:
         if isinstance(x, list):
             for b in x:
-                _rec(s, t, b, funcs)
+                yield from _rec(b)
         elif isinstance(x, Folder):
             for child in x.children:
-                _rec(s, t, child, funcs)
+                yield from _rec(child)
         elif paths and not any(x.path.startswith(path) for path in paths):
             pass
         else:
-            t.extend(asyncio.ensure_future(func(s, x)) for func in funcs)
+            yield x
+
+    async def _get_info(fetcher: Fetcher, b: Bookmark):
+        await asyncio.gather(*(func(fetcher, b) for func in _funcs))
+        if on_done:
+            on_done(b)
+
+    async def _schedule(fetcher: Fetcher):
+        # tasks are created as slots free up, instead of all at once
+        max_pending = fetch_options.concurrency * 4
+        pending = set()
+        for b in _rec(folder):
+            if len(pending) >= max_pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+            pending.add(asyncio.ensure_future(_get_info(fetcher, b)))
+        await asyncio.gather(*pending)
 
     async def _do():
         timeout = aiohttp.ClientTimeout(60, 10, 25)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            tasks = []
-            _rec(session, tasks, folder, _funcs)
-            await asyncio.gather(*tasks)
+        connector = aiohttp.TCPConnector(limit=fetch_options.concurrency, limit_per_host=fetch_options.per_host)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            fetcher = Fetcher(session, fetch_options)
+            try:
+                await _schedule(fetcher)
+            finally:
+                fetcher.close()
 
     asyncio.run(_do())
 
 
+def _update_icons_shard(shard: int, items: list[tuple[str, str, str, str]], results: multiprocessing.Queue,
+                        icon_cache_dir: typing.Optional[str], fetch_options: FetchOptions):
+    """worker of update_icons_sharded, `items` are (title, uri, icon_uri, icon hash) of its bookmarks.
+
+    Results go back in chunks of (uri, icon_uri, icon_data_uri), icon_data_uri is None if the icon did not change.
+    """
+    old_hashes = {uri: icon_hash for _, uri, _, icon_hash in items}
+    chunk = []
+
+    def _done(b: Bookmark):
+        changed = b.has_icon_data and b.icon_hash != old_hashes[b.uri]
+        chunk.append((b.uri, b.icon_uri, b.icon_data_uri if changed else None))
+        if len(chunk) >= 64:
+            results.put((shard, chunk.copy()))
+            chunk.clear()
+
+    bookmarks = [Bookmark.trusted(title, uri, icon_uri, '', ()) for title, uri, icon_uri, _ in items]
+    get_all_info(bookmarks, icon_cache_dir=icon_cache_dir, force=True, fetch_options=fetch_options, on_done=_done)
+    results.put((shard, chunk))
+    results.put((shard, None))
+
+
+def update_icons_sharded(storage: IStorage, workers: int, icon_cache_dir: typing.Optional[str] = None,
+                         fetch_options: typing.Optional[FetchOptions] = None, commit_every=200):
+    """refresh every icon in `workers` processes, each fetching the bookmarks of a hash slice of the hosts
+    on its own event loop. Changed icons are written here, `commit_every` at once, so an interrupted run keeps
+    what was written.
+
+    Slicing by host keeps the per host limits and failures of a host within one worker. Concurrency is split
+    over the workers, and they decode icons in threads, being processes already.
+    """
+    fetch_options = fetch_options or FetchOptions()
+    # the http cache may be shared by the workers, none may hold its write lock over many requests
+    fetch_options = dataclasses.replace(fetch_options, concurrency=-(-fetch_options.concurrency // workers),
+                                        image_executor='thread', http_cache_commit_every=1)
+    bookmarks = {b.uri: b for b in storage.iter_load(with_icon=False)}
+    shards = [[] for _ in range(workers)]
+    for b in bookmarks.values():
+        host = urllib.parse.urlsplit(b.uri).netloc
+        shards[zlib.crc32(host.encode()) % workers].append((b.title, b.uri, b.icon_uri, b.icon_hash))
+    results = multiprocessing.Queue()
+    running: dict[int, multiprocessing.Process] = {}
+    for shard, items in enumerate(shards):
+        if items:
+            running[shard] = multiprocessing.Process(
+                target=_update_icons_shard, args=(shard, items, results, icon_cache_dir, fetch_options),
+                name=f'update-icon-{shard}')
+            running[shard].start()
+    pending = []
+    done = updated = 0
+    started = time.time()
+
+    def _commit():
+        nonlocal updated
+        if pending:
+            storage.update(pending, fields=["icon_data_uri", "icon_uri"])
+            updated += len(pending)
+            pending.clear()
+        logger.info('%d/%d bookmarks done, %d icons updated, %.0f/s',
+                    done, len(bookmarks), updated, done / max(time.time() - started, 1e-3))
+
+    try:
+        while running:
+            try:
+                shard, chunk = results.get(timeout=1)
+            except queue.Empty:
+                # a worker exiting normally queued its end before, so only a failed one is missed here
+                for shard, process in running.items():
+                    if process.exitcode:
+                        raise RuntimeError(f'{process.name} exited with {process.exitcode}')
+                continue
+            if chunk is None:
+                running.pop(shard).join()
+                continue
+            for uri, icon_uri, icon_data_uri in chunk:
+                done += 1
+                if icon_data_uri is None:
+                    continue
+                b = bookmarks[uri]
+                b.icon_uri = icon_uri
+                b.icon_data_uri = icon_data_uri
+                b.icon_updated = True
+                pending.append(b)
+            if len(pending) >= commit_every:
+                _commit()
+    finally:
+        for process in running.values():
+            process.terminate()
+        _commit()
+
+
+_ATTR_URL_ESCAPES = str.maketrans({
+    '"': '%22',
+    '>': '%3E'
+})
+_ELEMENT_ESCAPES = str.maketrans({
+    '<': '&lt;',
+    '>': '&gt;',
+    '&': '&amp;',
+    '"': '&quot;',
+    "'": '&#x27;'
+})
+_ELEMENT_SPECIALS = re.compile('[<>&"\']')
+
+
 def escape_attr_url(value):
-    mapping = {
-        '"': '%22',
-        '>': '%3E'
-    }
-    for o, r in mapping.items():
-        value = value.replace(o, r)
+    if '"' in value or '>' in value:
+        value = value.translate(_ATTR_URL_ESCAPES)
+    if value.startswith(('https://', 'http://', 'ftp://')):
+        return value
     res = urllib.parse.urlparse(value)
     validate_schemes = {
         'https',
@@ -375,16 +1524,10 @@ def escape_attr_url(value):
 
 
 def escape_element(value):
-    mapping = {
-        '<': '&lt;',
-        '>': '&gt;',
-        '&': '&amp;',
-        '"': '&quot;',
-        "'": '&#x27;'
-    }
-    for o, r in mapping.items():
-        value = value.replace(o, r)
-    return value
+    # one pass, and most titles and tags have nothing to escape at all
+    if _ELEMENT_SPECIALS.search(value) is None:
+        return value
+    return value.translate(_ELEMENT_ESCAPES)
 
 
 def convert2list_with_tags(folder: Folder, paths: list[str]) -> typing.Tuple[list[Bookmark], dict[str, int]]:
@@ -420,55 +1563,35 @@ def convert2list_with_tags(folder: Folder, paths: list[str]) -> typing.Tuple[lis
     return bookmarks, tags
 
 
-def render(bookmarks: list[Bookmark]) -> str:
-    categorical_tags = collections.defaultdict(lambda: collections.defaultdict(lambda: 0))
-    for b in bookmarks:
-        for tag in b.tags:
-            if ":" in tag:
-                category, _ = tag.split(":", maxsplit=1)
-            else:
-                category = ''
-            categorical_tags[category][tag] += 1
+class SyncDiff:
+    """Changes of browser bookmarks against a storage by uri, the browser bookmarks may come batch by batch.
 
-    def _(b):
-        icon = b.icon_data_uri if b.icon_data_uri else get_svg_uri(b)
-        icon_html = f'<img src="{icon}" width="{ICON_SIZE[0]}" height="{ICON_SIZE[1]}" />'
+    A bookmark is modified if its title or tags differ, or the browser tells a different `modified`.
+    """
 
-        tags_html = ''.join(f'<div class="tag" data-name="{escape_element(tag)}">{escape_element(tag)}</div>' for tag in sorted(b.tags))
+    def __init__(self, stored: typing.Iterable[Bookmark]):
+        self._stored = {b.uri: (b.title, frozenset(b.tags) - {''}, b.modified) for b in stored}
+        self._seen: set[str] = set()
 
-        return (
-            '<div class="bookmark">'
-            f'<div class="icon">{icon_html}</div>'
-            f'<div class="tags">{tags_html}</div>'
-            f'<p><a href="{escape_attr_url(b.uri)}" referrerpolicy="no-referrer" target="_blank">{escape_element(b.title)}</a></p>'
-            '</div>'
-        )
-
-    tag_htmls = []
-    for category, tags in sorted(categorical_tags.items(), key=lambda x: x[0]):
-        if category:
-            tag_htmls.append(f'<details class=""><summary>{category}</summary>')
-        tag_htmls.append('<div class="tags">')
-        tag_htmls.append(''.join(
-            f'<div class="tag" data-name="{escape_element(n)}" data-category="{category}"><span>{escape_element(n)}</span><span>{c}</span></div>'
-            for n, c in sorted(tags.items(), key=lambda x: -x[1])
-        ))
-        tag_htmls.append('</div>')
-        if category:
-            tag_htmls.append('</details>')
+    def diff(self, bookmarks: list[Bookmark]) -> tuple[list[Bookmark], list[Bookmark]]:
+        """return the added and the modified ones"""
+        added, modified = [], []
+        for b in bookmarks:
+            self._seen.add(b.uri)
+            if b.uri not in self._stored:
+                added.append(b)
+                continue
+            title, tags, stored_modified = self._stored[b.uri]
+            if (title, tags) != (b.title, frozenset(b.tags)) or (b.modified is not None and b.modified != stored_modified):
+                modified.append(b)
+        return added, modified
 
+    def removed(self) -> list[str]:
+        """uris not seen in any batch"""
+        return [uri for uri in self._stored if uri not in self._seen]
 
-    context = {
-        'tags': ''.join(tag_htmls),
-        'bookmarks': ''.join(_(b) for b in bookmarks)
-    }
 
-    return re.sub(r'\{%\s*(\w+)\s*%}', lambda m: context[m.group(1)], '''<html lang="zh-CN">
-    <head>
-        <meta charset="UTF-8" />
-        <title>Bookmarks</title>
-        <style>
-            .tags {
+RENDER_STYLE = '''            .tags {
                 display: flex;
                 flex-wrap: wrap;
                 justify-content: center;
@@ -483,6 +1606,10 @@ def render(bookmarks: list[Bookmark]) -> str:
             .tag.active {
                 background: #ffa3d2;
             }
+            .nav .mode {
+                text-align: center;
+                margin-bottom: 1vh;
+            }
             .tag > span + span::before {
                 content: "(";
             }
@@ -519,6 +1646,8 @@ def render(bookmarks: list[Bookmark]) -> str:
             }
             .bookmark > .icon {
                 width: 64px;
+                height: 64px;
+                background-size: 64px 64px;
                 grid-area: a;
             }
             .bookmark .tags {
@@ -536,64 +1665,531 @@ def render(bookmarks: list[Bookmark]) -> str:
                 text-decoration: none;
                 color: rgb(76, 0, 152);
             }
-        </style>
+'''
+
+RENDER_TEMPLATE = '''<html lang="zh-CN">
+    <head>
+        <meta charset="UTF-8" />
+        <title>Bookmarks</title>
+        <style>
+{% style %}        </style>
     </head>
     <body>
         <div class="nav">
+        <div class="mode">
+            <label><input type="radio" name="tag-mode" value="or" checked />any selected tag</label>
+            <label><input type="radio" name="tag-mode" value="and" />all selected tags</label>
+        </div>
         {% tags %}
         </div>
         <div class="bookmarks">
         {% bookmarks %}
         </div>
+    <script type="application/json" id="tag-index">{% tag_index %}</script>
     <script>
-        var tag_clicked = false;
-        function clickTag(e) {
-            if (tag_clicked) {
-                return;
+        (function () {
+            // tag -> indices of its bookmarks in document order, delta encoded by render
+            const tagIndex = new Map();
+            for (const [tag, deltas] of Object.entries(JSON.parse(document.getElementById('tag-index').textContent))) {
+                const indices = new Uint32Array(deltas.length);
+                let last = 0;
+                deltas.forEach((delta, i) => { last += delta; indices[i] = last; });
+                tagIndex.set(tag, indices);
             }
-            tag_clicked = true;
-            let ele = e.target;
-            while (!ele.dataset.hasOwnProperty('name')) {
-                ele = ele.parentElement;
+            const empty = new Uint32Array(0);
+            const bookmarks = document.querySelectorAll('.bookmarks > .bookmark');
+            const navTags = new Map();
+            for (const e of document.querySelectorAll('.nav .tag')) {
+                if (!navTags.has(e.dataset.name)) {
+                    navTags.set(e.dataset.name, []);
+                }
+                navTags.get(e.dataset.name).push(e);
             }
-            let tag = ele.dataset.name;
-            let activate = !ele.classList.contains('active');
-            for (let other_tag_e of document.querySelectorAll('.nav .tag')) {
-                other_tag_e.classList.remove('active');
-                if (activate && other_tag_e.dataset.name == tag) {
-                    other_tag_e.classList.add('active');
-                    if (other_tag_e.dataset.hasOwnProperty('category')) {
-                        other_tag_e.parentElement.parentElement.open = true;
+            const activeTags = new Set();
+            const hidden = new Uint8Array(bookmarks.length);
+            let highlighted = [];
+
+            function apply() {
+                const all = document.querySelector('.nav input[name="tag-mode"]:checked').value === 'and';
+                const need = all ? activeTags.size : 1;
+                const counts = new Uint16Array(bookmarks.length);
+                for (const tag of activeTags) {
+                    for (const i of tagIndex.get(tag) || empty) {
+                        counts[i]++;
+                    }
+                }
+                // only bookmarks whose visibility changes are touched
+                for (let i = 0; i < bookmarks.length; i++) {
+                    const hide = activeTags.size > 0 && counts[i] < need ? 1 : 0;
+                    if (hide !== hidden[i]) {
+                        bookmarks[i].classList.toggle('inactive', hide === 1);
+                        hidden[i] = hide;
+                    }
+                }
+                for (const e of highlighted) {
+                    e.classList.remove('active');
+                }
+                highlighted = [];
+                for (const tag of activeTags) {
+                    const selector = `.tag[data-name="${CSS.escape(tag)}"]`;
+                    for (const i of tagIndex.get(tag) || empty) {
+                        const e = hidden[i] ? null : bookmarks[i].querySelector(selector);
+                        if (e) {
+                            e.classList.add('active');
+                            highlighted.push(e);
+                        }
                     }
                 }
             }
-            if (activate) {
-                ele.classList.add('active');
-            }
-            for (let bookmark of document.querySelectorAll('.bookmark')) {
-                let active_bookmark_tag = bookmark.querySelector(`[data-name="${tag}"]`);
-                for (let bookmark_tag of bookmark.querySelectorAll('.tag')) {
-                    bookmark_tag.classList.remove('active');
+
+            document.addEventListener('click', function (e) {
+                const ele = e.target.closest('.tag');
+                if (!ele) {
+                    return;
                 }
-                if (!activate) {
-                    bookmark.classList.remove('inactive');
-                } else if (active_bookmark_tag) {
-                    active_bookmark_tag.classList.add('active');
-                    bookmark.classList.remove('inactive');
+                const tag = ele.dataset.name;
+                const activate = !activeTags.has(tag);
+                if (activate) {
+                    activeTags.add(tag);
                 } else {
-                    bookmark.classList.add('inactive');
+                    activeTags.delete(tag);
                 }
+                for (const nav_tag_e of navTags.get(tag) || []) {
+                    nav_tag_e.classList.toggle('active', activate);
+                    if (activate && nav_tag_e.dataset.hasOwnProperty('category')) {
+                        nav_tag_e.parentElement.parentElement.open = true;
+                    }
+                }
+                apply();
+            });
+            for (const e of document.querySelectorAll('.nav input[name="tag-mode"]')) {
+                e.addEventListener('change', apply);
+            }
+        })();
+    </script>
+    </body>
+</html>'''
+
+
+PAGED_TEMPLATE = '''<html lang="zh-CN">
+    <head>
+        <meta charset="UTF-8" />
+        <title>Bookmarks</title>
+        <style>
+{% style %}            .bookmarks.paged {
+                display: block;
+                position: relative;
             }
-            tag_clicked = false;
-        };
+            .bookmarks.paged > .bookmark {
+                position: absolute;
+                box-sizing: border-box;
+                height: 96px;
+                overflow: hidden;
+            }
+        </style>
+    </head>
+    <body>
+        <div class="nav">
+        <div class="mode">
+            <label><input type="radio" name="tag-mode" value="or" checked />any selected tag</label>
+            <label><input type="radio" name="tag-mode" value="and" />all selected tags</label>
+        </div>
+        {% tags %}
+        </div>
+        <div class="bookmarks paged"></div>
+    <script type="application/json" id="meta">{% meta %}</script>
+    <script>
         (function () {
-            for (let e of document.querySelectorAll('.tag')) {
-                e.addEventListener('click', clickTag);
+            // bookmarks are [title, uri, icon file, tags] in shards of meta.shard_size, only the rows in view are in the DOM
+            const meta = JSON.parse(document.getElementById('meta').textContent);
+            const ROW_HEIGHT = 104, MIN_WIDTH = 400, OVERSCAN = 4, MAX_SHARDS = 16;
+            const grid = document.querySelector('.bookmarks');
+            const shards = new Map();
+            const loading = new Set();
+            const activeTags = new Set();
+            let tagIndex = null;
+            // indices of the shown bookmarks, null for all of them
+            let order = null;
+            let scheduled = false;
+
+            function esc(value) {
+                return String(value).replace(/[&<>"']/g, c => `&#${c.charCodeAt(0)};`);
+            }
+
+            function loadShard(n) {
+                if (loading.has(n)) {
+                    return;
+                }
+                loading.add(n);
+                fetch(`${meta.data}/${meta.shards[n]}`).then(r => r.json()).then(bookmarks => {
+                    shards.set(n, bookmarks);
+                    schedule();
+                }).finally(() => loading.delete(n));
+            }
+
+            function card(bookmark, row, col, cols) {
+                const [title, uri, icon, tags] = bookmark;
+                const tags_html = tags.map(
+                    tag => `<div class="tag${activeTags.has(tag) ? ' active' : ''}" data-name="${esc(tag)}">${esc(tag)}</div>`
+                ).join('');
+                return `<div class="bookmark" style="top:${row * ROW_HEIGHT}px;left:${col * 100 / cols}%;width:calc(${100 / cols}% - 1vw)">`
+                    + `<div class="icon" style="background-image:url('${meta.data}/icons/${icon}')"></div>`
+                    + `<div class="tags">${tags_html}</div>`
+                    + `<p><a href="${esc(uri)}" referrerpolicy="no-referrer" target="_blank">${esc(title)}</a></p></div>`;
+            }
+
+            function update() {
+                scheduled = false;
+                const total = order ? order.length : meta.count;
+                const cols = Math.max(1, Math.floor(grid.clientWidth / MIN_WIDTH));
+                const rows = Math.ceil(total / cols);
+                grid.style.height = `${rows * ROW_HEIGHT}px`;
+                const offset = -grid.getBoundingClientRect().top;
+                const first = Math.max(0, Math.floor(offset / ROW_HEIGHT) - OVERSCAN);
+                const last = Math.min(rows, Math.ceil((offset + window.innerHeight) / ROW_HEIGHT) + OVERSCAN);
+                const html = [];
+                const needed = new Set();
+                for (let pos = first * cols; pos < Math.min(total, last * cols); pos++) {
+                    const idx = order ? order[pos] : pos;
+                    const n = Math.floor(idx / meta.shard_size);
+                    needed.add(n);
+                    if (shards.has(n)) {
+                        html.push(card(shards.get(n)[idx % meta.shard_size], Math.floor(pos / cols), pos % cols, cols));
+                    } else {
+                        loadShard(n);
+                    }
+                }
+                grid.innerHTML = html.join('');
+                // memory stays bounded: drop the shards out of view first loaded
+                for (const n of shards.keys()) {
+                    if (shards.size <= MAX_SHARDS) {
+                        break;
+                    }
+                    if (!needed.has(n)) {
+                        shards.delete(n);
+                    }
+                }
+            }
+
+            function schedule() {
+                if (!scheduled) {
+                    scheduled = true;
+                    requestAnimationFrame(update);
+                }
+            }
+
+            async function filter() {
+                if (activeTags.size === 0) {
+                    order = null;
+                    schedule();
+                    return;
+                }
+                if (tagIndex === null) {
+                    // tag -> indices of its bookmarks, delta encoded, fetched on the first click
+                    const deltas = await (await fetch(`${meta.data}/${meta.tags}`)).json();
+                    tagIndex = new Map();
+                    for (const [tag, tag_deltas] of Object.entries(deltas)) {
+                        const indices = new Uint32Array(tag_deltas.length);
+                        let last = 0;
+                        tag_deltas.forEach((delta, i) => { last += delta; indices[i] = last; });
+                        tagIndex.set(tag, indices);
+                    }
+                }
+                const all = document.querySelector('.nav input[name="tag-mode"]:checked').value === 'and';
+                const need = all ? activeTags.size : 1;
+                const counts = new Uint16Array(meta.count);
+                for (const tag of activeTags) {
+                    for (const i of tagIndex.get(tag) || []) {
+                        counts[i]++;
+                    }
+                }
+                const shown = [];
+                counts.forEach((count, i) => { if (count >= need) { shown.push(i); } });
+                order = Uint32Array.from(shown);
+                schedule();
             }
+
+            document.addEventListener('click', function (e) {
+                const ele = e.target.closest('.tag');
+                if (!ele) {
+                    return;
+                }
+                const tag = ele.dataset.name;
+                const activate = !activeTags.has(tag);
+                if (activate) {
+                    activeTags.add(tag);
+                } else {
+                    activeTags.delete(tag);
+                }
+                for (const nav_tag_e of document.querySelectorAll('.nav .tag')) {
+                    if (nav_tag_e.dataset.name === tag) {
+                        nav_tag_e.classList.toggle('active', activate);
+                        if (activate && nav_tag_e.dataset.hasOwnProperty('category')) {
+                            nav_tag_e.parentElement.parentElement.open = true;
+                        }
+                    }
+                }
+                filter();
+            });
+            for (const e of document.querySelectorAll('.nav input[name="tag-mode"]')) {
+                e.addEventListener('change', filter);
+            }
+            window.addEventListener('scroll', schedule, {passive: true});
+            window.addEventListener('resize', schedule);
+            schedule();
         })();
     </script>
     </body>
-</html>''')
+</html>'''
+
+ICON_EXTENSIONS = {
+    'image/png': 'png',
+    'image/x-icon': 'ico',
+    'image/vnd.microsoft.icon': 'ico',
+    'image/svg+xml': 'svg',
+    'image/jpeg': 'jpg',
+    'image/gif': 'gif',
+    'image/webp': 'webp',
+}
+
+class TagIndex:
+    """Tag counts by category for the nav, and tag -> indices of its bookmarks for the page script"""
+
+    def __init__(self):
+        self.categorical_tags = collections.defaultdict(lambda: collections.defaultdict(lambda: 0))
+        # tag -> (last index, deltas of the indices of its bookmarks)
+        self._index: dict[str, list] = {}
+
+    def add(self, idx: int, b: Bookmark):
+        for tag in sorted(b.tags):
+            if tag in self._index:
+                entry = self._index[tag]
+                entry[1].append(idx - entry[0])
+                entry[0] = idx
+            else:
+                self._index[tag] = [idx, [idx]]
+            if ":" in tag:
+                category, _ = tag.split(":", maxsplit=1)
+            else:
+                category = ''
+            self.categorical_tags[category][tag] += 1
+
+    def nav_htmls(self) -> list[str]:
+        tag_htmls = []
+        for category, tags in sorted(self.categorical_tags.items(), key=lambda x: x[0]):
+            if category:
+                tag_htmls.append(f'<details class=""><summary>{category}</summary>')
+            tag_htmls.append('<div class="tags">')
+            tag_htmls.append(''.join(
+                f'<div class="tag" data-name="{escape_element(n)}" data-category="{category}"><span>{escape_element(n)}</span><span>{c}</span></div>'
+                for n, c in sorted(tags.items(), key=lambda x: -x[1])
+            ))
+            tag_htmls.append('</div>')
+            if category:
+                tag_htmls.append('</details>')
+        return tag_htmls
+
+    def json(self) -> str:
+        # "</" would end the script element
+        return json.dumps({tag: deltas for tag, (_, deltas) in self._index.items()},
+                          ensure_ascii=False, separators=(',', ':')).replace('</', '<\\/')
+
+
+def iter_template(template: str, context: dict[str, typing.Callable[[], typing.Iterable[str]]]) -> typing.Iterator[str]:
+    for idx, part in enumerate(re.split(r'\{%\s*(\w+)\s*%}', template)):
+        if idx % 2:
+            yield from context[part]()
+        else:
+            yield part
+
+
+class CardRenderer:
+    """html of bookmark cards for the static page, every distinct tag and placeholder icon is handled once"""
+
+    def __init__(self):
+        self._tag_htmls: dict[str, str] = {}
+        # placeholder svg uri -> its icon class
+        self._placeholder_classes: dict[str, str] = {}
+        self._emitted_classes: set[str] = set()
+
+    def _tag_html(self, tag: str) -> str:
+        html = self._tag_htmls.get(tag)
+        if html is None:
+            name = escape_element(tag)
+            html = self._tag_htmls[tag] = f'<div class="tag" data-name="{name}">{name}</div>'
+        return html
+
+    def _icon_html(self, b: Bookmark) -> str:
+        # every distinct icon is emitted once as a css class, the first card using it carries the rule
+        if b.has_icon_data:
+            icon = ''
+            icon_class = f'i-{b.icon_hash[:16]}'
+        else:
+            icon = get_svg_uri(b)
+            icon_class = self._placeholder_classes.get(icon)
+            if icon_class is None:
+                icon_class = self._placeholder_classes[icon] = f'i-{get_icon_hash(icon)[:16]}'
+        if icon_class in self._emitted_classes:
+            return f'<div class="icon {icon_class}"></div>'
+        icon = icon or b.icon_data_uri
+        self._emitted_classes.add(icon_class)
+        return f'<style>.{icon_class}{{background-image:url("{icon}")}}</style><div class="icon {icon_class}"></div>'
+
+    def __call__(self, b: Bookmark) -> str:
+        tags_html = ''.join(map(self._tag_html, sorted(b.tags)))
+        return (
+            '<div class="bookmark">'
+            f'{self._icon_html(b)}'
+            f'<div class="tags">{tags_html}</div>'
+            f'<p><a href="{escape_attr_url(b.uri)}" referrerpolicy="no-referrer" target="_blank">{escape_element(b.title)}</a></p>'
+            '</div>'
+        )
+
+
+def iter_render(load: typing.Callable[..., typing.Iterable[Bookmark]]) -> typing.Iterator[str]:
+    """yield the page chunk by chunk, `load` is called twice: `load(with_icon=False)` for the tag nav,
+    then `load()` for the bookmarks. A storage locks each call apart, so a write in between
+    can misalign the tag index with the bookmarks.
+    """
+    tag_index = TagIndex()
+    for idx, b in enumerate(load(with_icon=False)):
+        tag_index.add(idx, b)
+
+    yield from iter_template(RENDER_TEMPLATE, {
+        'style': lambda: [RENDER_STYLE],
+        'tags': tag_index.nav_htmls,
+        'bookmarks': lambda: map(CardRenderer(), load()),
+        'tag_index': lambda: [tag_index.json()]
+    })
+
+
+def render(bookmarks: list[Bookmark]) -> str:
+    return ''.join(iter_render(lambda with_icon=True: bookmarks))
+
+
+PRECOMPRESS_EXTENSIONS = ('.html', '.json', '.svg')
+
+
+def _file_digest(path: str) -> bytes:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(functools.partial(f.read, 1 << 20), b''):
+            digest.update(block)
+    return digest.digest()
+
+
+def _write_compressed(path: str, suffix: str):
+    tmp_path = f'{path}{suffix}.{os.getpid()}.tmp'
+    with open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+        if suffix == '.gz':
+            # no name and mtime in the header, so the same input gives the same bytes
+            with gzip.GzipFile(filename='', mode='wb', fileobj=dst, compresslevel=9, mtime=0) as gz:
+                shutil.copyfileobj(src, gz)
+        else:
+            compressor = brotli.Compressor(quality=11)
+            for block in iter(functools.partial(src.read, 1 << 20), b''):
+                dst.write(compressor.process(block))
+            dst.write(compressor.finish())
+    os.replace(tmp_path, f'{path}{suffix}')
+
+
+def write_static(path: str, chunks: typing.Iterable[typing.Union[str, bytes]], precompress=False) -> bool:
+    """write `chunks` to `path` only if its content changed, so mtime and etag stay the same for caches.
+    With `precompress` also keep `.gz` and `.br` (if brotli is installed) siblings for the web server.
+    Return whether `path` was written.
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    digest = hashlib.sha256()
+    with open(tmp_path, 'wb') as f:
+        for chunk in chunks:
+            data = chunk.encode() if isinstance(chunk, str) else chunk
+            digest.update(data)
+            f.write(data)
+    changed = not os.path.exists(path) or _file_digest(path) != digest.digest()
+    if changed:
+        os.replace(tmp_path, path)
+    else:
+        os.remove(tmp_path)
+    if precompress:
+        for suffix in ('.gz', '.br') if brotli is not None else ('.gz',):
+            if changed or not os.path.exists(f'{path}{suffix}'):
+                _write_compressed(path, suffix)
+    return changed
+
+
+def render_paged(load: typing.Callable[[], typing.Iterable[Bookmark]], output_path: str, shard_size=500, precompress=False):
+    """write a small page to `output_path`, bookmarks go to json shards of `shard_size` and icons to files, in
+    `<name>.data` beside it. The page fetches the shards in view and keeps only the cards in view in the DOM,
+    so it has to be served over http(s). `load` is called once.
+    Shards and icons are named by their content, so they can be cached forever, and unchanged files are not rewritten.
+    """
+    name = os.path.splitext(os.path.basename(output_path))[0]
+    data_dir = os.path.join(os.path.dirname(os.path.abspath(output_path)), f'{name}.data')
+    icons_dir = os.path.join(data_dir, 'icons')
+    os.makedirs(icons_dir, exist_ok=True)
+    existing_icons = set(os.listdir(icons_dir))
+    icon_files: dict[str, str] = {}
+    data_files: list[str] = []
+    tag_index = TagIndex()
+
+    def _write_json(prefix: str, text: str) -> str:
+        data = text.encode()
+        file_name = f'{prefix}-{hashlib.sha1(data).hexdigest()[:16]}.json'
+        write_static(os.path.join(data_dir, file_name), [data], precompress)
+        data_files.append(file_name)
+        return file_name
+
+    def _write_shard(shard: list) -> str:
+        return _write_json('shard', json.dumps(shard, ensure_ascii=False, separators=(',', ':')))
+
+    def _write_icon(key: str, icon: str) -> str:
+        header, _, payload = icon.partition(',')
+        file_name = f'{key[:16]}.{ICON_EXTENSIONS.get(header[5:].split(";")[0], "bin")}'
+        if file_name not in existing_icons or (precompress and file_name.endswith(PRECOMPRESS_EXTENSIONS)):
+            data = base64.b64decode(payload) if header.endswith(';base64') else urllib.parse.unquote_to_bytes(payload)
+            write_static(os.path.join(icons_dir, file_name), [data],
+                         precompress and file_name.endswith(PRECOMPRESS_EXTENSIONS))
+        return file_name
+
+    def _icon_file(b: Bookmark) -> str:
+        icon = '' if b.has_icon_data else get_svg_uri(b)
+        key = b.icon_hash or get_icon_hash(icon)
+        if key not in icon_files:
+            try:
+                icon_files[key] = _write_icon(key, icon or b.icon_data_uri)
+            except ValueError as e:
+                # binascii.Error of a broken data uri, the placeholder is shown instead as the browser does
+                logger.warning('broken icon of %s: %s', b.uri, e)
+                icon = get_svg_uri(b)
+                icon_files[key] = _write_icon(get_icon_hash(icon), icon)
+        return icon_files[key]
+
+    count = 0
+    shard = []
+    shards = []
+    for idx, b in enumerate(load()):
+        tag_index.add(idx, b)
+        shard.append([b.title, escape_attr_url(b.uri), _icon_file(b), sorted(b.tags)])
+        if len(shard) == shard_size:
+            shards.append(_write_shard(shard))
+            shard = []
+        count = idx + 1
+    if shard:
+        shards.append(_write_shard(shard))
+    tags = _write_json('tags', tag_index.json())
+    live = set(data_files)
+    for file_name in os.listdir(data_dir):
+        if (m := re.fullmatch(r'((?:shard-\w+|tags(?:-\w+)?)\.json)(?:\.gz|\.br)?', file_name)) and m.group(1) not in live:
+            os.remove(os.path.join(data_dir, file_name))
+
+    meta = {'count': count, 'shard_size': shard_size, 'data': urllib.parse.quote(f'{name}.data'),
+            'shards': shards, 'tags': tags}
+    write_static(output_path, iter_template(PAGED_TEMPLATE, {
+        'style': lambda: [RENDER_STYLE],
+        'tags': tag_index.nav_htmls,
+        'meta': lambda: [json.dumps(meta)]
+    }), precompress)
+    logger.info('rendered %d bookmarks in %d shards, %d icons', count, len(shards), len(icon_files))
 
 
 def get_latest_firefox() -> typing.Optional[str]:
@@ -619,6 +2215,26 @@ def get_latest_firefox() -> typing.Optional[str]:
     return candidate
 
 
+def get_firefox_places() -> typing.Optional[str]:
+    firefox_dir = os.path.expanduser('~/.mozilla/firefox/')
+    if not os.path.exists(firefox_dir):
+        logger.error('it seems that no firefox data exist!')
+        return ''
+    timestamp = 0
+    candidate = ''
+    for sub_path in os.listdir(firefox_dir):
+        if not sub_path.endswith('.default-release'):
+            continue
+        places_path = os.path.join(firefox_dir, sub_path, 'places.sqlite')
+        if not os.path.exists(places_path):
+            continue
+        f_stat = os.stat(places_path)
+        if f_stat.st_mtime > timestamp:
+            timestamp = f_stat.st_mtime
+            candidate = places_path
+    return candidate
+
+
 def get_chromium(name='chromium'):
     bookmark_path = os.path.expanduser(f'~/.config/{name}/Default/Bookmarks')
     if not os.path.exists(bookmark_path):
@@ -631,16 +2247,176 @@ def get_chrome():
     return get_chromium('google-chrome')
 
 
+class TextQuery:
+    """Full text search over title, uri and tags with sqlite FTS5, every term of the text matches as a prefix"""
+
+    # bm25 weights of the title, uri and tags columns
+    WEIGHTS = (10.0, 1.0, 5.0)
+    TOKENIZE = "unicode61 remove_diacritics 2"
+
+    @staticmethod
+    def match_expr(text: str) -> str:
+        return ' '.join(f'"{term}"*' for term in re.findall(r'[^\W_]+', text.lower()))
+
+    @classmethod
+    def rank_expr(cls, table: str) -> str:
+        return f"bm25({table}, {', '.join(map(str, cls.WEIGHTS))})"
+
+
+class QueryPlan:
+    """A DNF query compiled once, shared by the storages: a predicate over bookmarks for scans, an sql
+    where clause, and the uris it can only match, if every conjunction pins the uri, for index lookups.
+
+    Conditions are (field, op, value) over title, uri, icon_uri and tags:
+    `=`, `in` (value is a collection), `prefix`, `like` (`%text%`, contains text) and `has` (tag membership).
+    Tags take only `like`, which matches a tag containing the text, and `has`.
+    """
+
+    FIELDS = ("title", "uri", "icon_uri", "tags")
+    OPS = ("=", "in", "prefix", "like", "has")
+    # text ending any prefix, as sqlite compares text by its utf-8 bytes
+    _PREFIX_END = "\U0010ffff"
+
+    def __init__(self, dnf: typing.Iterable[typing.Iterable[tuple[str, str, typing.Any]]]):
+        self.dnf = self._normalize(dnf)
+        self.uris = self._uris()
+        self.predicate = self._compile()
+        self.where_sql = self._where_sql(tuple(
+            tuple((field, op, len(value) if op == "in" else 0) for field, op, value in conditions)
+            for conditions in self.dnf
+        ))
+        self.params = tuple(param for conditions in self.dnf for condition in conditions
+                            for param in self._sql_params(*condition))
+
+    @classmethod
+    def _normalize(cls, dnf) -> tuple[tuple[tuple[str, str, typing.Any], ...], ...]:
+        if not isinstance(dnf, (list, tuple)) or not all(isinstance(conditions, (list, tuple)) for conditions in dnf):
+            raise ValueError(f"not a list of lists of conditions: {dnf!r}")
+        normalized = []
+        for conditions in dnf:
+            normalized_conditions = []
+            for condition in conditions:
+                if not isinstance(condition, (list, tuple)) or len(condition) != 3:
+                    raise ValueError(f"not a (field, op, value) condition: {condition!r}")
+                field, op, value = condition
+                if field not in cls.FIELDS:
+                    raise ValueError(f"unknown field: {field}")
+                if op not in cls.OPS:
+                    raise ValueError(f"unknown op: {op}")
+                if (field == "tags") != (op == "has") and not (field == "tags" and op == "like"):
+                    raise ValueError(f"{op} does not apply to {field}")
+                if op == "like" and not (len(value) >= 2 and value[0] == value[-1] == "%"):
+                    raise ValueError(f"like takes %text%: {value}")
+                if op == "in":
+                    # kept in order, so the sql and the lookups are the same for the same query
+                    value = tuple(dict.fromkeys(value))
+                normalized_conditions.append((field, op, value))
+            normalized.append(tuple(normalized_conditions))
+        return tuple(normalized)
+
+    def _uris(self) -> typing.Optional[tuple[str, ...]]:
+        if not self.dnf:
+            return None
+        uris = {}
+        for conditions in self.dnf:
+            pinned = [(value, ) if op == "=" else value
+                      for field, op, value in conditions if field == "uri" and op in ("=", "in")]
+            if not pinned:
+                return None
+            # the shortest is enough, the other conditions are checked by the predicate
+            uris.update(dict.fromkeys(min(pinned, key=len)))
+        return tuple(uris)
+
+    @staticmethod
+    def _compile_condition(field: str, op: str, value) -> typing.Callable[[Bookmark], bool]:
+        get = operator.attrgetter(field)
+        if op == "=":
+            return lambda b: get(b) == value
+        if op == "in":
+            values = frozenset(value)
+            return lambda b: get(b) in values
+        if op == "prefix":
+            return lambda b: get(b).startswith(value)
+        if op == "has":
+            return lambda b: value in b.tags
+        text = value[1:-1]
+        if field == "tags":
+            return lambda b: any(text in tag for tag in b.tags)
+        return lambda b: text in get(b)
+
+    def _compile(self) -> typing.Callable[[Bookmark], bool]:
+        if not self.dnf:
+            return lambda b: True
+        conjunctions = []
+        for conditions in self.dnf:
+            predicates = tuple(self._compile_condition(*condition) for condition in conditions)
+            if len(predicates) == 1:
+                conjunctions.append(predicates[0])
+            else:
+                conjunctions.append(lambda b, predicates=predicates: all(p(b) for p in predicates))
+        if len(conjunctions) == 1:
+            return conjunctions[0]
+        conjunctions = tuple(conjunctions)
+        return lambda b: any(c(b) for c in conjunctions)
+
+    @classmethod
+    @functools.lru_cache(maxsize=256)
+    def _where_sql(cls, shape: tuple[tuple[tuple[str, str, int], ...], ...]) -> str:
+        """sql of the same query shape, of the same field, op and count of `in` values, is built once and
+        stays the same text, so sqlite3 reuses its prepared statement
+        """
+        if not shape:
+            return "1"
+
+        def _condition(field: str, op: str, count: int) -> str:
+            if op == "=":
+                return f"b.`{field}` = ?"
+            if op == "in":
+                return f"b.`{field}` IN ({','.join('?' * count)})" if count else "0"
+            if op == "prefix":
+                # a range, unlike like, is case sensitive and uses the index of the column
+                return f"b.`{field}` >= ? AND b.`{field}` < ?"
+            if op == "has":
+                return "instr(';' || b.tags || ';', ?) > 0"
+            return f"b.`{field}` LIKE ?"
+
+        return " OR ".join(
+            "(" + " AND ".join(f"({_condition(*condition)})" for condition in conditions) + ")" for conditions in shape
+        )
+
+    @classmethod
+    def _sql_params(cls, field: str, op: str, value) -> tuple:
+        if op == "in":
+            return value
+        if op == "prefix":
+            return value, value + cls._PREFIX_END
+        if op == "has":
+            return f";{value};",
+        return value,
+
+    @classmethod
+    @functools.lru_cache(maxsize=256)
+    def _compile_cached(cls, dnf) -> QueryPlan:
+        return cls(dnf)
+
+    @classmethod
+    def compile(cls, dnf: typing.Iterable[typing.Iterable[tuple[str, str, typing.Any]]]) -> QueryPlan:
+        """the plan of `dnf`, the same plan for the same query"""
+        try:
+            return cls._compile_cached(cls._normalize(dnf))
+        except TypeError:
+            # unhashable values
+            return cls(dnf)
+
+
 class IStorage(abc.ABC):
 
-    def query(self, dnf: typing.Iterable[typing.Iterable[tuple[str, str, str]]]) -> list[Bookmark]:
-        assert isinstance(dnf, (list, tuple))
-        assert all(map(lambda x: isinstance(x, (list, tuple)), dnf))
-        assert all(op in ("=", "like") for conditions in dnf for _, op, _ in conditions)
-        return self._query(dnf)
+    def query(self, dnf: typing.Union[QueryPlan, typing.Iterable[typing.Iterable[tuple[str, str, typing.Any]]]]) -> list[Bookmark]:
+        """bookmarks matching a DNF of conditions, see `QueryPlan`"""
+        return self._query(dnf if isinstance(dnf, QueryPlan) else QueryPlan.compile(dnf))
 
     @abc.abstractmethod
-    def _query(self, dnf: typing.Iterable[typing.Iterable[tuple[str, str, str]]]) -> list[Bookmark]:
+    def _query(self, plan: QueryPlan) -> list[Bookmark]:
         pass
 
     @abc.abstractmethod
@@ -651,6 +2427,23 @@ class IStorage(abc.ABC):
     def load(self) -> list[Bookmark]:
         ...
 
+    def iter_load(self, with_icon=True) -> typing.Iterator[Bookmark]:
+        """without `with_icon` storages keeping icons apart may give bookmarks whose icons are read on access"""
+        yield from self.load()
+
+    def load_table(self) -> BookmarkTable:
+        return BookmarkTable(self.iter_load())
+
+    def iter_icons(self) -> typing.Iterator[tuple[str, str]]:
+        """(hash, data uri) of the stored icons referenced by bookmarks, none if icons are kept in bookmarks"""
+        return iter(())
+
+    def save_icons(self, icons: typing.Iterable[tuple[str, str]]):
+        """store (hash, data uri) of icons ahead of the bookmarks referencing them,
+        which then skip their icons. Storages keeping icons in bookmarks drop them.
+        """
+        pass
+
     @abc.abstractmethod
     def add(self, bookmark: Bookmark):
         ...
@@ -663,16 +2456,117 @@ class IStorage(abc.ABC):
     def update(self, bookmarks: list[Bookmark], fields: typing.Iterable):
         ...
 
+    @contextlib.contextmanager
+    def batch(self) -> typing.Iterator[IStorage]:
+        """writes within may be grouped and committed together, at the latest when it exits"""
+        yield self
+
+    @abc.abstractmethod
+    def compact(self) -> tuple[int, int]:
+        """drop superseded data, return the size in bytes before and after"""
+        ...
+
+    @abc.abstractmethod
+    def search(self, text: str, limit: int) -> list[Bookmark]:
+        """full text search, the best ranked first"""
+        ...
+
 
 class SqliteStorage(IStorage):
+    """The schema version is kept in `PRAGMA user_version`, `_MIGRATIONS[v]` upgrades version v to v + 1"""
+
+    _PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-65536",
+        "PRAGMA mmap_size=268435456",
+    )
+
     def __init__(self, db):
         self._db = db
         self._conn: typing.Optional[sqlite3.Connection] = None
+        self._migrated = False
 
     def _connect(self):
         if self._conn:
             return
-        self._conn = sqlite3.connect(self._db)
+        self._conn = sqlite3.connect(self._db, timeout=30)
+        for pragma in self._PRAGMAS:
+            self._conn.execute(pragma)
+        if not self._migrated:
+            self._migrate()
+            self._migrated = True
+
+    @staticmethod
+    def _migrate_v1(conn: sqlite3.Connection):
+        """key bookmarks by uri and index titles, the latest of duplicated uris wins. icons move to the icons table"""
+        legacy = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='bookmarks'").fetchone()
+        if legacy:
+            conn.execute("ALTER TABLE bookmarks RENAME TO bookmarks_v0")
+        conn.execute("CREATE TABLE bookmarks("
+                     "title TEXT NOT NULL, uri TEXT PRIMARY KEY, icon_uri TEXT, icon_data_uri TEXT, tags TEXT)")
+        # titles are not unique: browsers happily keep bookmarks of the same title in different folders
+        conn.execute("CREATE INDEX bookmarks_title ON bookmarks(title)")
+        conn.execute("CREATE TABLE IF NOT EXISTS icons(hash TEXT PRIMARY KEY, data_uri TEXT)")
+        if not legacy:
+            return
+        conn.create_function("icon_hash", 1, get_icon_hash, deterministic=True)
+        conn.execute("INSERT INTO icons SELECT icon_hash(icon_data_uri), icon_data_uri FROM bookmarks_v0"
+                     " WHERE icon_data_uri LIKE 'data:%' ON CONFLICT DO NOTHING")
+        conn.execute("INSERT INTO bookmarks SELECT title, uri, icon_uri,"
+                     " CASE WHEN icon_data_uri LIKE 'data:%' THEN icon_hash(icon_data_uri) ELSE icon_data_uri END, tags"
+                     " FROM bookmarks_v0 WHERE true ORDER BY rowid"
+                     " ON CONFLICT(uri) DO UPDATE SET title=excluded.title, icon_uri=excluded.icon_uri,"
+                     " icon_data_uri=excluded.icon_data_uri, tags=excluded.tags")
+        conn.execute("DROP TABLE bookmarks_v0")
+
+    @staticmethod
+    def _migrate_v2(conn: sqlite3.Connection):
+        """full text index of bookmarks, kept in sync by triggers"""
+        conn.execute("CREATE VIRTUAL TABLE bookmarks_fts USING fts5(title, uri, tags,"
+                     f" content='bookmarks', content_rowid='rowid', tokenize='{TextQuery.TOKENIZE}')")
+        conn.execute("CREATE TRIGGER bookmarks_fts_insert AFTER INSERT ON bookmarks BEGIN"
+                     " INSERT INTO bookmarks_fts(rowid, title, uri, tags) VALUES (new.rowid, new.title, new.uri, new.tags);"
+                     " END")
+        conn.execute("CREATE TRIGGER bookmarks_fts_delete AFTER DELETE ON bookmarks BEGIN"
+                     " INSERT INTO bookmarks_fts(bookmarks_fts, rowid, title, uri, tags)"
+                     " VALUES ('delete', old.rowid, old.title, old.uri, old.tags);"
+                     " END")
+        conn.execute("CREATE TRIGGER bookmarks_fts_update AFTER UPDATE ON bookmarks BEGIN"
+                     " INSERT INTO bookmarks_fts(bookmarks_fts, rowid, title, uri, tags)"
+                     " VALUES ('delete', old.rowid, old.title, old.uri, old.tags);"
+                     " INSERT INTO bookmarks_fts(rowid, title, uri, tags) VALUES (new.rowid, new.title, new.uri, new.tags);"
+                     " END")
+        conn.execute("INSERT INTO bookmarks_fts(bookmarks_fts) VALUES ('rebuild')")
+
+    @staticmethod
+    def _migrate_v3(conn: sqlite3.Connection):
+        """when the browser last modified bookmarks in iso format, for `convert --sync`"""
+        conn.execute("ALTER TABLE bookmarks ADD COLUMN modified TEXT")
+
+    _MIGRATIONS = (_migrate_v1, _migrate_v2, _migrate_v3)
+
+    def _migrate(self):
+        schema_version = len(self._MIGRATIONS)
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == schema_version:
+            return
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            # re-read under the write lock, another process may have migrated meanwhile
+            version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+            if version > schema_version:
+                raise ValueError(f"{self._db} has schema version {version}, newer than {schema_version}")
+            for migration in self._MIGRATIONS[version:]:
+                logger.info("migrate %s from schema version %d", self._db, version)
+                migration(self._conn)
+                version += 1
+            self._conn.execute(f"PRAGMA user_version={version}")
+        except BaseException:
+            self._conn.rollback()
+            raise
+        self._conn.commit()
 
     def _disconnect(self):
         if not self._conn:
@@ -690,41 +2584,93 @@ class SqliteStorage(IStorage):
         self._disconnect()
         return
 
-    def _query(self, dnf: typing.Iterable[typing.Iterable[tuple[str, str, str]]]) -> list[Bookmark]:
-        where_sql = "(" + ") OR (".join(
-            ("(" + ") AND (".join(f"`{field}` {op} ?" for field, op, _ in conditions) + ")" ) for conditions in dnf
-        ) + ")"
-        sql = f"SELECT * FROM bookmarks WHERE {where_sql}"
+    # icon_data_uri holds a key of the icons table, or an inline data uri written before the icons table
+    _SELECT = ("SELECT b.title, b.uri, b.icon_uri, COALESCE(i.data_uri, b.icon_data_uri), b.tags, b.modified"
+               " FROM bookmarks AS b LEFT JOIN icons AS i ON i.hash = b.icon_data_uri")
+    _SELECT_ICON_KEY = "SELECT title, uri, icon_uri, icon_data_uri, tags, modified FROM bookmarks"
+
+    def _query(self, plan: QueryPlan) -> list[Bookmark]:
+        sql = f"{self._SELECT} WHERE {plan.where_sql}"
         logger.debug("query sql: %s", sql)
-        params = tuple(value for conditions in dnf for _, _, value in conditions)
         with self:
             return [
-                self._row2bookmark(row) for row in self._conn.execute(sql, params)
+                self._row2bookmark(row) for row in self._conn.execute(sql, plan.params)
             ]
 
 
+    def _put_icons(self, bookmarks: typing.Iterable[Bookmark]):
+        """store icons which are not stored yet, lazy icons are then never loaded"""
+        icons = {b.icon_hash: b for b in bookmarks if b.has_icon_data}
+        keys = list(icons)
+        stored = set()
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            stored.update(key for key, in self._conn.execute(
+                f"SELECT hash FROM icons WHERE hash IN ({','.join('?' * len(chunk))})", chunk))
+        self._conn.executemany("INSERT OR IGNORE INTO icons VALUES (?,?)", (
+            (key, b.icon_data_uri) for key, b in icons.items() if key not in stored
+        ))
+
+    def _read_icon(self, key: str) -> str:
+        if self._conn is None:
+            with self:
+                return self._read_icon(key)
+        row = self._conn.execute("SELECT data_uri FROM icons WHERE hash=?", (key, )).fetchone()
+        return row[0] if row else ''
+
+    def iter_icons(self) -> typing.Iterator[tuple[str, str]]:
+        with self:
+            yield from self._conn.execute(
+                "SELECT hash, data_uri FROM icons WHERE hash IN (SELECT icon_data_uri FROM bookmarks)")
+
+    def save_icons(self, icons: typing.Iterable[tuple[str, str]]):
+        icons = iter(icons)
+        while batch := list(itertools.islice(icons, 1000)):
+            with self:
+                self._conn.executemany("INSERT OR IGNORE INTO icons VALUES (?,?)", batch)
+
+    @staticmethod
+    def _to_sqlite_tuple(b: Bookmark):
+        # the icon is in the icons table, a lazy one is not read for its key
+        return b.title, b.uri, b.icon_uri, b.icon_hash, ";".join(b.tags), b.modified.isoformat() if b.modified else None
+
+    _INSERT = "INSERT INTO bookmarks(title, uri, icon_uri, icon_data_uri, tags, modified) VALUES (?,?,?,?,?,?)"
+    _UPSERT = (_INSERT + " ON CONFLICT(uri) DO UPDATE SET title=excluded.title, icon_uri=excluded.icon_uri,"
+                         " icon_data_uri=excluded.icon_data_uri, tags=excluded.tags, modified=excluded.modified")
+
     def save(self, bookmarks: list[Bookmark]):
-        bookmark_tuples = [b.to_sqlite_tuple() for b in bookmarks]
+        bookmark_tuples = [self._to_sqlite_tuple(b) for b in bookmarks]
         with self:
-            self._conn.execute("CREATE TABLE IF NOT EXISTS bookmarks(title, uri, icon_uri, icon_data_uri, tags)")
-            self._conn.executemany("INSERT INTO bookmarks VALUES (?,?,?,?,?)", bookmark_tuples)
+            self._put_icons(bookmarks)
+            self._conn.executemany(self._UPSERT, bookmark_tuples)
 
     def load(self) -> list[Bookmark]:
         with self:
             return [
-                self._row2bookmark(row) for row in self._conn.execute("SELECT * FROM bookmarks")
+                self._row2bookmark(row) for row in self._conn.execute(self._SELECT)
             ]
 
+    def iter_load(self, with_icon=True) -> typing.Iterator[Bookmark]:
+        with self:
+            for row in self._conn.execute(self._SELECT if with_icon else self._SELECT_ICON_KEY):
+                if with_icon or not is_icon_hash(row[3]):
+                    yield self._row2bookmark(row)
+                    continue
+                bookmark = self._row2bookmark(row[:3] + ('', ) + row[4:])
+                bookmark.set_lazy_icon(functools.partial(self._read_icon, row[3]), row[3])
+                yield bookmark
+
     def add(self, bookmark: Bookmark):
         def _check_dup(an):
-            rows = self._conn.execute(f"SELECT * FROM bookmarks where {an}=?", (getattr(bookmark, an), )).fetchall()
-            if len(rows) > 0:
+            row = self._conn.execute(f"SELECT 1 FROM bookmarks WHERE {an}=? LIMIT 1", (getattr(bookmark, an), )).fetchone()
+            if row is not None:
                 raise ValueError(f"Duplicate for {an}={getattr(bookmark, an)}")
 
         with self:
             _check_dup("title")
             _check_dup("uri")
-            self._conn.execute("INSERT INTO bookmarks VALUES (?,?,?,?,?)", bookmark.to_sqlite_tuple())
+            self._put_icons([bookmark])
+            self._conn.execute(self._INSERT, self._to_sqlite_tuple(bookmark))
 
     def remove(self, uri: str = "", title: str = "") -> list[Bookmark]:
         assert bool(uri) ^ bool(title)
@@ -735,7 +2681,7 @@ class SqliteStorage(IStorage):
             key = uri
             key_an = "uri"
         with self:
-            cur = self._conn.execute(f"SELECT * FROM bookmarks WHERE {key_an}=?", (key,))
+            cur = self._conn.execute(f"{self._SELECT} WHERE b.{key_an}=?", (key,))
             bookmarks = [self._row2bookmark(row) for row in cur]
             if len(bookmarks) > 0:
                 self._conn.execute(f"DELETE FROM bookmarks WHERE {key_an}=?", (key,))
@@ -751,48 +2697,328 @@ class SqliteStorage(IStorage):
 
         fields4params = list(fields) + ["uri"]
 
+        def _to_param(b, field):
+            if field == "tags":
+                return ";".join(b.tags)
+            if field == "icon_data_uri":
+                return b.icon_hash
+            if field == "modified":
+                return b.modified.isoformat() if b.modified else None
+            return getattr(b, field)
+
         def _to_params(b):
-            return tuple(map(lambda x: getattr(b, x) if x != "tags" else ";".join(getattr(b, "tags")), fields4params))
+            return tuple(_to_param(b, field) for field in fields4params)
 
-        with self:
+        if only_icon:
+            bookmarks = [bookmark for bookmark in bookmarks if bookmark.icon_updated]
             for bookmark in bookmarks:
-                if only_icon and not bookmark.icon_updated:
-                    continue
-                if only_icon:
-                    logger.info(f"{bookmark.title}({bookmark.uri}) icon updated")
-                parameters = _to_params(bookmark)
-                cur = self._conn.execute(sql, parameters)
-                logger.debug("sql=%s, parameters=%s, rowcount=%d", sql, parameters, cur.rowcount)
+                logger.info(f"{bookmark.title}({bookmark.uri}) icon updated")
+
+        with self:
+            if "icon_data_uri" in fields:
+                self._put_icons(bookmarks)
+            cur = self._conn.executemany(sql, map(_to_params, bookmarks))
+            logger.debug("sql=%s, %d bookmarks, rowcount=%d", sql, len(bookmarks), cur.rowcount)
 
+    def compact(self) -> tuple[int, int]:
+        before = os.path.getsize(self._db)
+        with self:
+            self._conn.execute("DELETE FROM icons WHERE hash NOT IN (SELECT icon_data_uri FROM bookmarks)")
+        with self:
+            self._conn.execute("VACUUM")
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        with self:
+            # VACUUM may renumber the rowids the full text index refers to
+            self._conn.execute("INSERT INTO bookmarks_fts(bookmarks_fts) VALUES ('rebuild')")
+        return before, os.path.getsize(self._db)
+
+    def search(self, text: str, limit: int) -> list[Bookmark]:
+        match = TextQuery.match_expr(text)
+        if not match:
+            return []
+        sql = (f"{self._SELECT} JOIN bookmarks_fts AS f ON f.rowid = b.rowid"
+               f" WHERE bookmarks_fts MATCH ? ORDER BY {TextQuery.rank_expr('bookmarks_fts')} LIMIT ?")
+        with self:
+            return [self._row2bookmark(row) for row in self._conn.execute(sql, (match, limit))]
 
     @staticmethod
     def _row2bookmark(row):
-        return Bookmark(
+        return Bookmark.trusted(
             title=row[0],
             uri=row[1],
-            parent='',
             icon_uri=row[2],
             icon_data_uri=row[3],
-            tags=set(row[4].split(';'))
+            tags=row[4].split(';'),
+            modified=datetime.datetime.fromisoformat(row[5]) if row[5] else None
         )
 
 
+class JsonlIndex:
+    """Sidecar index of a jsonl log in sqlite: uri -> byte offset of its latest live record.
+
+    `offset` is how far the log has been indexed, so `refresh` only parses the
+    tail appended since the last time, and every change writes only the rows it touches.
+    The index is tied to the inode of the log, a compacted (replaced) or truncated log is indexed from scratch.
+    Icon records are indexed by their hash in `icons`, an entry keeps the icon key its live record references
+    and `icon_refs` counts the live records referencing a key.
+    Entries are ordered by `seq`, the offset of the record which added the uri: updating a live uri keeps
+    its place, a deleted then re-added uri goes to the end, as the log replay does.
+    """
+    VERSION = 4
+
+    def __init__(self, path: str):
+        self._path = path
+        self._conn: typing.Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+            try:
+                conn.execute("SELECT COUNT(*) FROM sqlite_master")
+            except sqlite3.DatabaseError as e:
+                # the json index of older versions
+                logger.warning('replace index %s: %s', self._path, e)
+                conn.close()
+                os.remove(self._path)
+                conn = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value INTEGER)")
+            conn.execute("CREATE TABLE IF NOT EXISTS entries(uri TEXT PRIMARY KEY, offset INTEGER, seq INTEGER,"
+                         " icon TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_seq ON entries(seq)")
+            conn.execute("CREATE TABLE IF NOT EXISTS icons(key TEXT PRIMARY KEY, offset INTEGER)")
+            conn.execute("CREATE TABLE IF NOT EXISTS icon_refs(key TEXT PRIMARY KEY, count INTEGER)")
+            self._conn = conn
+        return self._conn
+
+    def _meta(self) -> dict[str, int]:
+        meta = dict(self._connect().execute("SELECT key, value FROM meta"))
+        if meta.get('version') != self.VERSION:
+            return {}
+        return meta
+
+    @property
+    def offset(self) -> int:
+        return self._meta().get('offset', 0)
+
+    def refresh(self, fd: typing.BinaryIO) -> bool:
+        st = os.fstat(fd.fileno())
+        meta = self._meta()
+        if meta.get('inode') == st.st_ino and meta.get('offset') == st.st_size:
+            return False
+        conn = self._connect()
+        with conn:
+            # readers refresh under a shared lock of the log, only the first of them applies the tail
+            conn.execute("BEGIN IMMEDIATE")
+            meta = self._meta()
+            offset = meta.get('offset', 0)
+            if meta.get('inode') != st.st_ino or offset > st.st_size:
+                logger.debug('rebuild index %s', self._path)
+                self._clear(conn, st.st_ino)
+                offset = 0
+            fd.seek(offset, os.SEEK_SET)
+            pos = offset
+            for line in fd:
+                if not line.endswith(b'\n'):
+                    logger.warning('incomplete record at %d of %s', pos, fd.name)
+                    break
+                if line.strip():
+                    self._apply(conn, json.loads(line), pos)
+                pos += len(line)
+            conn.execute("UPDATE meta SET value=? WHERE key='offset'", (pos,))
+        return pos != offset
+
+    def _clear(self, conn: sqlite3.Connection, inode: int):
+        for table in ('meta', 'entries', 'icons', 'icon_refs'):
+            conn.execute(f"DELETE FROM {table}")
+        conn.executemany("INSERT INTO meta VALUES (?,?)", (('version', self.VERSION), ('inode', inode), ('offset', 0)))
+
+    @staticmethod
+    def _apply(conn: sqlite3.Connection, data: dict, pos: int):
+        if 'icon' in data:
+            conn.execute("INSERT OR REPLACE INTO icons VALUES (?,?)", (data['icon'], pos))
+            return
+        uri = data['record']['uri']
+        row = conn.execute("SELECT seq, icon FROM entries WHERE uri=?", (uri,)).fetchone()
+        if row is not None and row[1] is not None:
+            conn.execute("UPDATE icon_refs SET count=count-1 WHERE key=?", (row[1],))
+            conn.execute("DELETE FROM icon_refs WHERE key=? AND count<=0", (row[1],))
+        if data.get('deleted', False):
+            conn.execute("DELETE FROM entries WHERE uri=?", (uri,))
+            return
+        key = data['record'].get('icon_data_uri', '')
+        key = key if is_icon_ref(key) else None
+        conn.execute("INSERT OR REPLACE INTO entries VALUES (?,?,?,?)", (uri, pos, pos if row is None else row[0], key))
+        if key is not None:
+            conn.execute("INSERT INTO icon_refs VALUES (?,1) ON CONFLICT(key) DO UPDATE SET count=count+1", (key,))
+
+    def append(self, datas: list[dict], offsets: list[int], offset: int):
+        """index the records just appended at `offsets`, the log now ends at `offset`"""
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for data, pos in zip(datas, offsets):
+                self._apply(conn, data, pos)
+            conn.execute("UPDATE meta SET value=? WHERE key='offset'", (offset,))
+
+    def replace(self, inode: int, offset: int, entries: dict[str, int], icons: dict[str, int], refs: dict[str, str]):
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._clear(conn, inode)
+            conn.executemany("INSERT INTO entries VALUES (?,?,?,?)",
+                             ((uri, pos, pos, refs.get(uri)) for uri, pos in entries.items()))
+            conn.executemany("INSERT INTO icons VALUES (?,?)", icons.items())
+            conn.executemany("INSERT INTO icon_refs VALUES (?,?)", collections.Counter(refs.values()).items())
+            conn.execute("UPDATE meta SET value=? WHERE key='offset'", (offset,))
+
+    def entries(self) -> list[tuple[str, int]]:
+        """(uri, offset) of the live records in log order"""
+        return self._connect().execute("SELECT uri, offset FROM entries ORDER BY seq").fetchall()
+
+    def offsets(self, uris: typing.Optional[typing.Iterable[str]] = None) -> list[int]:
+        """offsets of the live records of `uris` in their order, or of all of them in log order"""
+        conn = self._connect()
+        if uris is None:
+            return [offset for offset, in conn.execute("SELECT offset FROM entries ORDER BY seq")]
+        offsets = []
+        for uri in uris:
+            if (row := conn.execute("SELECT offset FROM entries WHERE uri=?", (uri,)).fetchone()) is not None:
+                offsets.append(row[0])
+        return offsets
+
+    def icon_offset(self, key: str) -> typing.Optional[int]:
+        row = self._connect().execute("SELECT offset FROM icons WHERE key=?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def icon_offsets(self) -> dict[str, int]:
+        return dict(self._connect().execute("SELECT key, offset FROM icons"))
+
+    def live_icon_keys(self) -> set[str]:
+        """icon keys referenced by live records"""
+        return {key for key, in self._connect().execute("SELECT key FROM icon_refs")}
+
+    def live_icon_count(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM icon_refs").fetchone()[0]
+
+
+class JsonlTextIndex:
+    """Full text index of a jsonl log in an sqlite FTS5 sidecar, refreshed from the log tail like `JsonlIndex`"""
+
+    def __init__(self, path: str):
+        self._path = path
+        self._conn: typing.Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self._path, timeout=30)
+            conn.execute("CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value INTEGER)")
+            conn.execute("CREATE TABLE IF NOT EXISTS docs(id INTEGER PRIMARY KEY, uri TEXT UNIQUE)")
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(title, uri, tags,"
+                         f" tokenize='{TextQuery.TOKENIZE}')")
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _apply(conn: sqlite3.Connection, data: dict):
+        if 'icon' in data:
+            return
+        record = data['record']
+        row = conn.execute("SELECT id FROM docs WHERE uri=?", (record['uri'],)).fetchone()
+        if row is not None:
+            conn.execute("DELETE FROM docs_fts WHERE rowid=?", row)
+        if data.get('deleted', False):
+            conn.execute("DELETE FROM docs WHERE uri=?", (record['uri'],))
+            return
+        doc_id = row[0] if row is not None else conn.execute("INSERT INTO docs(uri) VALUES (?)", (record['uri'],)).lastrowid
+        conn.execute("INSERT INTO docs_fts(rowid, title, uri, tags) VALUES (?,?,?,?)",
+                     (doc_id, record['title'], record['uri'], ";".join(record['tags'])))
+
+    def refresh(self, fd: typing.BinaryIO):
+        conn = self._connect()
+        meta = dict(conn.execute("SELECT key, value FROM meta"))
+        st = os.fstat(fd.fileno())
+        offset = meta.get('offset', 0)
+        if meta.get('inode') == st.st_ino and offset == st.st_size:
+            return
+        with conn:
+            if meta.get('inode') != st.st_ino or offset > st.st_size:
+                logger.debug('rebuild text index %s', self._path)
+                conn.execute("DELETE FROM docs")
+                conn.execute("DELETE FROM docs_fts")
+                offset = 0
+            fd.seek(offset, os.SEEK_SET)
+            for line in fd:
+                if not line.endswith(b'\n'):
+                    break
+                if line.strip():
+                    self._apply(conn, json.loads(line))
+                offset += len(line)
+            conn.executemany("INSERT OR REPLACE INTO meta VALUES (?,?)", (('inode', st.st_ino), ('offset', offset)))
+
+    def search(self, match: str, limit: int) -> list[str]:
+        sql = (f"SELECT d.uri FROM docs_fts JOIN docs AS d ON d.id = docs_fts.rowid"
+               f" WHERE docs_fts MATCH ? ORDER BY {TextQuery.rank_expr('docs_fts')} LIMIT ?")
+        return [uri for uri, in self._connect().execute(sql, (match, limit))]
+
+
 class JsonlStorage(IStorage):
-    def __init__(self, filepath):
+    """Append only log of bookmark records and tombstones.
+
+    Icons are stored once per content as `{"icon": hash, "data": data_uri}` lines,
+    and bookmark records reference them by hash in `icon_data_uri`.
+
+    Writers hold an exclusive lock of the log, readers a shared one. Records of a write are serialized
+    before taking the lock and appended by one `write`, fsync'ed as `durability` tells:
+    'none' leaves it to the OS, 'batch' syncs once per write, 'record' after every record.
+    """
+
+    DURABILITIES = ('none', 'batch', 'record')
+    # records queued by `batch` are written once they are this many
+    GROUP_COMMIT_RECORDS = 1000
+
+    def __init__(self, filepath, durability='none'):
         self._filepath = filepath
-        self._fd: typing.Optional[io.TextIOBase] = None
+        self._durability = durability
+        if self._durability not in self.DURABILITIES:
+            raise ValueError(f"Invalid {self._durability=}")
+        self._fd: typing.Optional[typing.BinaryIO] = None
+        self._index = JsonlIndex(f'{filepath}.idx')
+        self._text_index = JsonlTextIndex(f'{filepath}.fts')
+        # (records, icons) queued by `batch`
+        self._pending: typing.Optional[tuple[list[dict], dict[str, Bookmark]]] = None
 
     def _open(self):
         if self._fd:
             return
-        self._fd = open(self._filepath, "a+")
+        self._fd = open(self._filepath, "a+b")
+
+    def _lock(self, operation: int):
+        while True:
+            self._open()
+            fcntl.lockf(self._fd.fileno(), operation)
+            if os.path.exists(self._filepath) and os.fstat(self._fd.fileno()).st_ino == os.stat(self._filepath).st_ino:
+                break
+            # replaced by `compact` while waiting for the lock, retry on the new one
+            fcntl.lockf(self._fd.fileno(), fcntl.LOCK_UN)
+            self._fd.close()
+            self._fd = None
+        self._fd.__enter__()
 
     def __enter__(self):
-        self._open()
-        fcntl.lockf(self._fd.fileno(), fcntl.LOCK_EX)
-        self._fd.__enter__()
+        self._lock(fcntl.LOCK_EX)
         return self
 
+    @contextlib.contextmanager
+    def _shared(self) -> typing.Iterator[JsonlStorage]:
+        """lock for readers, they read alongside each other but never alongside a writer"""
+        self._lock(fcntl.LOCK_SH)
+        try:
+            yield self
+        finally:
+            self.__exit__(None, None, None)
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         assert self._fd
         fd = self._fd
@@ -800,87 +3026,304 @@ class JsonlStorage(IStorage):
         fcntl.lockf(fd.fileno(), fcntl.LOCK_UN)
         return fd.__exit__(exc_type, exc_val, exc_tb)
 
-    def _query(self, dnf: typing.Iterable[typing.Iterable[tuple[str, str, str]]]) -> list[Bookmark]:
-        def _filter(b):
-            if not dnf:
-                return True
-            for conditions in dnf:
-                for field, op, value in conditions:
-                    matched = True
-                    if op == "=":
-                        matched = getattr(b, field) == value
-                    elif op == "like":
-                        assert value[0] == value[-1] == "%"
-                        matched = value[1:-1] in getattr(b, field)
-                    else:
-                        assert False
-                    if not matched:
-                        logger.debug("%s %s %s not matched: %r", field, op, value, b)
-                        break
-                else:
-                    return True
-            return False
-        bookmarks_record_dict = {}
-        with self:
-            self._fd.seek(0, os.SEEK_SET)
-            for idx, line in enumerate(self._fd.readlines()):
-                line = line.strip()
-                if not line:
-                    continue
-                data = json.loads(line)
-                if data.get('deleted', False):
-                    if data['record']['uri'] in bookmarks_record_dict:
-                        del bookmarks_record_dict[data['record']['uri']]
-                    continue
-                if data['record']['uri'] not in bookmarks_record_dict:
-                    bookmarks_record_dict[data['record']['uri']] = data['record']
-                else:
-                    bookmarks_record_dict[data['record']['uri']].update(data['record'])
+    def _refresh_index(self):
+        self._index.refresh(self._fd)
 
+    @staticmethod
+    def _read_record(fd: typing.BinaryIO, offset: int) -> dict:
+        fd.seek(offset, os.SEEK_SET)
+        return json.loads(fd.readline())['record']
+
+    @contextlib.contextmanager
+    def _icon_reader(self, fd: typing.BinaryIO, icon_offset: typing.Callable[[str], typing.Optional[int]]
+                     ) -> typing.Iterator[typing.Callable[[str], str]]:
+        """`icon_offset` gives the offset of the icon record of a key, None if there is none"""
+        cache: dict[str, str] = {}
+
+        def _read(key: str) -> str:
+            if key not in cache:
+                if (offset := icon_offset(key)) is not None:
+                    fd.seek(offset, os.SEEK_SET)
+                    cache[key] = json.loads(fd.readline())['data']
+                else:
+                    logger.warning('icon %s is missing in %s', key, self._filepath)
+                    cache[key] = ''
+            return cache[key]
+
+        yield _read
+
+    def _read_icon(self, key: str) -> str:
+        """read one icon of a lazy bookmark, with the lock held or not"""
+        if self._fd is None:
+            with self._shared():
+                self._refresh_index()
+                return self._read_icon(key)
+        with self._icon_reader(self._fd, self._index.icon_offset) as read_icon:
+            return read_icon(key)
+
+    def _record2bookmark(self, record: dict, read_icon: typing.Optional[typing.Callable[[str], str]]) -> Bookmark:
+        """without `read_icon` the icon is read on access by `_read_icon`"""
+        key = record.get('icon_data_uri', '')
+        if not is_icon_ref(key):
+            return Bookmark.from_data_dict(record, trusted=True)
+        if read_icon is not None:
+            record['icon_data_uri'] = read_icon(key)
+            return Bookmark.from_data_dict(record, trusted=True)
+        record['icon_data_uri'] = ''
+        bookmark = Bookmark.from_data_dict(record, trusted=True)
+        bookmark.set_lazy_icon(functools.partial(self._read_icon, key), key if is_icon_hash(key) else '')
+        return bookmark
+
+    def _read_bookmarks(self, offsets: typing.Iterable[int],
+                        predicate: typing.Optional[typing.Callable[[Bookmark], bool]] = None) -> list[Bookmark]:
+        """the lock is held, icons are read only for the bookmarks matching `predicate`"""
         bookmarks = []
-        for bookmark_record in bookmarks_record_dict.values():
-            bookmark = Bookmark.from_data_dict(bookmark_record)
-            if not isinstance(bookmark, Bookmark):
-                logger.error("%s %d: %s", bookmark)
-                continue
-            if not _filter(bookmark):
-                continue
-            bookmarks.append(bookmark)
+        with self._icon_reader(self._fd, self._index.icon_offset) as read_icon:
+            for offset in offsets:
+                record = self._read_record(self._fd, offset)
+                if predicate is not None and not predicate(Bookmark.from_data_dict(dict(record, icon_data_uri=''), trusted=True)):
+                    continue
+                bookmarks.append(self._record2bookmark(record, read_icon))
         return bookmarks
 
+    def _put_icons(self, icons: dict[str, Bookmark]) -> list[dict]:
+        """store icons (hash -> bookmark holding it) which are not stored yet, the lock is held"""
+        missing = self._missing_icons(icons)
+        return self._store_icons((key, bookmark.icon_data_uri) for key, bookmark in icons.items() if key in missing)
+
+    def _missing_icons(self, keys: typing.Iterable[str]) -> set[str]:
+        """the lock is held"""
+        return {key for key in keys if self._index.icon_offset(key) is None}
+
+    def _store_icons(self, icons: typing.Iterable[tuple[str, str]]) -> list[dict]:
+        """the lock is held, return the lines to append to the log for the icons"""
+        return [{'icon': key, 'data': data_uri} for key, data_uri in icons]
+
+    def _live_icon_keys(self) -> set[str]:
+        """icon keys referenced by live records, the lock is held"""
+        return self._index.live_icon_keys()
+
+    def iter_icons(self) -> typing.Iterator[tuple[str, str]]:
+        with self._shared():
+            self._refresh_index()
+            icons = self._index.icon_offsets()
+            offsets = sorted(icons[key] for key in self._live_icon_keys() if key in icons)
+            fd = open(self._filepath, 'rb')
+        with fd:
+            for offset in offsets:
+                fd.seek(offset, os.SEEK_SET)
+                data = json.loads(fd.readline())
+                yield data['icon'] if is_icon_hash(data['icon']) else get_icon_hash(data['data']), data['data']
+
+    def save_icons(self, icons: typing.Iterable[tuple[str, str]]):
+        icons = iter(icons)
+        while batch := dict(itertools.islice(icons, 1000)):
+            with self:
+                self._refresh_index()
+                missing = self._missing_icons(batch)
+                self._append(self._store_icons((key, data_uri) for key, data_uri in batch.items() if key in missing))
+
+    @staticmethod
+    def _encode(datas: list[dict]) -> tuple[bytes, list[int]]:
+        """serialize lines at once, with the offset of every line in the result"""
+        lines = [json.dumps(data) for data in datas]
+        offsets = []
+        pos = 0
+        for line in lines:
+            offsets.append(pos)
+            # json.dumps escapes non ascii, so characters are bytes
+            pos += len(line) + 1
+        return ''.join(f'{line}\n' for line in lines).encode('ascii'), offsets
+
+    def _append(self, datas: list[dict], encoded: typing.Optional[tuple[bytes, list[int]]] = None):
+        """the lock is held, `encoded` is `_encode(datas)` when done before taking it"""
+        if not datas:
+            return
+        blob, offsets = encoded or self._encode(datas)
+        pos = self._fd.seek(0, os.SEEK_END)
+        if self._durability == 'record':
+            for start, end in zip(offsets, offsets[1:] + [len(blob)]):
+                self._fd.write(blob[start:end])
+                self._fd.flush()
+                os.fsync(self._fd.fileno())
+        else:
+            self._fd.write(blob)
+            self._fd.flush()
+            if self._durability == 'batch':
+                os.fsync(self._fd.fileno())
+        self._index.append(datas, [pos + offset for offset in offsets], pos + len(blob))
+
+    def _find(self, plan: QueryPlan) -> list[Bookmark]:
+        """the lock is held"""
+        self._refresh_index()
+        return self._read_bookmarks(self._index.offsets(plan.uris), plan.predicate if plan.dnf else None)
+
+    def _query(self, plan: QueryPlan) -> list[Bookmark]:
+        with self._shared():
+            return self._find(plan)
+
     def save(self, bookmarks: list[Bookmark]):
         self._save(bookmarks, False)
 
+    @staticmethod
+    def _records(bookmarks: list[Bookmark], deleted=False,
+                 with_icon=True) -> tuple[list[dict], dict[str, Bookmark]]:
+        """lines of the bookmarks, with the icons (hash -> bookmark holding it) they reference"""
+        datas = []
+        icons = {}
+        for bookmark in bookmarks:
+            if deleted:
+                record = {'uri': bookmark.uri, 'title': bookmark.title}
+            else:
+                # icons are read only if the store lacks them, lazy icons are then never loaded
+                record = bookmark.data_dict(with_icon=False)
+                if with_icon and bookmark.has_icon_data:
+                    record['icon_data_uri'] = key = bookmark.icon_hash
+                    icons[key] = bookmark
+            datas.append({
+                "record": record,
+                "deleted": deleted,
+            })
+        return datas, icons
+
     def _save(self, bookmarks: list[Bookmark], deleted=False):
+        datas, icons = self._records(bookmarks, deleted)
+        if self._pending is None:
+            self._commit(datas, icons)
+            return
+        self._pending[0].extend(datas)
+        self._pending[1].update(icons)
+        if len(self._pending[0]) >= self.GROUP_COMMIT_RECORDS:
+            self._commit(*self._pending)
+            self._pending = ([], {})
+
+    def _commit(self, datas: list[dict], icons: dict[str, Bookmark]):
+        """append records and the icons they reference with one write under one lock hold"""
+        if not datas and not icons:
+            return
+        blob, offsets = self._encode(datas)
         with self:
-            self._fd.seek(0, os.SEEK_END)
-            for bookmark in bookmarks:
-                data = {
-                    "record": bookmark.data_dict() if not deleted else {'uri': bookmark.uri, 'title': bookmark.title},
-                    "deleted": deleted,
-                }
-                self._fd.write(json.dumps(data) + "\n")
+            self._refresh_index()
+            if icon_datas := self._put_icons(icons):
+                icon_blob, icon_offsets = self._encode(icon_datas)
+                datas = icon_datas + datas
+                blob, offsets = icon_blob + blob, icon_offsets + [len(icon_blob) + offset for offset in offsets]
+            self._append(datas, (blob, offsets))
+            self._written()
+
+    def _written(self):
+        """the lock is still held after appending records"""
+        pass
+
+    @contextlib.contextmanager
+    def batch(self) -> typing.Iterator[JsonlStorage]:
+        """group commit: bookmarks saved, updated and removed within are written together when it exits,
+        or every GROUP_COMMIT_RECORDS records. Until then they are not visible to reads.
+        """
+        if self._pending is not None:
+            yield self
+            return
+        self._pending = ([], {})
+        try:
+            yield self
+        finally:
+            pending, self._pending = self._pending, None
+            self._commit(*pending)
 
     def load(self) -> list[Bookmark]:
         return self.query([])
 
+    def iter_load(self, with_icon=True) -> typing.Iterator[Bookmark]:
+        with self._shared():
+            self._refresh_index()
+            offsets = self._index.offsets()
+            icons = self._index.icon_offsets()
+            # the log is append only and `compact` replaces it, so this snapshot stays valid after unlocking
+            fd = open(self._filepath, 'rb')
+        with fd, self._icon_reader(fd, icons.get) as read_icon:
+            for offset in offsets:
+                yield self._record2bookmark(self._read_record(fd, offset), read_icon if with_icon else None)
+
     def add(self, bookmark: Bookmark):
         self.save([bookmark])
 
+    def search(self, text: str, limit: int) -> list[Bookmark]:
+        match = TextQuery.match_expr(text)
+        if not match:
+            return []
+        # exclusive, as the text index is brought up to date here
+        with self:
+            self._refresh_index()
+            self._text_index.refresh(self._fd)
+            uris = self._text_index.search(match, limit)
+            return self._read_bookmarks(self._index.offsets(uris))
+
     def remove(self, uri: str = "", title: str = "") -> list[Bookmark]:
         assert bool(uri) ^ bool(title)
-        dnf = [[("title", "=", title)]] if title else [[("uri", "=", uri)]]
-        bookmarks = self.query(dnf)
-        self._save(bookmarks, True)
+        plan = QueryPlan.compile([[("title", "=", title)]] if title else [[("uri", "=", uri)]])
+        if self._pending is not None:
+            bookmarks = self._query(plan)
+            self._save(bookmarks, True)
+            return bookmarks
+        with self:
+            bookmarks = self._find(plan)
+            datas, _ = self._records(bookmarks, True)
+            self._append(datas)
+            self._written()
         return bookmarks
 
     def update(self, bookmarks: list[Bookmark], fields: typing.Iterable):
         self._save(bookmarks, False)
 
+    def compact(self) -> tuple[int, int]:
+        """rewrite the log with only the latest live record of every uri and the icons they reference"""
+        with self:
+            self._refresh_index()
+            before = self._index.offset
+            tmp_path = f'{self._filepath}.{os.getpid()}.compact'
+            entries = {}
+            icons = {}
+            refs = {}
+            stored_icons = self._index.icon_offsets()
+            with open(tmp_path, 'wb') as tmp_fd:
+                pos = 0
+                for uri, offset in self._index.entries():
+                    self._fd.seek(offset, os.SEEK_SET)
+                    line = self._fd.readline()
+                    key = json.loads(line)['record'].get('icon_data_uri', '')
+                    if key in stored_icons and key not in icons:
+                        self._fd.seek(stored_icons[key], os.SEEK_SET)
+                        icon_line = self._fd.readline()
+                        tmp_fd.write(icon_line)
+                        icons[key] = pos
+                        pos += len(icon_line)
+                    tmp_fd.write(line)
+                    entries[uri] = pos
+                    if is_icon_ref(key):
+                        refs[uri] = key
+                    pos += len(line)
+                tmp_fd.flush()
+                os.fsync(tmp_fd.fileno())
+                inode = os.fstat(tmp_fd.fileno()).st_ino
+            os.replace(tmp_path, self._filepath)
+            self._index.replace(inode, pos, entries, icons, refs)
+        return before, pos
+
 
 class SplitIconJsonlStorage(JsonlStorage):
+    """Icons are kept in icons.zip beside the log, one member per distinct icon named by its hash.
+
+    Members of removed bookmarks and duplicated members written by older versions stay in the zip
+    until `repack`, which runs on `compact` and once too many members are stale.
+    """
+
+    # repack once at least this many and this ratio of the members are not referenced by live records
+    REPACK_MIN_STALE = 256
+    REPACK_STALE_RATIO = 0.25
+    # store a member as is unless deflating saves at least 10%
+    DEFLATE_MIN_SAVING = 0.1
 
-    def __init__(self, dirpath: str):
+    def __init__(self, dirpath: str, durability='none'):
         if not os.path.exists(dirpath):
             os.makedirs(dirpath, exist_ok=True)
         if not os.path.isdir(dirpath):
@@ -891,56 +3334,173 @@ class SplitIconJsonlStorage(JsonlStorage):
         #     raise ValueError(f"bookmarks.jsonl dose not exist: {jsonl_path}")
         # if not os.path.exists(icon_zip_path):
         #     raise ValueError(f"icons.zip dose not exist: {icon_zip_path}")
-        super().__init__(jsonl_path)
+        super().__init__(jsonl_path, durability)
         self._icon_zip_path = icon_zip_path
+        self._zip_signature: typing.Optional[tuple[int, int, int]] = None
+        self._zip_fd: typing.Optional[typing.BinaryIO] = None
+        self._zip_file: typing.Optional[zipfile.ZipFile] = None
 
-    def _query(self, dnf: typing.Iterable[typing.Iterable[tuple[str, str, str]]]) -> list[Bookmark]:
-        bookmarks = super()._query(dnf)
+    def _zip(self) -> typing.Optional[zipfile.ZipFile]:
+        """icons.zip opened read only and kept open, reopened once it changed"""
+        try:
+            st = os.stat(self._icon_zip_path)
+        except FileNotFoundError:
+            return None
+        signature = st.st_ino, st.st_size, st.st_mtime_ns
+        if self._zip_signature != signature:
+            self._close_zip()
+            if st.st_size == 0:
+                return None
+            self._zip_fd = open(self._icon_zip_path, 'rb')
+            self._zip_file = zipfile.ZipFile(self._zip_fd)
+            self._zip_signature = signature
+        return self._zip_file
+
+    def _close_zip(self):
+        if self._zip_file is not None:
+            self._zip_file.close()
+            self._zip_fd.close()
+        self._zip_file = None
+        self._zip_fd = None
+        self._zip_signature = None
+
+    def _read_icon(self, key: str) -> str:
+        """read one icon of a lazy bookmark, with the lock held or not.
+        `_store_icons` appends to icons.zip in place, so it must not be reopened without the lock.
+        """
+        if self._fd is None:
+            with self._shared():
+                return self._read_icon(key)
+        zf = self._zip()
+        if zf is None:
+            raise KeyError(f"{self._icon_zip_path} does not exist")
+        return zf.read(key).decode('utf-8')
+
+    def _record2bookmark(self, record: dict, read_icon: typing.Optional[typing.Callable[[str], str]]) -> Bookmark:
+        # icons are always read on access from icons.zip
+        return super()._record2bookmark(record, None)
+
+    def _missing_icons(self, keys: typing.Iterable[str]) -> set[str]:
+        zf = self._zip()
+        names = set(zf.namelist()) if zf is not None else set()
+        return {key for key in keys if key not in names}
+
+    def _store_icons(self, icons: typing.Iterable[tuple[str, str]]) -> list[dict]:
+        icons = list(icons)
+        if not icons:
+            # appending rewrites the central directory even if nothing is written
+            return []
         with zipfile.ZipFile(self._icon_zip_path, "a") as zf:
-            for bookmark in bookmarks:
-                if bookmark.icon_data_uri:
-                    key: str = bookmark.icon_data_uri
-                    bookmark.icon_data_uri = zf.read(key).decode('utf-8')
-        return bookmarks
+            for key, data_uri in icons:
+                data = data_uri.encode('utf-8')
+                zf.writestr(key, data, self._compress_type(data))
+        if self._durability != 'none':
+            # the records written next must not outlive their icons
+            fd = os.open(self._icon_zip_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        return []
+
+    def iter_icons(self) -> typing.Iterator[tuple[str, str]]:
+        with self._shared():
+            self._refresh_index()
+            keys = sorted(self._live_icon_keys())
+            zf = self._zip()
+        # appends leave the members indexed by this open zip as they are, it is safe to read unlocked
+        if zf is None:
+            return
+        for key in keys:
+            try:
+                data_uri = zf.read(key).decode('utf-8')
+            except KeyError:
+                logger.warning('icon %s is missing in %s', key, self._icon_zip_path)
+                continue
+            yield key if is_icon_hash(key) else get_icon_hash(data_uri), data_uri
 
-    def _save(self, bookmarks: list[Bookmark], deleted=False):
-        icon_data_uris: list[str] = []
-        with zipfile.ZipFile(self._icon_zip_path, "a") as zf:
-            for bookmark in bookmarks:
-                icon_data_uris.append(bookmark.icon_data_uri)
-                if bookmark.icon_data_uri:
-                    key = hashlib.md5(bookmark.uri.encode()).hexdigest()
-                    zf.writestr(key, bookmark.icon_data_uri)
-                    bookmark.icon_data_uri = key
-        try:
-            super()._save(bookmarks, deleted)
-        finally:
-            for icon_data_uri, bookmark in zip(icon_data_uris, bookmarks):
-                bookmark.icon_data_uri = icon_data_uri
+    def _written(self):
+        # repack once the members not referenced by live records, duplicated ones included, are too many
+        zf = self._zip()
+        if zf is None:
+            return
+        members = zf.infolist()
+        if len(members) < self.REPACK_MIN_STALE:
+            return
+        # live keys missing from the zip are not told apart here, they are none unless it was tampered with
+        stale = len(members) - self._index.live_icon_count()
+        if stale < max(self.REPACK_MIN_STALE, len(members) * self.REPACK_STALE_RATIO):
+            return
+        before, after = self._repack()
+        logger.info("repacked %s: %d stale members, %d bytes reclaimed", self._icon_zip_path, stale, before - after)
+
+    @classmethod
+    def _compress_type(cls, data: bytes) -> int:
+        if len(zlib.compress(data, 9)) <= len(data) * (1 - cls.DEFLATE_MIN_SAVING):
+            return zipfile.ZIP_DEFLATED
+        return zipfile.ZIP_STORED
+
+    def _repack(self) -> tuple[int, int]:
+        """rewrite icons.zip with only the members referenced by live records, the lock is held"""
+        self._refresh_index()
+        zf = self._zip()
+        if zf is None:
+            return 0, 0
+        before = os.path.getsize(self._icon_zip_path)
+        keys = self._live_icon_keys()
+        tmp_path = f'{self._icon_zip_path}.{os.getpid()}.repack'
+        with open(tmp_path, 'wb') as tmp_fd:
+            with zipfile.ZipFile(tmp_fd, "w") as tmp_zf:
+                # the last of duplicated members is the one read, as `getinfo` returns
+                for key in sorted(keys):
+                    try:
+                        info = zf.getinfo(key)
+                    except KeyError:
+                        logger.warning('icon %s is missing in %s', key, self._icon_zip_path)
+                        continue
+                    data = zf.read(info)
+                    compress_type = self._compress_type(data)
+                    tmp_zf.writestr(zipfile.ZipInfo(key, info.date_time), data, compress_type,
+                                    9 if compress_type == zipfile.ZIP_DEFLATED else None)
+            tmp_fd.flush()
+            os.fsync(tmp_fd.fileno())
+        os.replace(tmp_path, self._icon_zip_path)
+        self._close_zip()
+        return before, os.path.getsize(self._icon_zip_path)
+
+    def repack(self) -> tuple[int, int]:
+        """return the size in bytes of icons.zip before and after"""
+        with self:
+            return self._repack()
+
+    def compact(self) -> tuple[int, int]:
+        """compact the log and repack icons.zip, the sizes are of both"""
+        before, after = super().compact()
+        zip_before, zip_after = self.repack()
+        return before + zip_before, after + zip_after
 
 
 class NoIconDataJsonlStorage(JsonlStorage):
-    def _save(self, bookmarks: list[Bookmark], deleted=False):
-        icon_data_uris: list[str] = []
-        for bookmark in bookmarks:
-            icon_data_uris.append(bookmark.icon_data_uri)
-            bookmark.icon_data_uri = ''
-        try:
-            super()._save(bookmarks, deleted)
-        finally:
-            for icon_data_uri, bookmark in zip(icon_data_uris, bookmarks):
-                bookmark.icon_data_uri = icon_data_uri
+    def save_icons(self, icons: typing.Iterable[tuple[str, str]]):
+        pass
+
+    @staticmethod
+    def _records(bookmarks: list[Bookmark], deleted=False,
+                 with_icon=False) -> tuple[list[dict], dict[str, Bookmark]]:
+        # icons are dropped without reading them, lazy ones stay unread
+        return JsonlStorage._records(bookmarks, deleted, with_icon)
 
 
-def get_storage(path: str):
+def get_storage(path: str, durability='none'):
+    """`durability` is the fsync policy of jsonl storages, see `JsonlStorage`"""
     if path.endswith(".db"):
         return SqliteStorage(path)
     if path.endswith(".jsonl"):
-        return JsonlStorage(path)
+        return JsonlStorage(path, durability)
     if path.endswith(".njsonl"):
-        return NoIconDataJsonlStorage(path)
+        return NoIconDataJsonlStorage(path, durability)
     if os.path.isdir(path):
-        return SplitIconJsonlStorage(path)
+        return SplitIconJsonlStorage(path, durability)
     raise ValueError(f"Unsupported storage: {path}")
 
 
@@ -956,6 +3516,54 @@ def add_icon_cache_param(parser) -> typing.Callable[[argparse.Namespace], bool]:
     return _
 
 
+def add_fetch_params(parser) -> typing.Callable[[argparse.Namespace], FetchOptions]:
+    defaults = FetchOptions()
+    group = parser.add_argument_group('fetch')
+    group.add_argument('--concurrency', type=int, default=defaults.concurrency,
+                       help='max requests in flight')
+    group.add_argument('--per-host', dest='per_host', type=int, default=defaults.per_host,
+                       help='max requests in flight to one host')
+    group.add_argument('--rate', type=float, default=defaults.rate,
+                       help='max requests per second to one host, 0 for unlimited')
+    group.add_argument('--burst', type=int, default=defaults.burst,
+                       help='max requests sent at once to one host before --rate applies')
+    group.add_argument('--retries', type=int, default=defaults.retries,
+                       help='attempts for every request')
+    group.add_argument('--backoff', type=float, default=defaults.backoff,
+                       help='base seconds of the exponential backoff between attempts')
+    group.add_argument('--max-backoff', dest='max_backoff', type=float, default=defaults.max_backoff,
+                       help='max seconds between attempts, Retry-After of a server included')
+    group.add_argument('--http-cache', dest='http_cache', default=None,
+                       help='sqlite file caching responses, refreshed with conditional requests')
+    group.add_argument('--negative-cache', dest='negative_cache', default=None,
+                       help='sqlite file recording failed hosts and uris to skip them with backoff, '
+                            'the http cache by default')
+    group.add_argument('--ignore-negative-cache', dest='ignore_negative_cache', action='store_true',
+                       help='try failed hosts and uris regardless of their backoff')
+    group.add_argument('--image-executor', dest='image_executor', choices=('process', 'thread'),
+                       default=defaults.image_executor, help='pool decoding and resizing icons')
+    group.add_argument('--image-workers', dest='image_workers', type=int, default=defaults.image_workers,
+                       help='workers of the image pool, the number of CPUs by default')
+
+    def _(args):
+        return FetchOptions(
+            concurrency=args.concurrency,
+            per_host=args.per_host,
+            rate=args.rate,
+            burst=args.burst,
+            retries=args.retries,
+            backoff=args.backoff,
+            max_backoff=args.max_backoff,
+            http_cache=args.http_cache,
+            negative_cache=args.negative_cache,
+            ignore_negative_cache=args.ignore_negative_cache,
+            image_executor=args.image_executor,
+            image_workers=args.image_workers,
+        )
+
+    return _
+
+
 def register_add(add_parser):
     add_parser.add_argument('storage', help='/path/to/storage')
     add_parser.add_argument("--title", help="title", required=False)
@@ -970,7 +3578,7 @@ def register_add(add_parser):
         get_all_info(bookmark, icon_cache_dir=args.icon_cache_dir, get_title=True)
         if not bookmark.title:
             bookmark.title = bookmark.uri
-        get_storage(args.storage).add(bookmark)
+        get_storage(args.storage, args.durability).add(bookmark)
 
     return add_bookmark
 
@@ -982,7 +3590,7 @@ def register_remove(remove_parser):
     remove_key_group.add_argument("--uri", help="uri")
     remove_parser.add_argument('-y', '--yes', dest='yes', action='store_true', help='answer yes for all attentions')
     def remove_bookmark(args):
-        bookmarks = get_storage(args.storage).remove(args.uri, args.title)
+        bookmarks = get_storage(args.storage, args.durability).remove(args.uri, args.title)
         logger.info("total %d deleted", len(bookmarks))
         for bookmark in bookmarks:
             logger.info("%s(%s) deleted", bookmark.uri, bookmark.title)
@@ -992,13 +3600,23 @@ def register_remove(remove_parser):
 def register_update_icon(update_icon_parser):
     update_icon_parser.add_argument('storage', help='/path/to/storage')
     cb = add_icon_cache_param(update_icon_parser)
+    get_fetch_options = add_fetch_params(update_icon_parser)
+
+    update_icon_parser.add_argument('--workers', type=int, default=1,
+                                    help='processes fetching icons, each for a slice of the hosts')
+    update_icon_parser.add_argument('--commit-every', dest='commit_every', type=int, default=200,
+                                    help='with --workers, changed icons written at once')
 
     def update_icon(args):
         if not cb(args):
             sys.exit(1)
-        storage = get_storage(args.storage)
+        storage = get_storage(args.storage, args.durability)
+        if args.workers > 1:
+            update_icons_sharded(storage, args.workers, icon_cache_dir=args.icon_cache_dir,
+                                 fetch_options=get_fetch_options(args), commit_every=args.commit_every)
+            return
         bookmarks = storage.load()
-        get_all_info(bookmarks, icon_cache_dir=args.icon_cache_dir, force=True)
+        get_all_info(bookmarks, icon_cache_dir=args.icon_cache_dir, force=True, fetch_options=get_fetch_options(args))
         storage.update(bookmarks, fields=["icon_data_uri", "icon_uri"])
 
     return update_icon
@@ -1009,15 +3627,27 @@ def register_query(query_parser):
     query_key_group = query_parser.add_mutually_exclusive_group(required=True)
     query_key_group.add_argument("--title")
     query_key_group.add_argument("--uri")
+    query_key_group.add_argument("--text", help="full text search of title, uri and tags, ranked by relevance")
+    query_key_group.add_argument("--uri-prefix", dest="uri_prefix", help="uri starting with it")
+    query_key_group.add_argument("--tag", metavar="TAG", dest="tags", action="append",
+                                 help="bookmarks having the tag, bookmarks having all of them if repeated")
+    query_parser.add_argument("--limit", type=int, default=20, help="max bookmarks of --text")
     def query_bookmark(args):
-        storage = get_storage(args.storage)
-        key_an = "title" if args.title else "uri"
-        dnf = [[(key_an, "like", f"%{getattr(args, key_an)}%")]]
-        bookmarks = storage.query(dnf)
+        storage = get_storage(args.storage, args.durability)
+        if args.text:
+            bookmarks = storage.search(args.text, args.limit)
+        elif args.uri_prefix:
+            bookmarks = storage.query([[("uri", "prefix", args.uri_prefix)]])
+        elif args.tags:
+            bookmarks = storage.query([[("tags", "has", tag) for tag in args.tags]])
+        else:
+            key_an = "title" if args.title else "uri"
+            dnf = [[(key_an, "like", f"%{getattr(args, key_an)}%")]]
+            bookmarks = storage.query(dnf)
         for idx, bookmark in enumerate(bookmarks):
             print(f"========== Bookmark.{idx} ===========")
             print(f"title={bookmark.title}, uri={bookmark.uri}")
-            print(f"icon_uri={bookmark.icon_uri}, has_icon_data={bool(bookmark.icon_data_uri)}")
+            print(f"icon_uri={bookmark.icon_uri}, has_icon_data={bookmark.has_icon_data}")
             print(f"tags:", "  ".join(sorted(bookmark.tags)))
     return query_bookmark
 
@@ -1040,7 +3670,7 @@ def register_modify(modify_parser):
             sys.exit(1)
         key_an = "title" if args.title else "uri"
         dnf = [[(key_an, "like", f"%{getattr(args, key_an)}%")]]
-        storage = get_storage(args.storage)
+        storage = get_storage(args.storage, args.durability)
         bookmarks = storage.query(dnf)
         assert len(bookmarks) == 1
         fields = []
@@ -1070,14 +3700,66 @@ def register_modify(modify_parser):
     return modify_bookmark
 
 
+def register_compact(compact_parser):
+    compact_parser.add_argument('storage', help='/path/to/storage')
+
+    def compact(args):
+        before, after = get_storage(args.storage, args.durability).compact()
+        logger.info("compacted %s: %d -> %d bytes, %d bytes reclaimed", args.storage, before, after, before - after)
+
+    return compact
+
+
 def register_resave(resave_parser):
+    def _stamp(path: str) -> list[list[int]]:
+        # sidecar indexes change on every read, so only the data files tell whether the source changed
+        # sqlite commits land in the -wal file until a checkpoint
+        paths = [os.path.join(path, 'bookmarks.jsonl'), os.path.join(path, 'icons.zip')] if os.path.isdir(path) else [path, f'{path}-wal']
+        return [[st.st_size, st.st_mtime_ns] for st in map(os.stat, filter(os.path.exists, paths))]
+
     def _(args):
         src = get_storage(args.src)
-        dst = get_storage(args.dst)
-        dst.save(src.load())
+        dst = get_storage(args.dst, args.durability)
+        checkpoint_path = f'{args.dst.rstrip(os.sep)}.resave'
+        checkpoint = {'src': os.path.abspath(args.src), 'stamp': _stamp(args.src), 'icons': False, 'done': 0}
+        if os.path.exists(checkpoint_path) and not args.restart:
+            with open(checkpoint_path) as f:
+                saved = json.load(f)
+            if saved.get('src') == checkpoint['src'] and saved.get('stamp') == checkpoint['stamp']:
+                checkpoint = saved
+                logger.warning('resume from %s, %d bookmarks were resaved', checkpoint_path, checkpoint['done'])
+            else:
+                logger.warning('%s changed since %s, start over', args.src, checkpoint_path)
+
+        def _save_checkpoint():
+            tmp_path = f'{checkpoint_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(checkpoint, f)
+            os.replace(tmp_path, checkpoint_path)
+
+        started = time.time()
+        if not checkpoint['icons']:
+            # icons move as stored, once each, and the bookmarks below then skip them
+            dst.save_icons(src.iter_icons())
+            checkpoint['icons'] = True
+            _save_checkpoint()
+            logger.info('icons copied in %.1fs', time.time() - started)
+        resumed = checkpoint['done']
+        bookmarks = itertools.islice(src.iter_load(with_icon=False), resumed, None)
+        while batch := list(itertools.islice(bookmarks, args.batch_size)):
+            dst.save(batch)
+            checkpoint['done'] += len(batch)
+            _save_checkpoint()
+            logger.info('%d bookmarks resaved, %.0f/s', checkpoint['done'],
+                        (checkpoint['done'] - resumed) / max(time.time() - started, 1e-3))
+        os.remove(checkpoint_path)
 
     resave_parser.add_argument("src", help="/path/to/source")
     resave_parser.add_argument("dst", help="/path/to/destination")
+    resave_parser.add_argument('--batch-size', dest='batch_size', type=int, default=1000,
+                               help='bookmarks saved at once, progress is kept in <dst>.resave after every batch')
+    resave_parser.add_argument('--restart', dest='restart', action='store_true',
+                               help='ignore the progress of an interrupted resave')
     return _
 
 
@@ -1085,14 +3767,25 @@ def register_convert(convert_parser):
     browser_mapping = {
         'firefox': {
             'loader': load_firefox,
+            'streamer': stream_firefox,
+            'icons': fill_firefox_icons,
             'get_default': get_latest_firefox
         },
+        'firefox-places': {
+            'loader': load_firefox_places,
+            'icons': fill_firefox_icons,
+            'get_default': get_firefox_places
+        },
         'chrome': {
             'loader': load_chrome,
+            'streamer': stream_chrome,
+            'icons': fill_chrome_icons,
             'get_default': get_chrome
         },
         'chromium': {
             'loader': load_chrome,
+            'streamer': stream_chrome,
+            'icons': fill_chrome_icons,
             'get_default': get_chromium
         }
     }
@@ -1106,7 +3799,17 @@ def register_convert(convert_parser):
                                 help='filter bookmarks by path, use "." to split parent and child. apply multiple times works as "OR"')
     convert_parser.add_argument('--skip-empty', dest='skip_empty', action='store_true',
                                 help='skip empty folder')
+    convert_parser.add_argument('--stream', dest='stream', action='store_true',
+                                help='scan the bookmarks file incrementally and save in batches, for huge profiles')
+    convert_parser.add_argument('--batch-size', dest='batch_size', type=int, default=1000,
+                                help='bookmarks fetched and saved at a time with --stream')
+    convert_parser.add_argument('--no-browser-icons', dest='browser_icons', action='store_false',
+                                help='fetch every icon, instead of using those the browser already has')
+    convert_parser.add_argument('--sync', dest='sync', action='store_true',
+                                help='make the storage mirror the browser: only write added and modified bookmarks, '
+                                     'and remove those gone from the browser. Can not be used with -p')
     cb = add_icon_cache_param(convert_parser)
+    get_fetch_options = add_fetch_params(convert_parser)
     convert_parser.add_argument('-y', '--yes', dest='yes', action='store_true', help='answer yes for all attentions')
 
     def _(args):
@@ -1122,15 +3825,63 @@ def register_convert(convert_parser):
         if not cb(args):
             sys.exit(1)
 
-        if os.path.exists(args.storage):
+        if args.sync and args.path_filters:
+            # stored bookmarks keep no path, those out of the filters would all be taken as gone and removed
+            logger.error('--sync can not be used with -p/--path-filter')
+            sys.exit(1)
+
+        if os.path.exists(args.storage) and not args.sync:
             logger.warning('%s exists!', args.storage)
             if not args.yes and input(f'Do you want to append "{args.storage}"?[Yy/Nn]').lower() != 'y':
                 sys.exit(1)
 
-        folder = browser_mapping[args.browser]['loader'](args.input_path, args.skip_empty)
-        get_all_info(folder, args.path_filters, args.icon_cache_dir)
-        bookmarks, _ = convert2list_with_tags(folder, args.path_filters)
-        get_storage(args.storage).save(bookmarks)
+        browser = browser_mapping[args.browser]
+        storage = get_storage(args.storage, args.durability)
+        fetch_options = get_fetch_options(args)
+        sync = SyncDiff(storage.iter_load(with_icon=False)) if args.sync else None
+
+        def _save(bookmarks: list[Bookmark]):
+            modified = []
+            if sync is not None:
+                added, modified = sync.diff(bookmarks)
+                logger.info('%d added, %d modified of %d bookmarks', len(added), len(modified), len(bookmarks))
+                bookmarks = added + modified
+                if not bookmarks:
+                    return
+            if args.browser_icons:
+                browser['icons'](args.input_path, bookmarks)
+            for bookmark in modified:
+                # the icon stays, unless the browser has a newer one
+                if not bookmark.has_icon_data:
+                    for stored in storage.query([[("uri", "=", bookmark.uri)]]):
+                        bookmark.icon_uri = stored.icon_uri
+                        bookmark.icon_data_uri = stored.icon_data_uri
+            get_all_info(bookmarks, icon_cache_dir=args.icon_cache_dir, fetch_options=fetch_options, missing_only=True)
+            storage.save(bookmarks)
+
+        if args.stream and 'streamer' not in browser:
+            logger.warning('%s can not be streamed, load it at once', args.browser)
+        if args.stream and 'streamer' in browser:
+            # empty folders hold no bookmarks, so --skip-empty changes nothing here
+            batch = []
+            for bookmark in browser['streamer'](args.input_path, args.path_filters):
+                batch.append(bookmark)
+                if len(batch) >= args.batch_size:
+                    _save(batch)
+                    batch = []
+            if batch:
+                _save(batch)
+        else:
+            folder = browser['loader'](args.input_path, args.skip_empty)
+            bookmarks, _ = convert2list_with_tags(folder, args.path_filters)
+            _save(bookmarks)
+
+        if sync is not None:
+            removed = sync.removed()
+            with storage.batch():
+                for uri in removed:
+                    storage.remove(uri=uri)
+            logger.info('%d removed', len(removed))
 
     return _
 
@@ -1140,7 +3891,17 @@ def register_render(render_parser):
     render_parser.add_argument("output_path", help='/path/to/the/generate/html')
     render_parser.add_argument('-y', '--yes', dest='yes', action='store_true', help='answer yes for all attentions')
     render_parser.add_argument('-u', '--update-icon', dest='update_icon', action='store_true', help='update icon before render')
+    render_parser.add_argument('--stream', dest='stream', action='store_true',
+                               help='write bookmarks one by one while reading the storage, instead of rendering in memory')
+    render_parser.add_argument('--paged', dest='paged', action='store_true',
+                               help='write a small page loading bookmarks from json shards beside it as they scroll into view, '
+                                    'the page has to be served over http(s)')
+    render_parser.add_argument('--shard-size', dest='shard_size', type=int, default=500,
+                               help='bookmarks per shard with --paged')
+    render_parser.add_argument('--precompress', dest='precompress', action='store_true',
+                               help='also write .gz and .br (if brotli is installed) files beside the outputs')
     cb = add_icon_cache_param(render_parser)
+    get_fetch_options = add_fetch_params(render_parser)
 
     def _(args):
         if os.path.exists(args.output_path):
@@ -1149,13 +3910,29 @@ def register_render(render_parser):
                 sys.exit(1)
         if not cb(args):
             sys.exit(1)
-        with open(args.output_path, 'w+') as of:
-            storage = get_storage(args.storage)
-            bookmarks = storage.load()
+        if args.precompress and brotli is None:
+            logger.warning('brotli is not installed, only .gz files are written')
+        if args.paged:
+            storage = get_storage(args.storage, args.durability)
+            load = storage.iter_load
             if args.update_icon or isinstance(storage, NoIconDataJsonlStorage):
-                get_all_info(bookmarks, icon_cache_dir=args.icon_cache_dir)
-            html = render(bookmarks)
-            of.write(html)
+                bookmarks = storage.load()
+                get_all_info(bookmarks, icon_cache_dir=args.icon_cache_dir, fetch_options=get_fetch_options(args))
+                load = lambda: bookmarks
+            render_paged(load, args.output_path, args.shard_size, args.precompress)
+            return
+        storage = get_storage(args.storage, args.durability)
+        if args.update_icon or isinstance(storage, NoIconDataJsonlStorage):
+            bookmarks = storage.load()
+            get_all_info(bookmarks, icon_cache_dir=args.icon_cache_dir, fetch_options=get_fetch_options(args))
+            chunks = iter_render(lambda with_icon=True: bookmarks)
+        elif args.stream:
+            chunks = iter_render(storage.iter_load)
+        else:
+            table = storage.load_table()
+            chunks = iter_render(lambda with_icon=True: table)
+        if not write_static(args.output_path, chunks, args.precompress):
+            logger.info('%s is not changed', args.output_path)
 
     return _
 
@@ -1171,11 +3948,14 @@ def main():
         'add': register_add,
         'modify': register_modify,
         'remove': register_remove,
-        'update-icon': register_update_icon
+        'update-icon': register_update_icon,
+        'compact': register_compact
     }
     for name, register in register_mapping.items():
         sub_parser = sub_parsers.add_parser(name)
         sub_parser.add_argument('-v', '--verbose', action='count', default=0)
+        sub_parser.add_argument('--durability', choices=JsonlStorage.DURABILITIES, default='none',
+                                help='fsync of jsonl storages: never, once per write or after every record')
         func = register(sub_parser)
         assert callable(func)
         sub_parser.set_defaults(func=func)
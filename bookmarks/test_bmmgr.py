@@ -0,0 +1,446 @@
+import asyncio
+import dataclasses
+import datetime
+import gzip
+import json
+import multiprocessing
+import operator
+import os
+import shutil
+import sqlite3
+import sys
+import time
+import typing
+
+import aiohttp.web
+import lz4.block
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bmmgr
+
+
+def _add_bookmarks(path: str, start: int, count: int):
+    storage = bmmgr.get_storage(path)
+    for i in range(start, start + count):
+        storage.add(bmmgr.Bookmark(f't{i}', f'https://h{i % 7}.com/{i}', tags={'x'},
+                                   icon_data_uri=f'data:image/png;base64,{i:08d}' + 'A' * 512))
+
+
+def test_split_lazy_icons_while_adding(tmp_path):
+    """lazy icon reads of a split storage must not see icons.zip half appended by another process"""
+    path = str(tmp_path / 'split')
+    os.makedirs(path)
+    _add_bookmarks(path, 0, 50)
+    writer = multiprocessing.Process(target=_add_bookmarks, args=(path, 50, 400))
+    writer.start()
+    storage = bmmgr.SplitIconJsonlStorage(path)
+    reads = 0
+    try:
+        while writer.is_alive():
+            for bookmark in storage.iter_load(with_icon=False):
+                assert bookmark.icon_data_uri.startswith('data:image/png;base64,')
+                reads += 1
+    finally:
+        writer.join()
+    assert writer.exitcode == 0
+    assert reads > 0
+    assert len(storage.load()) == 450
+
+
+@pytest.mark.parametrize('name', ['bookmarks.jsonl', 'split'])
+def test_concurrent_add(tmp_path, name):
+    """adds of processes writing at once all land, and the index they update agrees with a rebuilt one"""
+    path = str(tmp_path / name)
+    if name == 'split':
+        os.makedirs(path)
+    _add_bookmarks(path, 0, 10)
+    writers = [multiprocessing.Process(target=_add_bookmarks, args=(path, 100 * (i + 1), 100)) for i in range(4)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    assert all(writer.exitcode == 0 for writer in writers)
+    storage = bmmgr.get_storage(path)
+    bookmarks = storage.load()
+    assert sorted(b.uri for b in bookmarks) == sorted(f'https://h{i % 7}.com/{i}' for i in [*range(10), *range(100, 500)])
+    assert all(b.icon_data_uri.startswith('data:image/png;base64,') for b in bookmarks)
+    rebuilt = bmmgr.JsonlIndex(str(tmp_path / 'rebuilt.idx'))
+    with storage._shared():
+        rebuilt.refresh(storage._fd)
+    assert rebuilt.entries() == storage._index.entries()
+    assert rebuilt.live_icon_keys() == storage._index.live_icon_keys()
+
+
+def _bookmark(i: int, title: str = '') -> bmmgr.Bookmark:
+    return bmmgr.Bookmark(title or f't{i}', f'https://h{i % 3}.com/{i}', tags={'x', f'y{i % 4}'},
+                          icon_data_uri=f'data:image/png;base64,AAA{i % 5}' if i % 2 else '')
+
+
+def _dicts(bookmarks: list[bmmgr.Bookmark]) -> list[dict]:
+    return [b.data_dict() for b in bookmarks]
+
+
+def test_jsonl_index_rebuild_and_compact(tmp_path):
+    """the index keeps the log order through updates and removals, a lost or older one is rebuilt,
+    and compact keeps the live records only"""
+    path = str(tmp_path / 'bookmarks.jsonl')
+    storage = bmmgr.JsonlStorage(path)
+    storage.save([_bookmark(i) for i in range(20)])
+    storage.update([_bookmark(3, 'renamed')], ['title'])
+    assert [b.uri for b in storage.remove(uri=_bookmark(5).uri)] == [_bookmark(5).uri]
+    storage.add(_bookmark(5))
+    expected = _dicts([_bookmark(3, 'renamed') if i == 3 else _bookmark(i) for i in range(20) if i != 5] + [_bookmark(5)])
+    assert _dicts(storage.load()) == expected
+    assert _dicts(storage.query([[('uri', '=', _bookmark(3).uri)]])) == [_bookmark(3, 'renamed').data_dict()]
+
+    rebuilt_path = str(tmp_path / 'rebuilt.jsonl')
+    shutil.copyfile(path, rebuilt_path)
+    assert _dicts(bmmgr.JsonlStorage(rebuilt_path).load()) == expected
+    # the json index of older versions
+    older_path = str(tmp_path / 'older.jsonl')
+    shutil.copyfile(path, older_path)
+    with open(f'{older_path}.idx', 'w') as f:
+        json.dump({'version': 3, 'inode': 0, 'offset': 0, 'entries': {}, 'icons': {}, 'refs': {}}, f)
+    assert _dicts(bmmgr.JsonlStorage(older_path).load()) == expected
+
+    other = bmmgr.JsonlStorage(path)
+    assert len(other.load()) == 20
+    before, after = storage.compact()
+    assert after < before == os.path.getsize(rebuilt_path)
+    assert os.path.getsize(path) == after
+    assert _dicts(storage.load()) == expected
+    # the log was replaced under the index of another instance
+    assert _dicts(other.load()) == expected
+    other.add(_bookmark(20))
+    assert _dicts(storage.load()) == expected + [_bookmark(20).data_dict()]
+    with open(path) as f:
+        icons = [json.loads(line)['icon'] for line in f if '"icon"' in line]
+    assert len(icons) == len(set(icons)) == 5
+
+
+def test_http_cache_entries():
+    cache = bmmgr.HttpCache(sqlite3.connect(':memory:'))
+    assert cache.expires({'Cache-Control': 'no-store'}) is None
+    assert cache.expires({'Cache-Control': 'no-cache'}) <= time.time()
+    assert 50 < cache.expires({'Cache-Control': 'public, max-age=60'}) - time.time() <= 60
+    assert cache.expires({'Expires': 'Wed, 21 Oct 2015 07:28:00 GMT'}) == 1445412480
+
+    result = bmmgr.FetchResult('https://a.com/', 'https://a.com/', 200, 'text/html', 'utf-8', b'<html>')
+    cache.put(result, '"v1"', '', 1.0)
+    entry = cache.get('https://a.com/')
+    assert entry.result.body == b'<html>' and entry.result.from_cache
+    assert entry.validators() == {'If-None-Match': '"v1"'}
+    cache.refresh('https://a.com/', 2.0)
+    assert cache.get('https://a.com/').expires == 2.0
+
+    head = dataclasses.replace(result, url='https://b.com/', truncated=True)
+    cache.put(head, '', 'Wed, 21 Oct 2015 07:28:00 GMT', 1.0)
+    assert cache.get('https://b.com/') is None
+    assert cache.get('https://b.com/', partial=True).result.truncated
+
+
+def _serve(handler) -> typing.Callable[[typing.Callable[[str], typing.Awaitable]], typing.Any]:
+    """run a coroutine against a local http server answering every GET with `handler`"""
+    async def _run(test):
+        app = aiohttp.web.Application()
+        app.router.add_get('/{path:.*}', handler)
+        runner = aiohttp.web.AppRunner(app)
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            return await test(f'http://127.0.0.1:{port}')
+        finally:
+            await runner.cleanup()
+    return lambda test: asyncio.run(_run(test))
+
+
+def test_fetcher_revalidates(tmp_path):
+    """stale responses, and heads read by probes, are revalidated with their validators"""
+    conditional = []
+    page = b'<html><head><title>T</title></head><body>' + b'x' * 100000
+
+    async def handler(request):
+        conditional.append(request.headers.get('If-None-Match'))
+        headers = {'ETag': '"v1"', 'Cache-Control': 'no-cache', 'Content-Type': 'text/html; charset=utf-8'}
+        if request.headers.get('If-None-Match') == '"v1"':
+            return aiohttp.web.Response(status=304, headers=headers)
+        return aiohttp.web.Response(body=page, headers=headers)
+
+    async def fetch(base, path, head_only=False):
+        async with aiohttp.ClientSession() as session:
+            fetcher = bmmgr.Fetcher(session, bmmgr.FetchOptions(http_cache=str(tmp_path / 'http.db')))
+            try:
+                return await fetcher.fetch(f'{base}/{path}', head_only=head_only)
+            finally:
+                fetcher.close()
+
+    async def test(base):
+        probes = [await fetch(base, 'p', head_only=True) for _ in range(2)]
+        assert [(r.from_cache, r.truncated) for r in probes] == [(False, True), (True, True)]
+        assert probes[1].body == probes[0].body and len(probes[0].body) < len(page)
+        # a full fetch is not answered by the head, then it answers probes
+        pages = [await fetch(base, 'p'), await fetch(base, 'p'), await fetch(base, 'p', head_only=True)]
+        assert [(r.from_cache, r.body) for r in pages] == [(False, page), (True, page), (True, page)]
+
+    _serve(handler)(test)
+    assert conditional == [None, '"v1"', None, '"v1"', '"v1"']
+
+
+def test_negative_cache_backoff():
+    cache = bmmgr.NegativeCache(sqlite3.connect(':memory:'))
+    url = 'https://a.com/page'
+    cache.check(url)
+    cache.record(cache.uri_key(url), 'http 404')
+    with pytest.raises(bmmgr.NegativelyCached):
+        cache.check(url)
+    # other uris of the host are still tried, unless the host failed
+    cache.check('https://a.com/other')
+    cache.record(cache.host_key(url), 'ClientOSError')
+    with pytest.raises(bmmgr.NegativelyCached):
+        cache.check('https://a.com/other')
+    cache.clear(url)
+    cache.check(url)
+
+    # the backoff doubles with every failure after the previous one passed
+    key = cache.uri_key(url)
+    backoffs = []
+    for _ in range(3):
+        cache.record(key, 'http 500')
+        attempts, last_failed, next_attempt = cache._conn.execute(
+            "SELECT attempts, last_failed, next_attempt FROM failures WHERE key=?", (key,)).fetchone()
+        backoffs.append(round(next_attempt - last_failed))
+        cache._conn.execute("UPDATE failures SET next_attempt=0 WHERE key=?", (key,))
+    assert backoffs == [cache.BACKOFF, cache.BACKOFF * 2, cache.BACKOFF * 4]
+
+
+@pytest.mark.parametrize('version', [0, 1, 2])
+def test_sqlite_migrations(tmp_path, version):
+    """a database of every older schema version is upgraded in place and keeps its bookmarks"""
+    path = str(tmp_path / 'bookmarks.db')
+    icon = 'data:image/png;base64,AAAA'
+    conn = sqlite3.connect(path)
+    if version == 0:
+        # duplicated uris were possible, the latest wins
+        conn.execute("CREATE TABLE bookmarks(title, uri, icon_uri, icon_data_uri, tags)")
+        conn.executemany("INSERT INTO bookmarks VALUES (?,?,?,?,?)", [
+            ('old', 'https://a.com/', 'https://a.com/favicon.ico', '', 'x'),
+            ('t a', 'https://a.com/', 'https://a.com/favicon.ico', icon, 'x;y'),
+            ('t b', 'https://b.com/', 'https://b.com/favicon.ico', icon, 'w'),
+        ])
+    else:
+        for migration in bmmgr.SqliteStorage._MIGRATIONS[:version]:
+            migration(conn)
+        conn.execute(f"PRAGMA user_version={version}")
+        conn.execute("INSERT INTO icons VALUES (?,?)", (bmmgr.get_icon_hash(icon), icon))
+        conn.executemany("INSERT INTO bookmarks VALUES (?,?,?,?,?)", [
+            ('t a', 'https://a.com/', 'https://a.com/favicon.ico', bmmgr.get_icon_hash(icon), 'x;y'),
+            ('t b', 'https://b.com/', 'https://b.com/favicon.ico', icon, 'w'),
+        ])
+    conn.commit()
+    conn.close()
+
+    storage = bmmgr.SqliteStorage(path)
+    assert [(b.title, b.uri, sorted(b.tags), b.icon_data_uri) for b in storage.load()] == [
+        ('t a', 'https://a.com/', ['x', 'y'], icon), ('t b', 'https://b.com/', ['w'], icon)]
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == len(bmmgr.SqliteStorage._MIGRATIONS)
+        if version == 0:
+            assert conn.execute("SELECT COUNT(*) FROM icons").fetchone()[0] == 1
+    assert [b.uri for b in storage.search('t b', 10)] == ['https://b.com/']
+
+    modified = datetime.datetime(2020, 1, 2, 3, 4, 5)
+    added = bmmgr.Bookmark('t c', 'https://c.com/', modified=modified, tags={'z'}, icon_data_uri=icon)
+    storage.save([added])
+    updated = bmmgr.Bookmark('t b', 'https://b.com/', icon_data_uri='data:image/png;base64,BBBB')
+    updated.icon_updated = True
+    storage.update([updated], ['icon_data_uri', 'icon_uri'])
+    reloaded = bmmgr.SqliteStorage(path).load()
+    assert [b.uri for b in reloaded] == ['https://a.com/', 'https://b.com/', 'https://c.com/']
+    assert reloaded[1].icon_data_uri == 'data:image/png;base64,BBBB'
+    assert reloaded[2].data_dict() == added.data_dict()
+
+
+def _chrome_bookmarks(path: str):
+    def _url(name, url):
+        return {'date_added': '13', 'id': '1', 'meta_info': {'k': [1, 2.5e3, None, True]}, 'name': name, 'type': 'url',
+                'url': url}
+
+    def _folder(name, children):
+        return {'children': children, 'date_added': '1', 'name': name, 'type': 'folder'}
+
+    roots = {
+        'bookmark_bar': _folder('bookmark_bar', [
+            _url('a "quoted" é', 'https://a.com/é"\\'),
+            _folder('F1', [_url('b', 'https://b.com/'), _url('skipped', 'chrome://settings'), _folder('F2', [])]),
+        ]),
+        'other': _folder('other', [_folder('F1', [_folder('F3', [_url('c', 'https://c.com/')])]), _url('d', 'https://d.com/')]),
+        'synced': _folder('synced', []),
+    }
+    with open(path, 'w') as f:
+        json.dump({'checksum': 'abc', 'roots': roots, 'version': 1}, f, indent=2)
+
+
+def _firefox_bookmarks(path: str):
+    def _place(title, uri, icon='https://e.com/i.ico'):
+        return {'guid': 'x', 'title': title, 'dateAdded': 1600000000000000, 'lastModified': 1600000000000001,
+                'type': 'text/x-moz-place', 'uri': uri, 'iconuri': icon}
+
+    def _container(title, children):
+        return {'guid': 'f', 'title': title, 'dateAdded': 1600000000000000, 'lastModified': 1600000000000000,
+                'type': 'text/x-moz-place-container', 'children': children}
+
+    root = _container('', [
+        _container('menu', [_place('e', 'https://e.com/'), _place('fake', 'https://f.com/', 'fake-favicon-uri:x')]),
+        _container('toolbar', [_container('A', [_container('B', [_place('g', 'https://g.com/')])]), _place('h', 'https://h.com/')]),
+    ])
+    with open(path, 'wb') as f:
+        f.write(b'mozLz40\x00' + lz4.block.compress(json.dumps(root).encode()))
+
+
+@pytest.mark.parametrize('chunk', [7, bmmgr.JsonTreeScanner.CHUNK])
+@pytest.mark.parametrize('browser', ['chrome', 'firefox'])
+def test_stream_matches_loader(tmp_path, monkeypatch, browser, chunk):
+    """streaming a bookmarks file gives what loading it whole gives, path filters included"""
+    monkeypatch.setattr(bmmgr.JsonTreeScanner, 'CHUNK', chunk)
+    path = str(tmp_path / 'bookmarks')
+    if browser == 'chrome':
+        _chrome_bookmarks(path)
+        load, stream, filters = bmmgr.load_chrome, bmmgr.stream_chrome, [[], ['root.bookmark_bar.F1', 'root.other']]
+    else:
+        _firefox_bookmarks(path)
+        load, stream, filters = bmmgr.load_firefox, bmmgr.stream_firefox, [[], ['toolbar.A', 'menu']]
+
+    def _key(bookmarks):
+        # chrome tells no creation time, it is the load time
+        return [(b.parent, b.title, b.uri, b.icon_uri, sorted(b.tags), b.modified, b.created if browser == 'firefox' else None)
+                for b in bookmarks]
+
+    for paths in filters:
+        loaded, _ = bmmgr.convert2list_with_tags(load(path), paths)
+        assert loaded
+        assert _key(stream(path, paths)) == _key(loaded)
+
+
+def test_sync_diff():
+    modified = datetime.datetime(2020, 1, 1)
+    stored = [bmmgr.Bookmark('a', 'https://a.com/', tags={'x'}), bmmgr.Bookmark('b', 'https://b.com/', modified=modified),
+              bmmgr.Bookmark('c', 'https://c.com/'), bmmgr.Bookmark('d', 'https://d.com/', tags={'x'})]
+    sync = bmmgr.SyncDiff(stored)
+    added, changed = sync.diff([bmmgr.Bookmark('a', 'https://a.com/', tags={'x'}),
+                                bmmgr.Bookmark('b', 'https://b.com/', modified=modified + datetime.timedelta(seconds=1)),
+                                bmmgr.Bookmark('e', 'https://e.com/')])
+    assert [b.uri for b in added] == ['https://e.com/']
+    assert [b.uri for b in changed] == ['https://b.com/']
+    # browser bookmarks may come batch by batch
+    added, changed = sync.diff([bmmgr.Bookmark('d', 'https://d.com/', tags={'y'})])
+    assert (added, [b.uri for b in changed]) == ([], ['https://d.com/'])
+    assert sync.removed() == ['https://c.com/']
+
+
+@pytest.mark.parametrize('name', ['bookmarks.jsonl', 'split', 'bookmarks.db'])
+def test_sync_round_trip(tmp_path, name):
+    """syncing writes the changes and removes what the browser dropped, the storage then mirrors the browser"""
+    path = str(tmp_path / name)
+    if name == 'split':
+        os.makedirs(path)
+    storage = bmmgr.get_storage(path)
+    storage.save([_bookmark(i) for i in range(10)])
+    browser = [_bookmark(i, 'renamed' if i == 4 else '') for i in range(3, 13)]
+    sync = bmmgr.SyncDiff(storage.iter_load(with_icon=False))
+    added, changed = sync.diff(browser)
+    assert ([b.uri for b in added], [b.uri for b in changed]) == ([b.uri for b in browser[-3:]], [browser[1].uri])
+    storage.save(added + changed)
+    with storage.batch():
+        for uri in sync.removed():
+            storage.remove(uri=uri)
+    key = operator.itemgetter('uri')
+    assert sorted(_dicts(bmmgr.get_storage(path).load()), key=key) == sorted(_dicts(browser), key=key)
+    sync = bmmgr.SyncDiff(storage.iter_load(with_icon=False))
+    assert sync.diff(browser) == ([], []) and sync.removed() == []
+
+
+def test_sync_rejects_path_filters(tmp_path, monkeypatch):
+    """stored bookmarks keep no path, so every one out of the filters would be removed"""
+    path = str(tmp_path / 'Bookmarks')
+    _chrome_bookmarks(path)
+    storage = str(tmp_path / 'bookmarks.jsonl')
+    monkeypatch.setattr(sys, 'argv', ['bmmgr.py', 'convert', '-b', 'chrome', '-i', path, '--sync', '-p', 'root.other', storage])
+    with pytest.raises(SystemExit) as e:
+        bmmgr.main()
+    assert e.value.code == 1
+    assert not os.path.exists(storage)
+
+
+def test_write_static(tmp_path):
+    """unchanged content is not rewritten, precompressed siblings follow the content"""
+    path = str(tmp_path / 'page.html')
+    suffixes = ('.gz', '.br') if bmmgr.brotli is not None else ('.gz',)
+    assert bmmgr.write_static(path, ['<html>', b'one'], precompress=True)
+    mtimes = {suffix: os.stat(path + suffix).st_mtime_ns for suffix in ('', *suffixes)}
+    assert not os.path.exists(path + '.br') or bmmgr.brotli is not None
+    assert not bmmgr.write_static(path, ['<html>one'], precompress=True)
+    assert {suffix: os.stat(path + suffix).st_mtime_ns for suffix in ('', *suffixes)} == mtimes
+    assert [name for name in os.listdir(tmp_path) if name.endswith('.tmp')] == []
+
+    # a missing sibling is written even if the content did not change
+    os.remove(path + '.gz')
+    assert not bmmgr.write_static(path, ['<html>one'], precompress=True)
+    assert bmmgr.write_static(path, ['<html>two'], precompress=True)
+    with open(path, 'rb') as f:
+        assert f.read() == b'<html>two'
+    with gzip.open(path + '.gz') as f:
+        assert f.read() == b'<html>two'
+    if bmmgr.brotli is not None:
+        with open(path + '.br', 'rb') as f:
+            assert bmmgr.brotli.decompress(f.read()) == b'<html>two'
+
+
+def test_render_paged_unchanged(tmp_path):
+    """a render of the same bookmarks rewrites nothing, an icon that can not be decoded gets the placeholder"""
+    output_path = str(tmp_path / 'out.html')
+    bookmarks = [_bookmark(i) for i in range(30)] + [
+        bmmgr.Bookmark('broken', 'https://broken.com/', icon_data_uri='data:image/png;base64,abc')]
+
+    def _mtimes():
+        return {os.path.join(root, name): os.stat(os.path.join(root, name)).st_mtime_ns
+                for root, _, names in os.walk(tmp_path) for name in names}
+
+    bmmgr.render_paged(lambda: bookmarks, output_path, shard_size=8, precompress=True)
+    mtimes = _mtimes()
+    assert sum(name.endswith('.gz') for name in mtimes) > 5
+    bmmgr.render_paged(lambda: bookmarks, output_path, shard_size=8, precompress=True)
+    assert _mtimes() == mtimes
+
+
+QUERIES = [
+    [],
+    [[('uri', '=', 'https://h1.com/4')]],
+    [[('uri', 'in', ['https://h1.com/4', 'https://h2.com/5', 'https://none.com/'])], [('title', '=', 't7')]],
+    [[('uri', 'in', [])]],
+    [[('uri', 'prefix', 'https://h2.com/')]],
+    [[('uri', 'prefix', 'https://h2.com/1'), ('tags', 'has', 'y2')]],
+    [[('title', 'like', '%1%')], [('tags', 'like', '%y3%')]],
+    [[('icon_uri', 'prefix', 'https://h0.com/')]],
+    [[('tags', 'has', 'y')]],
+    [[('title', 'like', '%ü%'), ('uri', '=', 'https://h0.com/0')]],
+]
+
+
+@pytest.mark.parametrize('dnf', QUERIES)
+def test_query_plan_sql_matches_predicate(tmp_path, dnf):
+    """the sql of a plan, its uri lookups and its predicate select the same bookmarks.
+    sqlite LIKE also folds ascii case, so the texts here are of one case.
+    """
+    bookmarks = [_bookmark(i, f't{i}ü' if i % 4 == 0 else '') for i in range(20)]
+    plan = bmmgr.QueryPlan.compile(dnf)
+    assert bmmgr.QueryPlan.compile(dnf) is plan
+    expected = sorted(b.uri for b in bookmarks if plan.predicate(b))
+    for name in ('bookmarks.db', 'bookmarks.jsonl'):
+        storage = bmmgr.get_storage(str(tmp_path / name))
+        storage.save(bookmarks)
+        assert sorted(b.uri for b in storage.query(dnf)) == expected, name
+        assert sorted(b.uri for b in storage.query(plan)) == expected, name